@@ -3,17 +3,26 @@
 # This file is covered by the LICENSE file in the root of this project.
 # A keras generator which generates batches out of cached feature volumes
 
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from keras.utils import Sequence
+try:
+  from keras.utils import Sequence
+except ImportError:
+  # without keras (numpy head backend) the cache is not used as keras generator
+  Sequence = object
+
+from cache_policies import create_eviction_policy
+from feature_volume_store import FeatureVolumeStore, store_exists, quantize, dequantize
+from stage_timer import timer
 
 
 class FeatureVolumeCacheSequence(Sequence):
   """ A class which caches feature volumes in CPU memory.
   """
   
-  def __init__(self, config, feature_volume_size, cache_size):
+  def __init__(self, config, feature_volume_size, cache_size=None):
     """ Initialize the dataset. It is assumed that all feature volumes
       are present. No ground truth is used, thus this class is only for inference.
       Args:
@@ -21,139 +30,295 @@ class FeatureVolumeCacheSequence(Sequence):
           Used attributes:
             batch_size: size of a batch.
             'data_root_folder', 'infer_seqs_map': for path to feature volumes.
+          Optional attributes:
+            'cache_policy': eviction policy of the cache, 'fifo' (default), 'lru', 'clock' or 'spatial'.
+            'cache_bytes': memory budget of the cache in bytes (default 4 GB).
+            'cache_dtype': precision of the cached volumes, 'float32' (default), 'float16' or
+              'int8' (quantized per channel, volumes of int8 stores are cached without requantization).
+            'loader_workers': number of threads reading missed volumes of a batch (default 4).
         feature_volume_size: a tuple with size of the feature volume (heightxwidthxchannels).
         cache_size: number of feature volumes to be stored (in CPU memory).
+          If None, it is given by the memory budget.
     """
     
     self.datasetpath_map = config['data_root_folder'] + '/' + config['infer_seqs_map']
     self.datasetpath_query = config['data_root_folder'] + '/' + config['infer_seqs_query']
     self.batch_size = config['batch_size']
     self.feature_volume_size = feature_volume_size
+    
+    # The cache stores the volumes in compact precision, they are converted
+    # to float32 when a batch is assembled. int8 entries have a scale and zero point per channel.
+    self.cache_dtype = np.dtype(config.get('cache_dtype', 'float32'))
+    self.quantized = self.cache_dtype == np.int8
+    self.params_shape = (2, feature_volume_size[-1])
+    self.volume_bytes = int(np.prod(feature_volume_size)) * self.cache_dtype.itemsize
+    if self.quantized:
+      self.volume_bytes += int(np.prod(self.params_shape)) * 4
+    if cache_size is None:
+      cache_size = max(1, int(config.get('cache_bytes', 4 * 1024 ** 3)) // self.volume_bytes)
     self.cache_size = cache_size
     
+    # The packed stores (memory mapped) of map and query feature volumes.
+    # They are opened on first use.
+    self.map_store = None
+    self.query_store = None
+    
     # The cache:: feature volumes as
-    # a numpy array with dimension n x w x h x chans
-    self.cache = np.zeros((cache_size, feature_volume_size[0], feature_volume_size[1],
-                           feature_volume_size[2]))
+    # blocks of numpy arrays with dimension n x w x h x chans.
+    # Blocks are allocated when they are needed, thus the cache grows lazily up to cache_size.
+    self.block_size = max(1, min(cache_size, (64 * 1024 ** 2) // self.volume_bytes))
+    self.cache_blocks = []
+    self.params_blocks = []
     
-    # A lookup table for the cache. The filename is used as a key. The
+    # A lookup table for the cache. The record index in the map store is used as a key. The
     # values is the index in the cache
     self.cache_entries = {}
-    # Vice versa: the key for every entry in the cache
-    self.key_for_cache_entries = ["" for i in range(0, cache_size)]
-    self.nextfreeidx = 0
+    # Vice versa: the key for every entry in the cache, -1 if unused
+    self.key_for_cache_entries = np.full(cache_size, -1, dtype=np.int64)
+    self.num_used = 0
     
-    # Statistics
-    self.no_queries = 0
-    self.cache_hit = 0
+    # The eviction policy decides which entry is reused when the cache is full.
+    # It also keeps the statistics.
+    self.policy = create_eviction_policy(config.get('cache_policy', 'fifo'), cache_size)
+    
+    # The cache is read and filled concurrently by batch assembly and prefetching threads.
+    # The lock protects the lookup table, the eviction policy and the cache entries.
+    # Missed volumes are read from the store without holding the lock.
+    self.lock = threading.Lock()
+    self.prefetched = 0
+    self.loader = ThreadPoolExecutor(max_workers=config.get('loader_workers', 4))
+    
+    # Two preallocated batch buffers: one is filled while the other one is in the model
+    self.batch_buffers = [np.zeros((self.batch_size,) + tuple(feature_volume_size), dtype=np.float32)
+                          for _ in range(2)]
   
-  def coord2filename(self, coord):
+  def open_store(self, datasetpath):
+    """ Open the packed feature volume store of a sequence.
     """
-      Input: 1x2 numpy array of X and Y coordinate.
-      Ouput: complete filename for the feature volume.
+    if not store_exists(datasetpath):
+      raise FileNotFoundError('No packed feature volumes in %s, please run gen_feature_volumes.py '
+                              '(or feature_volume_store.py to pack existing .npz volumes).' % datasetpath)
+    return FeatureVolumeStore(datasetpath)
+  
+  def open_stores(self):
+    if self.map_store is None:
+      self.map_store = self.open_store(self.datasetpath_map)
+      self.query_store = self.open_store(self.datasetpath_query)
+  
+  def new_task(self, coord_current_frame, coordinates_nearby_grid, query_volume=None):
+    # print('New task with current frame coord', coord_current_frame)
+    self.open_stores()
+    
+    # Convert to records of the map store
+    grid_coords = np.round(np.asarray(coordinates_nearby_grid) / self.map_store.resolution).astype(np.int64)
+    self.set_task(coord_current_frame, self.map_store.lookup(grid_coords), grid_coords, query_volume)
+  
+  def new_record_task(self, coord_current_frame, map_records, query_volume=None):
+    """ Same as new_task(), but the grids are given as records of the map store.
     """
-    new_x = str('{:+.2f}'.format(coord[0])).zfill(10)
-    new_y = str('{:+.2f}'.format(coord[1])).zfill(10)
-    file_name = new_x + '_' + new_y
-    return file_name
+    self.open_stores()
+    self.set_task(coord_current_frame, map_records, self.map_store.record_keys()[map_records], query_volume)
   
-  def coord_or_idx2filename(self, coord_or_idx):
+  def set_task(self, coord_current_frame, map_records, map_grid_coords, query_volume=None):
+    """ Set the pairs to infer. The query feature volume is read from the query store,
+      unless it is given (e.g. computed online from a scan by live_query.py).
     """
-      Args: A numpy array of X and Y coordinate
-        or an index as int (numpy.integer type).
-      Returns: filename (without any extension).
+    # Number of pairs to infer
+    self.n = len(map_records)
+    self.map_records = map_records
+    self.map_grid_coords = map_grid_coords
+    with self.lock:
+      self.policy.begin_task(self.map_grid_coords)
+    
+    # prepare first leg: the query broadcasted to the batch size (without copying)
+    if query_volume is None:
+      query_record = self.query_store.lookup(np.array([coord_current_frame]))[0]
+      query_volume = self.load_feature_volume(query_record, use_query_seq=True)
+    fcurrent = np.asarray(query_volume, dtype=np.float32).reshape(self.feature_volume_size)
+    self.input1 = np.broadcast_to(fcurrent, (self.batch_size,) + fcurrent.shape)
+  
+  # Get the feature volumes of the pairs start to end: either from the cache or load them.
+  # Cached volumes are copied into out while holding the lock, thus they cannot be evicted meanwhile.
+  def get_feature_volumes(self, start, end, out):
+    records = self.map_records[start:end]
+    
+    missed = []
+    with self.lock:
+      for i, record in enumerate(records):
+        if record in self.cache_entries:
+          self.policy.on_hit(self.cache_entries[record])
+          self.read_entry(self.cache_entries[record], out[i])
+        else:
+          self.policy.on_miss()
+          missed.append(i)
+    
+    timer.count('cache_hits', len(records) - len(missed))
+    timer.count('cache_misses', len(missed))
+    if len(missed) == 0:
+      return out
+    
+    # read the missed volumes concurrently, copying from the memory mapped store releases the GIL.
+    # For a quantized cache the int8 volumes are kept to be inserted without requantization.
+    raw_volumes = {}
+    def read_volume(i):
+      if self.quantized and records[i] >= 0:
+        raw_volumes[i] = self.load_quantized_volume(records[i])
+        dequantize(raw_volumes[i][0], raw_volumes[i][1], out[i])
+      else:
+        out[i] = self.load_feature_volume(records[i])
+    with timer.stage('disk_read'):
+      if len(missed) > 1:
+        list(self.loader.map(read_volume, missed))
+      else:
+        read_volume(missed[0])
+    
+    with self.lock:
+      for i in missed:
+        if records[i] >= 0 and records[i] not in self.cache_entries:
+          self.insert_volume(records[i], self.map_grid_coords[start + i], *raw_volumes.get(i, (out[i],)))
+    return out
+  
+  def insert_volume(self, record, grid_coord, volume, params=None):
+    """ Store a feature volume in the cache, the caller must hold the lock.
+      A float volume is quantized for an int8 cache, unless the quantization parameters are given.
+      Returns: the index in the cache.
     """
-    if type(coord_or_idx) == np.ndarray:
-      new_x = str('{:+.2f}'.format(coord_or_idx[0])).zfill(10)
-      new_y = str('{:+.2f}'.format(coord_or_idx[1])).zfill(10)
-      file_name = new_x + '_' + new_y
+    if self.num_used < self.cache_size:
+      idx = self.num_used
+      self.num_used += 1
+      if idx == len(self.cache_blocks) * self.block_size:
+        self.cache_blocks.append(np.empty((self.block_size,) + tuple(self.feature_volume_size),
+                                          dtype=self.cache_dtype))
+        if self.quantized:
+          self.params_blocks.append(np.empty((self.block_size,) + self.params_shape, dtype=np.float32))
     else:
-      file_name = str(coord_or_idx).zfill(6)
+      # cache is full, delete the victim from index
+      idx = self.policy.victim()
+      del self.cache_entries[self.key_for_cache_entries[idx]]
+      self.key_for_cache_entries[idx] = -1
     
-    return file_name
+    if self.quantized:
+      if params is None:
+        volume, params = quantize(np.asarray(volume)[None], 'channel')
+        volume, params = volume[0], params[0]
+      self.params_blocks[idx // self.block_size][idx % self.block_size] = params
+    self.cache_entry(idx)[:] = volume
+    
+    self.cache_entries[record] = idx
+    self.key_for_cache_entries[idx] = record
+    self.policy.on_insert(idx, grid_coord)
+    return idx
   
-  def new_task(self, coord_current_frame, coordinates_nearby_grid):
-    # print('New task with current frame coord', coord_current_frame)
-    # Number of pairs to infer
-    self.n = len(coordinates_nearby_grid)
-    # Convert to filenames
-    self.map_filenames = []
-    for i in range(0, self.n):
-      self.map_filenames.append(self.coord2filename(coordinates_nearby_grid[i]))
-    
-    self.current_filename = self.coord_or_idx2filename(coord_current_frame)
-    
-    # prepare first leg: a repeated version of query
-    fcurrent = self.load_feature_volume(self.current_filename, use_query_seq=True)
-    self.input1 = np.tile(fcurrent, (self.batch_size, 1, 1, 1,))
-  
-  # Get a feature volume: either from the cache or load it.
-  def get_feature_volume(self, batchi):
-    # print('get_feature_volume %s' % self.map_filenames[batchi] )
-    # sys.stdout.flush()
-    
-    self.no_queries += 1
-    if self.map_filenames[batchi] in self.cache_entries:
-      self.cache_hit += 1
-      # print('cache hit')
-      # sys.stdout.flush()
-    else:
-      if len(self.key_for_cache_entries[self.nextfreeidx]) > 0:
-        # cache entry already used, delete from index
-        # print('del old entry')
-        # sys.stdout.flush()
-        del self.cache_entries[self.key_for_cache_entries[self.nextfreeidx]]
-        self.key_for_cache_entries[self.nextfreeidx] = ''
-      
-      self.cache[self.nextfreeidx, :, :, :] = self.load_feature_volume(self.map_filenames[batchi])
-      
-      self.cache_entries[self.map_filenames[batchi]] = self.nextfreeidx
-      self.key_for_cache_entries[self.nextfreeidx] = self.map_filenames[batchi]
-      self.nextfreeidx += 1
-      if self.nextfreeidx == self.cache_size:
-        self.nextfreeidx = 0
-    
-    return self.cache[self.cache_entries[self.map_filenames[batchi]], :, :, :]
-  
-  def load_feature_volume(self, filename, use_query_seq=False):
-    if (use_query_seq):
-      complete_path = self.datasetpath_query + '/feature_volumes/' + filename + '.npz'
+  def is_cached(self, records):
+    """ Returns: boolean numpy array, True for records in the cache.
+    """
+    with self.lock:
+      return np.array([record in self.cache_entries for record in records], dtype=bool)
+  
+  def prefetch(self, records, grid_coords):
+    """ Load feature volumes into the cache ahead of their use. The pages of the
+      memory mapped store are read without holding the lock.
+      Args:
+        records: records of the map store.
+        grid_coords: nx2 numpy array of integer grid coordinates of the records.
+    """
+    self.open_stores()
+    for record, grid_coord in zip(records, grid_coords):
+      if record < 0 or record in self.cache_entries:
+        continue
+      with timer.stage('prefetch_read'):
+        if self.quantized:
+          volume, params = self.load_quantized_volume(record)
+        else:
+          volume, params = np.array(self.map_store.read(record), dtype=self.cache_dtype), None
+      with self.lock:
+        if record not in self.cache_entries:
+          self.insert_volume(record, grid_coord, volume, params)
+          self.prefetched += 1
+  
+  def cache_entry(self, idx):
+    """ The feature volume stored in an entry of the cache.
+    """
+    return self.cache_blocks[idx // self.block_size][idx % self.block_size]
+  
+  def read_entry(self, idx, out):
+    """ Copy an entry of the cache into out as float32, int8 entries are dequantized.
+    """
+    if self.quantized:
+      dequantize(self.cache_entry(idx), self.params_blocks[idx // self.block_size][idx % self.block_size], out)
     else:
-      complete_path = self.datasetpath_map + '/feature_volumes/' + filename + '.npz'
+      out[:] = self.cache_entry(idx)
+  
+  def cache_memory(self):
+    """ Returns: the number of bytes currently allocated for the cache.
+    """
+    return len(self.cache_blocks) * self.block_size * self.volume_bytes
+  
+  def load_feature_volume(self, record, use_query_seq=False):
+    """ Read a feature volume from a packed store. This is a view into the memory mapped
+      file, thus only the pages of this record are read.
+    """
+    store = self.query_store if use_query_seq else self.map_store
     
-    # print('load %s' % complete_path)
-    if not os.path.exists(complete_path):
-      print('ERROR: feature volume %s doest not exist!!!!' % complete_path)
-      return np.zeros((1, 360, 128))
+    if record < 0:
+      print('ERROR: feature volume doest not exist in %s!!!!' % store.folder)
+      return np.zeros(self.feature_volume_size)
     
-    return np.load(complete_path)['arr_0']
+    return store.read(record)
+  
+  def load_quantized_volume(self, record):
+    """ Read a feature volume of the map store as int8 payload and quantization parameters (per channel).
+      The volumes of int8 stores are copied, float32 volumes are quantized.
+    """
+    volume, params = self.map_store.read_raw(record)
+    if params is None:
+      volume, params = quantize(np.asarray(volume)[None], 'channel')
+      return volume[0], params[0]
+    return np.array(volume), np.broadcast_to(params, self.params_shape)
   
   # implemented interface of Sequence base class
   def __len__(self):
     return int(np.ceil(self.n / float(self.batch_size)))
   
+  def get_batch(self, idx, input2):
+    """ Assemble a batch into the given buffer for the second leg.
+      Args:
+        idx: index of the batch.
+        input2: buffer of size batch_size x h x w x chans.
+      Returns:
+        the inputs of the head for this batch.
+    """
+    maxidx = min((idx + 1) * self.batch_size, self.n)
+    cb_size = maxidx - idx * self.batch_size
+    
+    input2 = self.get_feature_volumes(idx * self.batch_size, maxidx, input2[0:cb_size, :, :, :])
+    return [self.input1[0:cb_size, :, :, :], input2]
+  
+  def get_buffered_batch(self, idx):
+    """ Assemble a batch into one of the two preallocated buffers (alternating).
+      The batch must be consumed before the batch idx + 2 is assembled.
+    """
+    return self.get_batch(idx, self.batch_buffers[idx % 2])
+  
+  def get_fixed_batch(self, idx):
+    """ Assemble a batch into the first preallocated buffer. The inputs always have the full
+      batch size (unused entries are stale), thus the shape given to the model never changes.
+      Returns:
+        the inputs of the head and the number of valid entries.
+    """
+    maxidx = min((idx + 1) * self.batch_size, self.n)
+    cb_size = maxidx - idx * self.batch_size
+    self.get_feature_volumes(idx * self.batch_size, maxidx, self.batch_buffers[0][0:cb_size, :, :, :])
+    return [self.input1, self.batch_buffers[0]], cb_size
+  
   # implemented interface of Sequence base class
   def __getitem__(self, idx):
-    # print('getitem with ', idx)
-    # sys.stdout.flush()
-    
-    maxidx = (idx + 1) * self.batch_size
-    
-    cb_size = self.batch_size
-    input1 = self.input1
-    if maxidx > self.n:
-      maxidx = self.n
-      cb_size = maxidx - idx * self.batch_size
-      input1 = self.input1[0:cb_size, :, :, :]
-    
-    input2 = np.zeros((cb_size, self.feature_volume_size[0], self.feature_volume_size[1],
-                       self.feature_volume_size[2]))
-    d = idx * self.batch_size
-    for batchi in range(idx * self.batch_size, maxidx):
-      input2[batchi - d, :, :, :] = self.get_feature_volume(batchi)
-    
-    return ([input1, input2], 0)
+    input2 = np.zeros((self.batch_size, self.feature_volume_size[0], self.feature_volume_size[1],
+                       self.feature_volume_size[2]), dtype=np.float32)
+    return (self.get_batch(idx, input2), 0)
   
   def print_statistics(self):
-    print('Feature volume cache hit rate: %5.1f %%' %
-          (100.0 * self.cache_hit / self.no_queries))
+    print('Feature volume cache hit rate (%s policy): %5.1f %% (%d hits, %d misses)' %
+          (self.policy.name, self.policy.hit_rate(), self.policy.hits, self.policy.misses))
+    print('Feature volume cache memory: %.1f MB (%d of %d entries used, %d prefetched)' %
+          (self.cache_memory() / 1024.0 ** 2, self.num_used, self.cache_size, self.prefetched))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: micro-benchmarks of the particle filter components on synthetic maps, particles and a stub head.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import yaml
+import numpy as np
+
+from initialization import init_particles_given_coords
+from map_manifest import MapManifest
+from motion_model import motion_model
+from particle_set import ParticleSet
+from resample import resample, RESAMPLING_SCHEMES
+
+
+def synthetic_map(num_cells, resolution):
+  """ A synthetic map: num_cells grids filling a square row by row.
+    Returns: the map manifest.
+  """
+  width = int(np.ceil(np.sqrt(num_cells)))
+  ys, xs = np.divmod(np.arange(num_cells), width)
+  return MapManifest(np.stack([xs - width // 2, ys - width // 2], axis=1), resolution)
+
+
+def synthetic_particles(num_particles, manifest, rng, capacity=None):
+  """ Particles spread uniformly over the grids of the map with random weights.
+    Returns: the particles (ParticleSet).
+  """
+  particles = np.empty((num_particles, 4))
+  particles[:, :2] = manifest.coords[rng.integers(len(manifest.coords), size=num_particles)]
+  particles[:, :2] += rng.uniform(-0.5, 0.5, (num_particles, 2))
+  particles[:, 2] = rng.uniform(-np.pi, np.pi, num_particles)
+  particles[:, 3] = rng.random(num_particles)
+  return ParticleSet.from_array(particles, capacity, rng)
+
+
+class StubModel():
+  """ A stand-in for FastInfer: the overlap of a grid decreases with its distance to the origin,
+    the yaw bin is given by the grid coordinates. Thus the sensor model can be timed without the network.
+  """
+  volume_cache = None
+
+  def __init__(self, overlap_range=50.):
+    self.overlap_range = overlap_range
+    self.num_cells = 0
+
+  def infer_overlaps(self, idx_current_frame, grid_coords, query_volume=None, low_latency_cells=0):
+    grid_coords = np.asarray(grid_coords, dtype=np.float64)
+    self.num_cells += len(grid_coords)
+    distances = np.hypot(grid_coords[:, 0], grid_coords[:, 1])
+    overlaps = np.exp(-distances / self.overlap_range).astype(np.float32)
+    yaws = (np.abs(grid_coords[:, 0]) + np.abs(grid_coords[:, 1])).astype(np.int64) % 360
+    return overlaps, yaws
+
+
+def time_runs(function, setup, repetitions):
+  """ Time a function, setup() is called before every run and is not timed.
+    Returns: the mean, min and max duration in milliseconds.
+  """
+  durations = []
+  for _ in range(repetitions):
+    args = setup()
+    t_start = time.perf_counter()
+    function(*args)
+    durations.append(1000. * (time.perf_counter() - t_start))
+  return {'mean_ms': float(np.mean(durations)), 'min_ms': float(np.min(durations)),
+          'max_ms': float(np.max(durations)), 'repetitions': repetitions}
+
+
+def bench_motion_model(num_particles, manifest, rng, repetitions):
+  particles = synthetic_particles(num_particles, manifest, rng)
+  command = np.array([0.05, 5., 0.02])
+  return time_runs(motion_model, lambda: (particles, command), repetitions)
+
+
+def bench_update_weights(num_particles, manifest, rng, repetitions, config):
+  from sensor_model_overlap import SensorModel
+  sensor_config = {'resolution': manifest.resolution, 'use_yaw': True, 'yaw_sigma': 5, 'num_reduced': -1,
+                   'converge_thres': -1, 'min_overlap_for_angle': 0.7}
+  sensor_config.update(config.get('sensor_model', {}) or {})
+  model = StubModel()
+  sensor_model = SensorModel(sensor_config, manifest.bounds, None, model=model, manifest=manifest)
+  particles = synthetic_particles(num_particles, manifest, rng)
+  init = particles.to_array()
+
+  def setup():
+    particles.assign(init)
+    return particles, 0
+  result = time_runs(sensor_model.update_weights, setup, repetitions)
+  result['cells_per_run'] = model.num_cells // repetitions
+  return result
+
+
+def bench_resample(num_particles, manifest, rng, repetitions, scheme):
+  particles = synthetic_particles(num_particles, manifest, rng)
+  init = particles.to_array()
+  # skewed weights, thus the effective sample size is small and the particles are always resampled
+  init[:, 3] = rng.random(num_particles) ** 8
+
+  def setup():
+    particles.assign(init)
+    return (particles, None, scheme)
+  return time_runs(resample, setup, repetitions)
+
+
+def bench_init_particles(num_particles, manifest, rng, repetitions):
+  coords = manifest.coords.astype(float)
+  return time_runs(init_particles_given_coords, lambda: (num_particles, coords, 1.0, rng), repetitions)
+
+
+def bench_cache(num_cells, manifest, rng, repetitions, config, folder):
+  """ Time the feature volume cache: every run requests random grids of the map in batches,
+    the cache is smaller than the map, thus grids are read from the store and entries are evicted.
+  """
+  from FeatureVolumeCacheSequence import FeatureVolumeCacheSequence
+  from feature_volume_store import FeatureVolumeStore
+
+  volume_shape = tuple(config.get('volume_shape', [1, 8, 8]))
+  store_folder = os.path.join(folder, 'cells_%d' % num_cells)
+  os.makedirs(store_folder)
+  store = FeatureVolumeStore.create(store_folder, manifest.coords, volume_shape, manifest.resolution,
+                                    np.dtype(config.get('volume_dtype', 'float32')))
+  store.write(slice(None), rng.random((len(store),) + volume_shape, dtype=np.float32))
+  store.finalize()
+
+  cache_config = {'data_root_folder': folder, 'infer_seqs_map': '', 'infer_seqs_query': '',
+                  'batch_size': config.get('batch_size', 64),
+                  'cache_policy': config.get('cache_policy', 'fifo'),
+                  'cache_dtype': config.get('cache_dtype', 'float32'),
+                  'loader_workers': config.get('loader_workers', 4)}
+  cache = FeatureVolumeCacheSequence(cache_config, volume_shape, config.get('cache_volumes', 4096))
+  cache.map_store = store
+  cache.query_store = store
+  query_volume = np.zeros(volume_shape, dtype=np.float32)
+  num_requests = min(num_cells, config.get('cache_requests', 4096))
+
+  def setup():
+    # requests are local: a window of the map around a random grid
+    start = rng.integers(max(1, num_cells - num_requests))
+    records = np.sort(rng.permutation(np.arange(start, start + num_requests)))
+    cache.new_record_task(0, records, query_volume)
+    return ()
+
+  def get_batches():
+    for batch_idx in range(len(cache)):
+      cache.get_fixed_batch(batch_idx)
+
+  result = time_runs(get_batches, setup, repetitions)
+  result.update({'requests_per_run': num_requests, 'cache_volumes': cache.cache_size,
+                 'hit_rate': cache.policy.hit_rate()})
+  cache.loader.shutdown()
+  del store, cache
+  shutil.rmtree(store_folder)
+  return result
+
+
+def run_benchmarks(config):
+  """ Run all benchmarks for the configured numbers of particles and grids.
+    Returns: list of dicts with the name, the size and the timings of every benchmark.
+  """
+  rng = np.random.default_rng(config.get('seed', 0))
+  repetitions = config.get('repetitions', 5)
+  resolution = config.get('resolution', 0.2)
+  particle_counts = config.get('particle_counts', [1000, 10000, 100000, 1000000])
+  cell_counts = config.get('cell_counts', [1000, 10000, 100000, 1000000])
+  schemes = config.get('resample_schemes', sorted(RESAMPLING_SCHEMES.keys()))
+  benchmarks = config.get('benchmarks', ['motion_model', 'update_weights', 'resample', 'init_particles', 'cache'])
+
+  results = []
+  def report(name, num_particles, num_cells, result, **extra):
+    result = dict({'benchmark': name, 'particles': num_particles, 'cells': num_cells}, **extra, **result)
+    results.append(result)
+    print('%-16s %-12s particles %8s  cells %8s  mean %9.2f ms  min %9.2f ms' %
+          (name, extra.get('scheme', ''), num_particles or '-', num_cells or '-', result['mean_ms'], result['min_ms']))
+
+  folder = tempfile.mkdtemp()
+  try:
+    for num_cells in cell_counts:
+      manifest = synthetic_map(num_cells, resolution)
+      if 'cache' in benchmarks:
+        report('cache', None, num_cells, bench_cache(num_cells, manifest, rng, repetitions, config, folder))
+      for num_particles in particle_counts:
+        if 'update_weights' in benchmarks:
+          report('update_weights', num_particles, num_cells,
+                 bench_update_weights(num_particles, manifest, rng, repetitions, config))
+        if 'init_particles' in benchmarks:
+          report('init_particles', num_particles, num_cells,
+                 bench_init_particles(num_particles, manifest, rng, repetitions))
+
+    # the motion model and resampling do not depend on the map
+    manifest = synthetic_map(cell_counts[0], resolution)
+    for num_particles in particle_counts:
+      if 'motion_model' in benchmarks:
+        report('motion_model', num_particles, None, bench_motion_model(num_particles, manifest, rng, repetitions))
+      if 'resample' in benchmarks:
+        for scheme in schemes:
+          report('resample', num_particles, None,
+                 bench_resample(num_particles, manifest, rng, repetitions, scheme), scheme=scheme)
+  finally:
+    shutil.rmtree(folder)
+  return results
+
+
+def environment():
+  return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+          'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+          'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+if __name__ == '__main__':
+  # load config file
+  config_filename = '../config/benchmark.yml'
+  if len(sys.argv) > 1:
+    config_filename = sys.argv[1]
+
+  if yaml.__version__ >= '5.1':
+    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
+  else:
+    config = yaml.load(open(config_filename))
+
+  results = run_benchmarks(config)
+
+  results_file = config.get('results_file', 'benchmark_results.json')
+  with open(results_file, 'w') as f:
+    json.dump({'environment': environment(), 'config': config, 'results': results}, f, indent=2)
+  print('Saved the benchmark results to', results_file)
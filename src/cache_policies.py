@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: eviction policies for the feature volume cache.
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class EvictionPolicy():
+  """ Base class of the eviction policies. A policy decides which slot of a full cache is reused
+    for a new feature volume. Every policy counts its own cache hits and misses.
+  """
+  name = 'base'
+
+  def __init__(self, cache_size):
+    """ Initialization:
+      cache_size: number of slots in the cache.
+    """
+    self.cache_size = cache_size
+    self.hits = 0
+    self.misses = 0
+
+  def begin_task(self, grid_coords):
+    """ Called once per frame with the integer grid coordinates of all grids of the task,
+      which are the grids under the current particle cloud.
+    """
+    pass
+
+  def on_hit(self, slot):
+    self.hits += 1
+
+  def on_miss(self):
+    self.misses += 1
+
+  def on_insert(self, slot, grid_coord):
+    """ Called after a feature volume was loaded into a slot (after a miss or by prefetching).
+    """
+    pass
+
+  def victim(self):
+    """ Returns: the slot of a full cache which is evicted next.
+    """
+    raise NotImplementedError
+
+  def hit_rate(self):
+    if self.hits + self.misses == 0:
+      return 0.0
+    return 100.0 * self.hits / (self.hits + self.misses)
+
+
+class FIFOPolicy(EvictionPolicy):
+  """ First in, first out: the slots are reused as a ring.
+  """
+  name = 'fifo'
+
+  def __init__(self, cache_size):
+    super().__init__(cache_size)
+    self.nextidx = 0
+
+  def victim(self):
+    slot = self.nextidx
+    self.nextidx = (self.nextidx + 1) % self.cache_size
+    return slot
+
+
+class LRUPolicy(EvictionPolicy):
+  """ Least recently used: the slot which was not accessed for the longest time is evicted.
+  """
+  name = 'lru'
+
+  def __init__(self, cache_size):
+    super().__init__(cache_size)
+    self.order = OrderedDict()
+
+  def on_hit(self, slot):
+    super().on_hit(slot)
+    self.order.move_to_end(slot)
+
+  def on_insert(self, slot, grid_coord):
+    super().on_insert(slot, grid_coord)
+    self.order[slot] = True
+    self.order.move_to_end(slot)
+
+  def victim(self):
+    slot, _ = self.order.popitem(last=False)
+    return slot
+
+
+class ClockPolicy(EvictionPolicy):
+  """ CLOCK (second chance): an approximation of LRU with one reference bit per slot.
+  """
+  name = 'clock'
+
+  def __init__(self, cache_size):
+    super().__init__(cache_size)
+    self.referenced = np.zeros(cache_size, dtype=bool)
+    self.hand = 0
+
+  def on_hit(self, slot):
+    super().on_hit(slot)
+    self.referenced[slot] = True
+
+  def on_insert(self, slot, grid_coord):
+    super().on_insert(slot, grid_coord)
+    self.referenced[slot] = True
+
+  def victim(self):
+    while self.referenced[self.hand]:
+      self.referenced[self.hand] = False
+      self.hand = (self.hand + 1) % self.cache_size
+    slot = self.hand
+    self.hand = (self.hand + 1) % self.cache_size
+    return slot
+
+
+class SpatialPolicy(EvictionPolicy):
+  """ Evicts the grid which is farthest from the current particle cloud.
+    The distances of all cached grids to the grids of the current task are computed
+    once per frame, the victims are then taken in order of decreasing distance.
+  """
+  name = 'spatial'
+
+  def __init__(self, cache_size):
+    super().__init__(cache_size)
+    self.grid_coords = np.zeros((cache_size, 2), dtype=np.int64)
+    self.is_used = np.zeros(cache_size, dtype=bool)
+    # slots filled during the current task are not evicted before all others
+    self.is_fresh = np.zeros(cache_size, dtype=bool)
+    self.eviction_order = []
+    self.nextidx = 0
+
+  def begin_task(self, grid_coords):
+    self.is_fresh[:] = False
+    used_slots = np.flatnonzero(self.is_used)
+    if len(used_slots) == 0 or len(grid_coords) == 0:
+      self.eviction_order = list(used_slots)
+      return
+    distances, _ = cKDTree(grid_coords).query(self.grid_coords[used_slots])
+    # farthest first, slots under the particle cloud are never evicted by the spatial order
+    order = np.argsort(-distances, kind='stable')
+    order = order[distances[order] > 0]
+    # reversed, thus pop() returns the farthest slot
+    self.eviction_order = list(used_slots[order][::-1])
+
+  def on_insert(self, slot, grid_coord):
+    super().on_insert(slot, grid_coord)
+    self.grid_coords[slot] = grid_coord
+    self.is_used[slot] = True
+    self.is_fresh[slot] = True
+
+  def victim(self):
+    while len(self.eviction_order) > 0:
+      slot = self.eviction_order.pop()
+      if not self.is_fresh[slot]:
+        return slot
+    # all cached grids are under the particle cloud: fall back to a ring over the slots,
+    # it skips the slots filled during the current task unless all slots are fresh
+    for _ in range(self.cache_size):
+      if not self.is_fresh[self.nextidx]:
+        break
+      self.nextidx = (self.nextidx + 1) % self.cache_size
+    slot = self.nextidx
+    self.nextidx = (self.nextidx + 1) % self.cache_size
+    return slot
+
+
+EVICTION_POLICIES = {policy.name: policy for policy in [FIFOPolicy, LRUPolicy, ClockPolicy, SpatialPolicy]}
+
+
+def create_eviction_policy(name, cache_size):
+  """ Create an eviction policy by its name ('fifo', 'lru', 'clock' or 'spatial').
+  """
+  if name not in EVICTION_POLICIES:
+    raise ValueError('Unknown cache policy %s, use one of %s' % (name, list(EVICTION_POLICIES.keys())))
+  return EVICTION_POLICIES[name](cache_size)
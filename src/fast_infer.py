@@ -5,21 +5,28 @@
 
 import os
 import sys
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-from FeatureVolumeCacheSequence import FeatureVolumeCacheSequence
+from feature_volume_store import FeatureVolumeStore, store_exists
+from generation_checkpoint import GenerationCheckpoint
+from head_inference import HeadInference
 sys.path.append('../OverlapNet/src/two_heads')
 from ImagePairOverlapOrientationSequence import ImagePairOverlapOrientationSequence
 from infer import Infer
 
 
-class FastInfer(Infer):
-  """ This is a class for fast online OverlapNet inferring with multiple frames
+class FastInfer(HeadInference, Infer):
+  """ This is a class for fast online OverlapNet inferring with multiple frames.
+    The inference of the head is implemented in HeadInference, the keras models are loaded by Infer.
   """
-  def __init__(self, config, cache_size):
+  def __init__(self, config, cache_size=None):
     """
       config: configure parameters.
-      cache_size: number of cached feature volumes.
+      cache_size: number of cached feature volumes. If None, the number is given by the memory budget
+        of the cache (config['cache_bytes']).
     """
     if not 'infer_seqs' in config:
       # Assuming query sequence (first leg) AND map_sequence (second leg)
@@ -28,28 +35,16 @@ class FastInfer(Infer):
       self.seq_map=config['infer_seqs_map']
       
     super().__init__(config)
-    feature_volume_size = (int(self.head.input_shape[0][1]),
-                           int(self.head.input_shape[0][2]),
-                           int(self.head.input_shape[0][3]))
-    self.volume_cache = FeatureVolumeCacheSequence(config, feature_volume_size, cache_size)
-  
-  def infer_multiple(self, idx_current_frame, coordinates_nearby_grid):
-    """
-      idx_current_frame: current query scan index.
-      coordinates_nearby_grid: coordinates of grids assigned to particles.
-    """
-    self.volume_cache.new_task(idx_current_frame, coordinates_nearby_grid)
-    
-    model_outputs = self.head.predict_generator(self.volume_cache, max_queue_size=10,
-                                                workers=1, verbose=1)
-    # in case of single head, make output a list of size 1                                     
-    if not isinstance(model_outputs, list):
-      model_outputs = [model_outputs]
-    
-    return model_outputs
-  
-  def print_statistics(self):
-    self.volume_cache.print_statistics()
+    self.init_head_inference(config, cache_size)
+    # format of the written feature volumes: float32 or int8 (quantized per volume or per channel)
+    self.volume_dtype = np.dtype(config.get('volume_dtype', 'float32'))
+    self.volume_quantization = config.get('volume_quantization', 'channel')
+    # generation of feature volumes: batch size of the leg, volumes per checkpointed shard,
+    # threads loading the inputs and threads writing the volumes
+    self.generation_batch_size = config.get('generation_batch_size', 256)
+    self.generation_shard_size = config.get('generation_shard_size', 4096)
+    self.generation_loaders = config.get('generation_loaders', 8)
+    self.generation_writers = config.get('generation_writers', 2)
   
   def coord2filename(self, coord):
     """
@@ -76,77 +71,193 @@ class FastInfer(Infer):
       
     return file_name
 
-  def save_feature_volumes(self, coords_or_idx, save_new_volumes=True):
+  def coords_or_idx2keys(self, coords_or_idx):
+    """
+      Args: nx2 numpy array of map coordinates X,Y or 1D numpy array of frame indices.
+      Returns: keys for the packed feature volume store (integer grid coordinates or frame indices).
+    """
+    if coords_or_idx.ndim == 2:
+      return np.round(coords_or_idx / self.resolution).astype(np.int64)
+    return np.asarray(coords_or_idx, dtype=np.int64)
+
+  def save_feature_volumes(self, coords_or_idx=None, save_new_volumes=True, replace=False):
     """ For external usage to save the feature volumes.
+      The feature volumes are written into the packed store of the sequence (see feature_volume_store.py),
+      ordered along a space-filling curve. Volumes which are already in the store or exist
+      as single .npz files are reused. With config['volume_dtype'] 'int8' the volumes are quantized.
+      The new volumes are inferred in shards (see generate_feature_volumes()), the progress is checkpointed,
+      thus an interrupted generation resumes with the unfinished shards.
       Input:
         coords_or_idx: Either nx2 numpy array of map coordinates X,Y
           or 1D array of size n numpy array of frame indices (thus filenames will be e.g. 000000.npy).
+          If None, an unfinished generation is resumed.
+        replace: if True, the given volumes are inferred again, also if they exist (e.g. after the map changed).
     """
-    n = len(coords_or_idx)
-    filenames_for_generation = []
-    coordinate_for_generation = []
-    feature_volumes_exist = []
-    is_new = np.ones(n)
+    seq_folder = os.path.join(self.datasetpath, self.seq)
+    checkpoint = GenerationCheckpoint.load(seq_folder)
+    if coords_or_idx is None:
+      if checkpoint is None:
+        raise FileNotFoundError('No unfinished generation of feature volumes in %s' % seq_folder)
+    elif checkpoint is not None and not checkpoint.matches(self.coords_or_idx2keys(coords_or_idx),
+                                                           self.volume_dtype, self.volume_quantization):
+      print('Discard the unfinished generation of feature volumes in %s, it was started for other volumes.'
+            % seq_folder)
+      checkpoint.remove()
+      checkpoint = None
     
-    for i in range(n):
-      filename = self.coord_or_idx2filename(coords_or_idx[i])
-      complete_path = self.datasetpath + '/feature_volumes/' + \
-                      filename + '.npz'
-      
-      if os.path.exists(complete_path):
-        feature_volumes_exist.append(np.load(complete_path)['arr_0'])
-        is_new[i] = 0
+    if checkpoint is not None:
+      store = FeatureVolumeStore.open_pending(seq_folder)
+      if store.resumed:
+        print('Resume the generation of feature volumes in %s: %d of %d shards done' %
+              (seq_folder, np.sum(checkpoint.done), len(checkpoint.done)))
       else:
-        filenames_for_generation.append(filename)
-        coordinate_for_generation.append(coords_or_idx[i])
-        if coords_or_idx.ndim==2:
-          print("Generate new feature volume for (%f, %f)" % (coords_or_idx[i, 0], coords_or_idx[i, 1]))
-        else:
-          print("Generate new feature volume for index %d" % coords_or_idx[i])
-
-    feature_volumes_exist = np.array(feature_volumes_exist)
+        # the files of the new segment are lost or do not match the pending index
+        store.discard()
+        checkpoint.remove()
+        checkpoint = None
+        if coords_or_idx is None:
+          raise FileNotFoundError('The unfinished generation of feature volumes in %s can not be resumed, '
+                                  'please start it again.' % seq_folder)
+        print('Restart the generation of feature volumes in %s, its unfinished store is incomplete.' % seq_folder)
+    
+    if checkpoint is None:
+      checkpoint, store = self.plan_feature_volumes(seq_folder, coords_or_idx, save_new_volumes, replace)
+      if store is None:
+        return
+    
+    self.generate_feature_volumes(checkpoint, store, save_new_volumes)
+    
+    if save_new_volumes:
+      store.finalize()
+    else:
+      store.discard()
+    checkpoint.remove()
+  
+  def plan_feature_volumes(self, seq_folder, coords_or_idx, save_checkpoint=True, replace=False):
+    """ Create the new store and the plan of the volumes to infer (all given volumes if replace is set).
+      The new volumes are appended to the existing store (see FeatureVolumeStore.create()), thus the records
+      of the other volumes are kept. If the format of the store changed, the existing volumes are copied.
+      Single .npz volumes are reused.
+      Returns:
+        the checkpoint (GenerationCheckpoint) and the new store, None and None if all volumes exist.
+    """
+    keys = self.coords_or_idx2keys(coords_or_idx)
+    old_store = FeatureVolumeStore(seq_folder) if store_exists(seq_folder) else None
+    is_new = np.ones(len(keys), dtype=bool)
+    if old_store is not None and not replace:
+      is_new = old_store.lookup(keys) < 0
     
-    generation_size = len(filenames_for_generation)
-    if generation_size > 0:
-      if generation_size % self.batch_size == 0:
-        loop_range = int(generation_size / self.batch_size)
+    if old_store is not None and old_store.has_format(self.feature_volume_size, self.volume_dtype,
+                                                      self.volume_quantization):
+      if not np.any(is_new):
+        print('All %d feature volumes exist.' % len(keys))
+        return None, None
+      store = FeatureVolumeStore.create(seq_folder, keys[is_new], self.feature_volume_size, self.resolution,
+                                        self.volume_dtype, self.volume_quantization, base=old_store)
+    else:
+      # a new store, the existing volumes are copied in the order of their records
+      all_keys = keys
+      if old_store is not None:
+        order = np.argsort(old_store.records)
+        old_keys, old_records = old_store.keys[order], old_store.records[order]
+        all_keys = np.concatenate([old_keys, keys.reshape((-1,) + old_keys.shape[1:])])
+      store = FeatureVolumeStore.create(seq_folder, all_keys, self.feature_volume_size, self.resolution,
+                                        self.volume_dtype, self.volume_quantization)
+      if old_store is not None:
+        records = store.lookup(old_keys)
+        for start in range(0, len(records), self.batch_size):
+          store.copy_records(records[start:start + self.batch_size], old_store,
+                             old_records[start:start + self.batch_size])
+    records = store.lookup(keys)
+    
+    # single .npz volumes are listed once instead of probing every file
+    volume_folder = os.path.join(seq_folder, 'feature_volumes')
+    npz_names = set()
+    if os.path.isdir(volume_folder) and not replace:
+      npz_names = set(os.path.splitext(f)[0] for f in os.listdir(volume_folder) if f.endswith('.npz'))
+    
+    names_for_generation = []
+    records_for_generation = []
+    for i in np.flatnonzero(is_new):
+      name = self.coord_or_idx2filename(coords_or_idx[i])
+      if name in npz_names:
+        store.write(records[i], np.load(os.path.join(volume_folder, name + '.npz'))['arr_0'])
       else:
-        loop_range = int(generation_size / self.batch_size) + 1
-      for loop_idx in range(loop_range):
-        if (generation_size - loop_idx * self.batch_size) < self.batch_size:
-          batch_end = generation_size
-        else:
-          batch_end = (loop_idx + 1) * self.batch_size
-        real_batch_size = len(filenames_for_generation[loop_idx * self.batch_size:batch_end])
-        test_generator_leg = ImagePairOverlapOrientationSequence(self.datasetpath,
-                                                                 filenames_for_generation[
-                                                                 loop_idx * self.batch_size:batch_end],
-                                                                 [],
-                                                                 [self.seq for _ in
-                                                                  range(len(filenames_for_generation))],
-                                                                 [],
-                                                                 np.zeros((real_batch_size)),
-                                                                 np.zeros((real_batch_size)),
-                                                                 self.network_output_size, self.batch_size,
-                                                                 self.inputShape[0], self.inputShape[1],
-                                                                 self.no_input_channels,
-                                                                 use_depth=self.use_depth,
-                                                                 use_normals=self.use_normals,
-                                                                 use_class_probabilities=self.use_class_probabilities,
-                                                                 use_intensity=self.use_intensity,
-                                                                 use_class_probabilities_pca=self.use_class_probabilities_pca)
-        
-        feature_volumes_new = self.leg.predict_generator(test_generator_leg, max_queue_size=10,
-                                                         workers=8, verbose=1)
-        
-        if save_new_volumes:
-          for i in range(len(feature_volumes_new)):
-            f = self.datasetpath + '/' + self.seq + '/feature_volumes/'
-            f += self.coord_or_idx2filename(coordinate_for_generation[i + loop_idx * self.batch_size])
-            if coords_or_idx.ndim!=2:
-              f += '.npz'
-
-            np.savez_compressed(f, feature_volumes_new[i])
+        names_for_generation.append(name)
+        records_for_generation.append(records[i])
+    
+    # the volumes are inferred in the order of the records, thus shards are written to contiguous parts of the store
+    order = np.argsort(records_for_generation, kind='stable')
+    checkpoint = GenerationCheckpoint(seq_folder, keys, store.keys, np.array(names_for_generation, dtype=str)[order],
+                                      np.array(records_for_generation, dtype=np.int64)[order],
+                                      self.generation_shard_size, self.feature_volume_size, self.resolution,
+                                      self.volume_dtype, self.volume_quantization)
+    print('%d of %d feature volumes exist, %d are generated in %d shards' %
+          (len(keys) - len(names_for_generation), len(keys), len(names_for_generation), len(checkpoint.done)))
+    if save_checkpoint:
+      store.flush()
+      checkpoint.save()
+    return checkpoint, store
+  
+  def infer_legs(self, names):
+    """ Infer the feature volumes of the depth and normal data of the given names with the leg.
+      Returns:
+        numpy array of size n x h x w x chans.
+    """
+    generator = ImagePairOverlapOrientationSequence(self.datasetpath, list(names), [],
+                                                    [self.seq for _ in range(len(names))], [],
+                                                    np.zeros((len(names))), np.zeros((len(names))),
+                                                    self.network_output_size, self.generation_batch_size,
+                                                    self.inputShape[0], self.inputShape[1],
+                                                    self.no_input_channels,
+                                                    use_depth=self.use_depth,
+                                                    use_normals=self.use_normals,
+                                                    use_class_probabilities=self.use_class_probabilities,
+                                                    use_intensity=self.use_intensity,
+                                                    use_class_probabilities_pca=self.use_class_probabilities_pca)
+    return self.leg.predict_generator(generator, max_queue_size=10, workers=self.generation_loaders, verbose=0)
+  
+  def generate_feature_volumes(self, checkpoint, store, save_new_volumes=True):
+    """ Infer the pending shards of a checkpoint and write them into the store.
+      The volumes of a shard are written by a pool of background writers while the next shard is inferred.
+      A shard is marked as done when its volumes are flushed to disk.
+    """
+    pending = checkpoint.pending_shards()
+    if len(pending) == 0:
+      return
+    total = len(checkpoint.records)
+    generated = int(np.sum(checkpoint.done)) * checkpoint.shard_size
+    writer = ThreadPoolExecutor(max_workers=self.generation_writers)
+    in_flight = collections.deque()
+    
+    def complete(shard_idx, writes):
+      for write in writes:
+        write.result()
+      if save_new_volumes:
+        store.flush()
+        checkpoint.mark_done(shard_idx)
+    
+    t_start = time.perf_counter()
+    num_inferred = 0
+    for shard_idx in pending:
+      names, records = checkpoint.shard(shard_idx)
+      volumes = self.infer_legs(names)
+      num_inferred += len(names)
+      writes = []
+      if save_new_volumes:
+        for start in range(0, len(records), self.generation_batch_size):
+          end = start + self.generation_batch_size
+          writes.append(writer.submit(store.write, records[start:end], volumes[start:end]))
+      in_flight.append((shard_idx, writes))
+      # the writes of the previous shard have run during the inference of this one
+      while len(in_flight) > 1:
+        complete(*in_flight.popleft())
+      generated = min(total, generated + len(names))
+      print('Generated %d of %d feature volumes (%.1f volumes/s)' %
+            (generated, total, num_inferred / (time.perf_counter() - t_start)))
+    while len(in_flight) > 0:
+      complete(*in_flight.popleft())
+    writer.shutdown()
 
 
 # Test code    
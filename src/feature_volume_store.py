@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a packed store of feature volumes: one contiguous file with fixed size records, read by memory mapping.
+
+import os
+import sys
+import uuid
+import yaml
+import numpy as np
+
+# file names inside a sequence folder (e.g. 07/map): the index refers to the segment files of the records,
+# a store which is created but not finalized has a pending index
+INDEX_FILENAME = 'feature_volumes_index.npz'
+PENDING_INDEX_FILENAME = 'feature_volumes_index.pending.npz'
+# the records and the scales and zero points (int8 stores) of stores written before segments were introduced
+VOLUMES_FILENAME = 'feature_volumes.npy'
+QUANTIZATION_FILENAME = 'feature_volumes_quantization.npy'
+
+# granularity of the quantization: one scale and zero point per volume or per channel of a volume
+QUANTIZATION_MODES = ['volume', 'channel']
+
+
+def quantize(volumes, mode='channel'):
+  """ Quantize feature volumes to int8 (asymmetric, zero is exactly representable).
+    Args:
+      volumes: numpy array of size n x h x w x chans.
+      mode: 'volume' or 'channel', see QUANTIZATION_MODES.
+    Returns:
+      the int8 payload (n x h x w x chans) and the parameters (n x 2 x chans or n x 2 x 1 float32 array,
+      scales and zero points).
+  """
+  if mode not in QUANTIZATION_MODES:
+    raise ValueError('Unknown quantization mode: %s, use one of %s' % (mode, QUANTIZATION_MODES))
+  volumes = np.asarray(volumes, dtype=np.float32)
+  axis = (1, 2) if mode == 'channel' else (1, 2, 3)
+  low = np.minimum(np.min(volumes, axis=axis), 0).reshape(len(volumes), -1)
+  high = np.maximum(np.max(volumes, axis=axis), 0).reshape(len(volumes), -1)
+  scales = (high - low) / 255.
+  scales[scales <= 0] = 1.
+  zero_points = np.clip(np.round(-128. - low / scales), -128, 127)
+
+  payload = np.round(volumes / scales[:, None, None, :]) + zero_points[:, None, None, :]
+  payload = np.clip(payload, -128, 127).astype(np.int8)
+  return payload, np.stack([scales, zero_points], axis=1).astype(np.float32)
+
+
+def dequantize(payload, params, out=None):
+  """ Convert int8 volumes back to float32.
+    Args:
+      payload: int8 numpy array of size (n x) h x w x chans.
+      params: the scales and zero points given by quantize(), size (n x) 2 x chans or (n x) 2 x 1.
+      out: optional float32 output array of the size of payload.
+    Returns:
+      the float32 volumes.
+  """
+  params = np.asarray(params)
+  scales = params[..., 0, :][..., None, None, :]
+  zero_points = params[..., 1, :][..., None, None, :]
+  out = np.subtract(payload, zero_points, out=out, dtype=np.float32)
+  return np.multiply(out, scales, out=out)
+
+
+def segment_filenames(segment):
+  """ Returns: the file names of the records and of the quantization parameters of a segment.
+    The segment '' is the single file of a store written before segments were introduced.
+  """
+  if not segment:
+    return VOLUMES_FILENAME, QUANTIZATION_FILENAME
+  return 'feature_volumes_%s.npy' % segment, 'feature_volumes_%s_quantization.npy' % segment
+
+
+def morton_codes(grid_xs, grid_ys):
+  """ Interleave the bits of non-negative integer coordinates (Z-order curve),
+    thus spatially close grids get close codes.
+    Args:
+      grid_xs, grid_ys: non-negative integer coordinates smaller than 2^32.
+    Returns:
+      numpy array of uint64 codes.
+  """
+  def spread_bits(v):
+    v = np.asarray(v).astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+  return spread_bits(grid_xs) | (spread_bits(grid_ys) << np.uint64(1))
+
+
+class FeatureVolumeStore():
+  """ This class stores all feature volumes of a sequence in contiguous files of fixed size records
+    (.npy files of shape n x h x w x chans) plus an index. The volumes are read with np.memmap, thus reading
+    a volume is a page read without decompression and the OS page cache is shared between runs.
+
+    There are two kinds of stores:
+      'grid': keys are integer grid coordinates (real coordinates divided by the resolution).
+              The records are ordered along a Z-order curve, thus neighbouring grids are adjacent on disk.
+      'frame': keys are frame indices of query scans, the records are ordered by index.
+
+    The records are float32 or int8. int8 records are quantized per volume or per channel (see quantize()),
+    their scales and zero points are in a second file. read() returns float32 volumes for both formats.
+
+    The records are kept in segments (files named by a unique id), the records of a segment never change.
+    Every version of the store writes one new segment: either all records, or only the new and replaced ones
+    appended to the segments of the previous version (see create()). Thus a record index always refers
+    to the same volume within a lineage of versions, the memo and the head parts of the map are kept.
+    create() writes a pending index and finalize() renames it to the index in one atomic step,
+    thus the index always refers to complete segments. Segments which are not referenced any more are removed.
+  """
+  def __init__(self, folder, mode='r'):
+    """ Open an existing store.
+      Args:
+        folder: the sequence folder which contains the store (e.g. data/07/map).
+        mode: 'r' for reading, 'r+' for writing into existing records of the last segment.
+    """
+    self.load_index(folder, INDEX_FILENAME)
+    self.open_segments(self.segments, mode)
+    self.segment_sizes = [len(volumes) for volumes in self.segment_volumes]
+    self.offsets = np.cumsum([0] + self.segment_sizes)
+
+  def load_index(self, folder, filename):
+    index = np.load(os.path.join(folder, filename))
+    self.folder = folder
+    self.kind = str(index['kind'])
+    self.version = str(index['version'])
+    self.resolution = float(index['resolution'])
+    self.origin = index['origin'].astype(np.int64)
+    self.codes = index['codes'].astype(np.uint64)
+    self.records = index['records'].astype(np.int64)
+    self.keys = index['keys'].astype(np.int64)
+    self.keys_by_record = None
+    self.quantization = str(index['quantization']) if 'quantization' in index else ''
+    # stores written before segments were introduced have a single file and no format in the index
+    self.lineage = str(index['lineage']) if 'lineage' in index else self.version
+    self.segments = [str(segment) for segment in index['segments']] if 'segments' in index else ['']
+    self.segment_sizes = [int(size) for size in index['segment_sizes']] if 'segment_sizes' in index else None
+    self.volume_shape = tuple(int(size) for size in index['volume_shape']) if 'volume_shape' in index else None
+    self.dtype = np.dtype(str(index['dtype'])) if 'dtype' in index else None
+
+  def save_index(self, filename):
+    tmp_index = os.path.join(self.folder, filename + '.tmp.npz')
+    np.savez(tmp_index, kind=self.kind, version=self.version, resolution=self.resolution,
+             origin=self.origin, codes=self.codes, records=self.records, keys=self.keys,
+             quantization=self.quantization, lineage=self.lineage, segments=np.array(self.segments, dtype=str),
+             segment_sizes=np.array(self.segment_sizes, dtype=np.int64), volume_shape=self.volume_shape,
+             dtype=self.dtype.name)
+    os.replace(tmp_index, os.path.join(self.folder, filename))
+
+  def open_segments(self, segments, mode):
+    self.segment_volumes = []
+    self.segment_params = []
+    for segment in segments:
+      volumes_file, params_file = segment_filenames(segment)
+      self.segment_volumes.append(np.load(os.path.join(self.folder, volumes_file), mmap_mode=mode))
+      self.segment_params.append(np.load(os.path.join(self.folder, params_file), mmap_mode=mode)
+                                 if self.quantization else None)
+    if len(self.segment_volumes) > 0:
+      self.volume_shape = self.segment_volumes[0].shape[1:]
+      self.dtype = self.segment_volumes[0].dtype
+
+  def open_new_segment(self, resume):
+    """ Open the files of the new (last) segment of a store which is not finalized for writing,
+      see open_unfinished(). self.resumed tells whether the records were kept.
+    """
+    volumes_file, params_file = segment_filenames(self.segments[-1])
+    volumes, created = open_unfinished(os.path.join(self.folder, volumes_file), self.dtype,
+                                       (self.segment_sizes[-1],) + self.volume_shape, resume)
+    self.resumed = not created
+    params = None
+    if self.quantization:
+      # the parameters are only kept together with the records
+      params, created = open_unfinished(os.path.join(self.folder, params_file), np.float32,
+                                        (self.segment_sizes[-1],) + self.params_shape(), self.resumed)
+      if created:
+        params[:, 0] = 1.
+        self.resumed = False
+    self.segment_volumes.append(volumes)
+    self.segment_params.append(params)
+    self.offsets = np.cumsum([0] + self.segment_sizes)
+
+  def params_shape(self):
+    """ Returns: the shape of the scales and zero points of a record of an int8 store.
+    """
+    return (2, self.volume_shape[-1] if self.quantization == 'channel' else 1)
+
+  def has_format(self, volume_shape, dtype=np.float32, quantization='channel'):
+    """ Check whether the records have the given format, thus records of this format can be appended.
+    """
+    quantization = quantization if np.dtype(dtype) == np.int8 else ''
+    return (tuple(self.volume_shape) == tuple(int(size) for size in volume_shape) and
+            self.dtype == np.dtype(dtype) and self.quantization == quantization)
+
+  @classmethod
+  def create(cls, folder, keys, volume_shape, resolution=0.0, dtype=np.float32, quantization='channel', base=None):
+    """ Create a new version of the store with zero initialized records in a new segment.
+      Its pending index is written, the existing store is replaced only when the returned store is finalized.
+      An unfinished store in the folder is discarded.
+      Args:
+        folder: the sequence folder for the store.
+        keys: nx2 numpy array of integer grid coordinates or 1D numpy array of frame indices.
+        volume_shape: size of a feature volume (heightxwidthxchannels).
+        resolution: the resolution of the grids, only used for grid stores.
+        dtype: dtype of the records, np.float32 or np.int8 (quantized, write the records with write()).
+        quantization: granularity of the quantization of int8 stores, 'volume' or 'channel'.
+        base: optional existing store of the same format (see has_format()) in folder. The new version keeps
+          its segments and lineage, the records of keys which are in base are replaced by the new ones.
+      Returns:
+        the store opened for writing (the records of keys), the records are in the order of store.keys.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if np.dtype(dtype) == np.int8 and quantization not in QUANTIZATION_MODES:
+      raise ValueError('Unknown quantization mode: %s, use one of %s' % (quantization, QUANTIZATION_MODES))
+    if base is not None and not base.has_format(volume_shape, dtype, quantization):
+      raise ValueError('Records can only be appended to a store of the same format')
+    new_keys = np.unique(keys, axis=0) if keys.ndim == 2 else np.unique(keys)
+
+    all_keys = new_keys
+    kept_records = np.zeros(0, dtype=np.int64)
+    if base is not None:
+      # the records of keys which are not appended again are kept
+      is_kept = ~np.isin(base.records, base.lookup(new_keys))
+      all_keys = np.concatenate([base.keys[is_kept], new_keys])
+      kept_records = base.records[is_kept]
+    kind, origin, codes = key_codes(all_keys)
+    # the new records are ordered along the space-filling curve within the new segment
+    first_record = base.num_records() if base is not None else 0
+    new_records = np.empty(len(new_keys), dtype=np.int64)
+    new_records[np.argsort(codes[len(kept_records):], kind='stable')] = first_record + np.arange(len(new_keys))
+    records = np.concatenate([kept_records, new_records])
+    order = np.argsort(codes, kind='stable')
+    discard_pending(folder)
+
+    store = cls.__new__(cls)
+    store.folder = folder
+    store.kind = kind
+    store.version = uuid.uuid4().hex
+    store.lineage = base.lineage if base is not None else store.version
+    store.resolution = base.resolution if base is not None else float(resolution)
+    store.origin = origin
+    store.codes = codes[order]
+    store.records = records[order]
+    store.keys = all_keys[order]
+    store.keys_by_record = None
+    store.quantization = quantization if np.dtype(dtype) == np.int8 else ''
+    store.volume_shape = tuple(int(size) for size in volume_shape)
+    store.dtype = np.dtype(dtype)
+    store.segments = (base.segments if base is not None else []) + [uuid.uuid4().hex]
+    store.segment_sizes = (base.segment_sizes if base is not None else []) + [len(new_keys)]
+    store.segment_volumes = list(base.segment_volumes) if base is not None else []
+    store.segment_params = list(base.segment_params) if base is not None else []
+    store.open_new_segment(resume=False)
+    store.save_index(PENDING_INDEX_FILENAME)
+    return store
+
+  @classmethod
+  def open_pending(cls, folder):
+    """ Open the store which was created but not finalized (e.g. by an interrupted generation) for writing.
+      Returns:
+        the store, None if there is none. store.resumed is False if the files of its new segment were lost
+        or do not match the pending index, the records are zero initialized again.
+    """
+    if not unfinished_store_exists(folder):
+      return None
+    store = cls.__new__(cls)
+    store.load_index(folder, PENDING_INDEX_FILENAME)
+    store.open_segments(store.segments[:-1], 'r')
+    store.open_new_segment(resume=True)
+    return store
+
+  def finalize(self):
+    """ Flush the records of a newly created store and make it the store of the folder:
+      the pending index is renamed to the index, then the segments which are not referenced any more are removed.
+    """
+    self.flush()
+    os.replace(os.path.join(self.folder, PENDING_INDEX_FILENAME), os.path.join(self.folder, INDEX_FILENAME))
+    remove_unreferenced_segments(self.folder, self.segments)
+    self.segment_volumes.pop()
+    self.segment_params.pop()
+    volumes_file, params_file = segment_filenames(self.segments[-1])
+    self.segment_volumes.append(np.load(os.path.join(self.folder, volumes_file), mmap_mode='r'))
+    self.segment_params.append(np.load(os.path.join(self.folder, params_file), mmap_mode='r')
+                               if self.quantization else None)
+
+  def flush(self):
+    """ Flush the written records of a store which is not finalized to disk.
+    """
+    self.segment_volumes[-1].flush()
+    if self.segment_params[-1] is not None:
+      self.segment_params[-1].flush()
+
+  def discard(self):
+    """ Remove the files of a newly created store which is not finalized.
+    """
+    self.segment_volumes.pop()
+    self.segment_params.pop()
+    discard_pending(self.folder)
+
+  def num_records(self):
+    """ Returns: the number of records in all segments, including records which were replaced.
+    """
+    return int(self.offsets[-1])
+
+  def segment_id(self, segment_idx):
+    """ Returns: a unique id of a segment (the single file of an old store is identified by the lineage).
+    """
+    return self.segments[segment_idx] or self.lineage
+
+  def read(self, records, out=None):
+    """ Read feature volumes as float32.
+      Args:
+        records: a record index, a slice or a numpy array of record indices.
+        out: optional float32 output array, only used for int8 stores.
+      Returns:
+        the volumes, for float32 stores with a single segment a view into the memory mapped file.
+    """
+    payload, params = self.read_raw(records)
+    if params is None:
+      return payload
+    return dequantize(payload, params, out)
+
+  def read_raw(self, records):
+    """ Returns: the stored payload and the quantization parameters (None for float32 stores) of records.
+    """
+    if len(self.segment_volumes) == 1:
+      params = self.segment_params[0]
+      return self.segment_volumes[0][records], params[records] if params is not None else None
+
+    if isinstance(records, slice):
+      records = np.arange(self.num_records())[records]
+    records = np.asarray(records, dtype=np.int64)
+    segments = np.searchsorted(self.offsets, records, side='right') - 1
+    if records.ndim == 0:
+      local = records - self.offsets[segments]
+      params = self.segment_params[segments]
+      return self.segment_volumes[segments][local], params[local] if params is not None else None
+
+    payload = np.empty((len(records),) + tuple(self.volume_shape), dtype=self.dtype)
+    params = np.empty((len(records),) + self.params_shape(), dtype=np.float32) if self.quantization else None
+    for segment in np.unique(segments):
+      is_in_segment = segments == segment
+      local = records[is_in_segment] - self.offsets[segment]
+      payload[is_in_segment] = self.segment_volumes[segment][local]
+      if params is not None:
+        params[is_in_segment] = self.segment_params[segment][local]
+    return payload, params
+
+  def new_records(self, records):
+    """ Returns: the given records of the last segment as indices into its files.
+    """
+    offset = self.offsets[-2]
+    if offset == 0:
+      return records
+    if isinstance(records, slice):
+      records = np.arange(self.num_records())[records]
+    records = np.asarray(records, dtype=np.int64) - offset
+    if np.any(records < 0):
+      raise IndexError('Only the records of the last segment can be written')
+    return records
+
+  def write(self, records, volumes):
+    """ Write float32 feature volumes into records of the last segment, they are quantized for int8 stores.
+      Args:
+        records: a record index, a slice or a numpy array of record indices.
+        volumes: the volumes, size h x w x chans for a single record.
+    """
+    records = self.new_records(records)
+    if self.segment_params[-1] is None:
+      self.segment_volumes[-1][records] = volumes
+      return
+    volumes = np.asarray(volumes, dtype=np.float32)
+    payload, params = quantize(volumes.reshape((-1,) + tuple(self.volume_shape)), self.quantization)
+    if volumes.ndim == len(self.volume_shape):
+      payload, params = payload[0], params[0]
+    self.segment_volumes[-1][records] = payload
+    self.segment_params[-1][records] = params
+
+  def copy_records(self, records, source, source_records):
+    """ Copy records of another store, quantized volumes of the same format are copied without requantization.
+    """
+    if self.quantization and source.quantization == self.quantization:
+      records = self.new_records(records)
+      self.segment_volumes[-1][records], self.segment_params[-1][records] = source.read_raw(source_records)
+    else:
+      self.write(records, source.read(source_records))
+
+  def storage_bytes(self):
+    """ Returns: the size of the records and the quantization parameters of all segments in bytes.
+    """
+    return sum(volumes.nbytes for volumes in self.segment_volumes) + \
+           sum(params.nbytes for params in self.segment_params if params is not None)
+
+  def __len__(self):
+    return len(self.records)
+
+  def lookup(self, keys):
+    """ Find the records of keys.
+      Args:
+        keys: nx2 numpy array of integer grid coordinates or 1D numpy array of frame indices.
+      Returns:
+        numpy array with the record index of each key, -1 if the key is not in the store.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if self.kind == 'grid':
+      keys = keys.reshape(-1, 2)
+      local = keys - self.origin
+      valid = np.all((local >= 0) & (local < 2 ** 32), axis=1)
+      codes = morton_codes(np.where(valid, local[:, 0], 0), np.where(valid, local[:, 1], 0))
+    else:
+      keys = keys.reshape(-1)
+      valid = keys >= 0
+      codes = np.where(valid, keys, 0).astype(np.uint64)
+
+    pos = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+    found = valid & (self.codes[pos] == codes)
+    return np.where(found, self.records[pos], -1)
+
+  def lookup_coords(self, real_coords):
+    """ Find the records of grids given their real coordinates (in meters).
+    """
+    grid_coords = np.round(np.asarray(real_coords, dtype=float) / self.resolution).astype(np.int64)
+    return self.lookup(grid_coords)
+
+  def record_keys(self):
+    """ The keys of all records, in record order. Records which were replaced have the key zero.
+    """
+    if self.keys_by_record is None:
+      self.keys_by_record = np.zeros((self.num_records(),) + self.keys.shape[1:], dtype=np.int64)
+      self.keys_by_record[self.records] = self.keys
+    return self.keys_by_record
+
+
+def key_codes(keys):
+  """ Returns: the kind of the keys ('grid' or 'frame'), the origin of the grid coordinates
+    and the codes of the keys (the order of the records).
+  """
+  if keys.ndim == 2:
+    origin = np.min(keys, axis=0)
+    return 'grid', origin, morton_codes(keys[:, 0] - origin[0], keys[:, 1] - origin[1])
+  return 'frame', np.zeros(2, dtype=np.int64), keys.astype(np.uint64)
+
+
+def unfinished_store_exists(folder):
+  """ Check whether a created but not finalized store is in the folder.
+  """
+  return os.path.exists(os.path.join(folder, PENDING_INDEX_FILENAME))
+
+
+def discard_pending(folder):
+  """ Remove the pending index and the new (last) segment of a store which is not finalized.
+  """
+  pending_index = os.path.join(folder, PENDING_INDEX_FILENAME)
+  if not os.path.exists(pending_index):
+    return
+  for filename in segment_filenames(str(np.load(pending_index)['segments'][-1])):
+    if os.path.exists(os.path.join(folder, filename)):
+      os.remove(os.path.join(folder, filename))
+  os.remove(pending_index)
+
+
+def remove_unreferenced_segments(folder, segments):
+  """ Remove the segment files in the folder which are not in segments (e.g. of a replaced version),
+    also unfinished files of stores written before segments were introduced.
+  """
+  referenced = set(filename for segment in segments for filename in segment_filenames(segment))
+  for filename in os.listdir(folder):
+    if filename.startswith('feature_volumes') and filename.endswith(('.npy', '.npy.tmp')) and \
+        filename not in referenced:
+      os.remove(os.path.join(folder, filename))
+
+
+def open_unfinished(filename, dtype, shape, resume):
+  """ Open the memory mapped .npy file of a store which is not finalized.
+    If resume is set and the file exists with the same dtype and shape, it is opened for writing
+    with its content, otherwise a new zero initialized file is created.
+    Returns:
+      the array and True if the file was created.
+  """
+  if resume and os.path.exists(filename):
+    array = np.load(filename, mmap_mode='r+')
+    if array.dtype == np.dtype(dtype) and array.shape == tuple(shape):
+      return array, False
+    del array
+  return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape), True
+
+
+def store_exists(folder):
+  """ Check whether a (complete) packed store is in the folder.
+  """
+  return os.path.exists(os.path.join(folder, INDEX_FILENAME))
+
+
+def pack_feature_volumes(folder, resolution, dtype=np.float32, quantization='channel'):
+  """ Convert a folder of per-grid/per-frame .npz feature volumes (folder/feature_volumes/*.npz)
+    into a packed store in folder.
+    Args:
+      folder: the sequence folder (e.g. data/07/map).
+      resolution: the resolution of the grids.
+      dtype, quantization: the format of the store, see FeatureVolumeStore.create().
+  """
+  volume_folder = os.path.join(folder, 'feature_volumes')
+  filenames = sorted(f for f in os.listdir(volume_folder) if f.endswith('.npz'))
+  if len(filenames) == 0:
+    print('No feature volumes to pack in: ', volume_folder)
+    return
+
+  names = [os.path.splitext(f)[0].split('_') for f in filenames]
+  if len(names[0]) == 2:
+    keys = np.round(np.array(names, dtype=float) / resolution).astype(np.int64)
+  else:
+    keys = np.array([name[0] for name in names], dtype=np.int64)
+
+  first_volume = np.load(os.path.join(volume_folder, filenames[0]))['arr_0']
+  store = FeatureVolumeStore.create(folder, keys, first_volume.shape, resolution, dtype, quantization)
+  records = store.lookup(keys)
+  for filename, record in zip(filenames, records):
+    store.write(record, np.load(os.path.join(volume_folder, filename))['arr_0'])
+  store.finalize()
+  print('Packed %d feature volumes into: %s' % (len(filenames), folder))
+
+
+if __name__ == '__main__':
+  # pack existing feature volumes of map and queries
+  config_filename = '../config/localization.yml'
+  if len(sys.argv) > 1:
+    config_filename = sys.argv[1]
+
+  if yaml.__version__ >= '5.1':
+    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
+  else:
+    config = yaml.load(open(config_filename))
+
+  for seq in [config['infer_seqs_map'], config['infer_seqs_query']]:
+    pack_feature_volumes(os.path.join(config['data_root_folder'], seq), config['resolution'],
+                         np.dtype(config.get('volume_dtype', 'float32')), config.get('volume_quantization', 'channel'))
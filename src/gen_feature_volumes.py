@@ -8,6 +8,8 @@ import sys
 import numpy as np
 import yaml
 from fast_infer import FastInfer
+from generation_checkpoint import GenerationCheckpoint
+from map_manifest import MapManifest, manifest_path, load_map_pyramid
 
 
 def gen_feature_volumes_map(config, cache_size=50000):
@@ -24,19 +26,37 @@ def gen_feature_volumes_map(config, cache_size=50000):
   config['infer_seqs']=config['infer_seqs_map']
   infer = FastInfer(config, cache_size=cache_size)
   
-  # collect coords
-  depth_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'], 'depth')
-  grid_paths = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-    os.path.expanduser(depth_folder)) for f in fn]
-  grid_paths.sort()
-  
-  coords = []
-  for grid_path in grid_paths:
-    coords.append(os.path.basename(grid_path).replace('.npy', '').split('_'))
+  # an interrupted generation is resumed from its checkpoint without scanning the depth folder again
+  checkpoint = GenerationCheckpoint.load(os.path.join(config['data_root_folder'], config['infer_seqs_map']))
+  if checkpoint is not None:
+    grid_coords = checkpoint.requested_keys
+    infer.save_feature_volumes()
+  else:
+    # collect coords
+    depth_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'], 'depth')
+    grid_paths = [os.path.join(dp, f) for dp, dn, fn in os.walk(
+      os.path.expanduser(depth_folder)) for f in fn]
+    grid_paths.sort()
+    
+    coords = []
+    for grid_path in grid_paths:
+      coords.append(os.path.basename(grid_path).replace('.npy', '').split('_'))
+    
+    coords = np.array(coords, dtype=float)
+    grid_coords = infer.coords_or_idx2keys(coords)
+    
+    infer.save_feature_volumes(coords)
   
-  coords = np.array(coords, dtype=float)
+  # write the map manifest, which is used instead of walking the feature volume folder
+  manifest = MapManifest(np.unique(grid_coords, axis=0), config['resolution'])
+  manifest.save(manifest_path(features_folder))
+  print('Saved map manifest with %d grids.' % len(manifest.coords))
   
-  infer.save_feature_volumes(coords)
+  # coarse levels of the map pyramid, they reuse the feature volumes of the map
+  if config.get('pyramid_levels'):
+    levels = load_map_pyramid(features_folder, manifest, config['pyramid_levels'])
+    for level in levels:
+      print('Map pyramid level %.2f m: %d grids' % (level.resolution, len(level.coords)))
 
 
 def gen_feature_volumes_query(config, cache_size=50000):
@@ -53,6 +73,11 @@ def gen_feature_volumes_query(config, cache_size=50000):
   config['infer_seqs']=config['infer_seqs_query']
   infer = FastInfer(config, cache_size=cache_size)
   
+  # an interrupted generation is resumed from its checkpoint without scanning the depth folder again
+  if GenerationCheckpoint.load(os.path.join(config['data_root_folder'], config['infer_seqs_query'])) is not None:
+    infer.save_feature_volumes()
+    return
+  
   # collect indizes
   depth_folder = os.path.join(config['data_root_folder'], config['infer_seqs_query'], 'depth')
   idx_paths = [os.path.join(dp, f) for dp, dn, fn in os.walk(
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: the plan and the progress of a generation of feature volumes, thus an interrupted generation resumes.
+
+import os
+import numpy as np
+
+from feature_volume_store import unfinished_store_exists
+
+# file names inside a sequence folder (e.g. 07/map), they exist only while a generation is unfinished
+PLAN_FILENAME = 'generation_plan.npz'
+PROGRESS_FILENAME = 'generation_progress.npy'
+
+
+class GenerationCheckpoint():
+  """ This class keeps the pending work of a generation of feature volumes: the keys of the new store
+    (which is written into the new segment of the pending store, see FeatureVolumeStore.create()),
+    and the names and records of the volumes to be inferred, divided into shards of consecutive records.
+    The plan is written once, the progress (one flag per shard) after every shard is written and flushed,
+    both atomically. Thus after an interruption only the unfinished shards are inferred again.
+  """
+  def __init__(self, folder, requested_keys, all_keys, names, records, shard_size, volume_shape, resolution,
+               dtype, quantization):
+    """ A new plan:
+      folder: the sequence folder (e.g. data/07/map).
+      requested_keys: keys of the volumes requested by the caller, used to check whether a plan matches.
+      all_keys: keys of the new store (existing and requested volumes).
+      names: filenames (without extension) of the volumes to infer, in the order of records.
+      records: records of the volumes to infer in the new store.
+      shard_size: number of volumes per shard.
+      volume_shape, resolution, dtype, quantization: the format of the new store.
+    """
+    self.folder = folder
+    self.requested_keys = np.asarray(requested_keys, dtype=np.int64)
+    self.all_keys = np.asarray(all_keys, dtype=np.int64)
+    self.names = np.asarray(names, dtype=str)
+    self.records = np.asarray(records, dtype=np.int64)
+    self.shard_size = int(shard_size)
+    self.volume_shape = tuple(int(size) for size in volume_shape)
+    self.resolution = float(resolution)
+    self.dtype = np.dtype(dtype)
+    self.quantization = quantization
+    self.done = np.zeros(int(np.ceil(len(self.records) / float(self.shard_size))), dtype=bool)
+
+  @classmethod
+  def load(cls, folder):
+    """ Returns: the checkpoint of an unfinished generation in folder, None if there is none.
+    """
+    plan_file = os.path.join(folder, PLAN_FILENAME)
+    if not os.path.exists(plan_file):
+      return None
+    plan = np.load(plan_file)
+    if not unfinished_store_exists(folder):
+      # the store was finalized, but the checkpoint was not removed
+      remove_checkpoint(folder)
+      return None
+    checkpoint = cls(folder, plan['requested_keys'], plan['all_keys'], plan['names'], plan['records'],
+                     plan['shard_size'], plan['volume_shape'], plan['resolution'], str(plan['dtype']),
+                     str(plan['quantization']))
+    progress_file = os.path.join(folder, PROGRESS_FILENAME)
+    if os.path.exists(progress_file):
+      checkpoint.done = np.load(progress_file)
+    return checkpoint
+
+  def save(self):
+    """ Write the plan and the progress.
+    """
+    tmp_plan = os.path.join(self.folder, PLAN_FILENAME + '.tmp.npz')
+    np.savez(tmp_plan, requested_keys=self.requested_keys, all_keys=self.all_keys, names=self.names,
+             records=self.records, shard_size=self.shard_size, volume_shape=self.volume_shape,
+             resolution=self.resolution, dtype=self.dtype.name, quantization=self.quantization)
+    self.save_progress()
+    os.replace(tmp_plan, os.path.join(self.folder, PLAN_FILENAME))
+
+  def save_progress(self):
+    tmp_progress = os.path.join(self.folder, PROGRESS_FILENAME + '.tmp.npy')
+    np.save(tmp_progress, self.done)
+    os.replace(tmp_progress, os.path.join(self.folder, PROGRESS_FILENAME))
+
+  def matches(self, requested_keys, dtype, quantization):
+    """ Returns: True if the plan was made for the same request, thus it can be resumed.
+    """
+    requested_keys = np.asarray(requested_keys, dtype=np.int64)
+    return (requested_keys.shape == self.requested_keys.shape and
+            np.array_equal(requested_keys, self.requested_keys) and
+            np.dtype(dtype) == self.dtype and (self.dtype != np.int8 or quantization == self.quantization))
+
+  def pending_shards(self):
+    return np.flatnonzero(~self.done)
+
+  def shard(self, shard_idx):
+    """ Returns: the names and records of the volumes of a shard.
+    """
+    start = shard_idx * self.shard_size
+    return self.names[start:start + self.shard_size], self.records[start:start + self.shard_size]
+
+  def mark_done(self, shard_idx):
+    self.done[shard_idx] = True
+    self.save_progress()
+
+  def remove(self):
+    """ Delete the checkpoint, after the store is finalized (or discarded).
+    """
+    remove_checkpoint(self.folder)
+
+
+def remove_checkpoint(folder):
+  for filename in [PLAN_FILENAME, PROGRESS_FILENAME]:
+    if os.path.exists(os.path.join(folder, filename)):
+      os.remove(os.path.join(folder, filename))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: online overlap and yaw estimation with the head of OverlapNet on cached feature volumes.
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from FeatureVolumeCacheSequence import FeatureVolumeCacheSequence
+from overlap_memo import OverlapMemo, weights_hash
+from stage_timer import timer
+
+
+def create_fast_infer(config, cache_size=None):
+  """ Create the inference of the head with the backend given by config['head_backend']:
+    'keras' (default, FastInfer of fast_infer.py) or 'numpy' (NumpyFastInfer of numpy_head.py,
+    which evaluates the exported head without keras).
+    With config['inference_workers'] > 1, the grids are inferred by worker processes (see sharded_infer.py).
+    Args:
+      config: configuration parameters.
+      cache_size: number of cached feature volumes. If None, the number is given by the memory budget.
+  """
+  num_workers = config.get('inference_workers', 0)
+  if num_workers > 1:
+    from sharded_infer import ShardedInfer
+    return ShardedInfer(config, num_workers)
+  backend = config.get('head_backend', 'keras')
+  if backend == 'numpy':
+    from numpy_head import NumpyFastInfer
+    return NumpyFastInfer(config, cache_size)
+  if backend == 'keras':
+    from fast_infer import FastInfer
+    return FastInfer(config, cache_size)
+  raise ValueError('Unknown head backend %s, use keras or numpy.' % backend)
+
+
+class HeadInference():
+  """ The online inference of the head for the current scan and many map grids, independent of the backend.
+    The backend provides self.head with input_shape, predict_on_batch() and get_weights() (like a keras model).
+  """
+  def init_head_inference(self, config, cache_size=None):
+    """ Set up the feature volume cache, the batch assembly and the overlap memo, needs self.head.
+      Args:
+        config: configuration parameters.
+        cache_size: number of cached feature volumes. If None, the number is given by the memory budget
+          of the cache (config['cache_bytes']).
+    """
+    # resolution of the map grids, used as keys of the packed feature volume store
+    self.resolution = config['resolution']
+    self.feature_volume_size = (int(self.head.input_shape[0][1]),
+                                int(self.head.input_shape[0][2]),
+                                int(self.head.input_shape[0][3]))
+    self.volume_cache = FeatureVolumeCacheSequence(config, self.feature_volume_size, cache_size)
+    # assembles the next batch while the current one is in the model
+    self.batch_assembler = ThreadPoolExecutor(max_workers=1)
+    # optional persistent memo of the head outputs, opened on first use (it needs the store versions)
+    self.memo_folder = config.get('overlap_memo_folder', '')
+    self.memo = None
+  
+  def infer_multiple(self, idx_current_frame, coordinates_nearby_grid, query_volume=None):
+    """
+      idx_current_frame: current query scan index.
+      coordinates_nearby_grid: coordinates of grids assigned to particles.
+      query_volume: feature volume of the current scan. If None, it is read from the query store.
+    """
+    self.volume_cache.new_task(idx_current_frame, coordinates_nearby_grid, query_volume)
+    
+    # double buffering: batch k+1 is assembled in the background while batch k is in the model
+    num_batches = len(self.volume_cache)
+    batch_outputs = []
+    next_batch = self.batch_assembler.submit(self.volume_cache.get_buffered_batch, 0)
+    for batch_idx in range(num_batches):
+      with timer.stage('batch_wait'):
+        inputs = next_batch.result()
+      if batch_idx + 1 < num_batches:
+        next_batch = self.batch_assembler.submit(self.volume_cache.get_buffered_batch, batch_idx + 1)
+      with timer.stage('head'):
+        outputs = self.head.predict_on_batch(inputs)
+      # in case of single head, make output a list of size 1
+      if not isinstance(outputs, list):
+        outputs = [outputs]
+      batch_outputs.append(outputs)
+    
+    model_outputs = [np.concatenate([outputs[i] for outputs in batch_outputs])
+                     for i in range(len(batch_outputs[0]))]
+    return model_outputs
+  
+  def lookup_cells(self, grid_coords):
+    """
+      grid_coords: nx2 numpy array of integer grid coordinates.
+      Returns: records of the grids in the map feature volume store (-1 if not in the map).
+    """
+    self.volume_cache.open_stores()
+    return self.volume_cache.map_store.lookup(grid_coords)
+  
+  def lookup_query(self, idx_current_frame):
+    """ Returns: the record of a query scan in the query feature volume store (-1 if it has no volume).
+    """
+    self.volume_cache.open_stores()
+    return int(self.volume_cache.query_store.lookup(np.array([idx_current_frame]))[0])
+  
+  def infer_cells(self, idx_current_frame, map_records, query_volume=None):
+    """ Low-latency inference for a small number of grids (e.g. after convergence).
+      The batches are filled straight from the cache into a preallocated buffer of fixed shape,
+      the query is broadcasted and the head is called directly.
+      Args:
+        idx_current_frame: current query scan index.
+        map_records: records of the grids in the map feature volume store (see lookup_cells()).
+        query_volume: feature volume of the current scan. If None, it is read from the query store.
+      Returns:
+        the same outputs as infer_multiple().
+    """
+    self.volume_cache.new_record_task(idx_current_frame, map_records, query_volume)
+    
+    batch_outputs = []
+    for batch_idx in range(len(self.volume_cache)):
+      with timer.stage('batch_assembly'):
+        inputs, cb_size = self.volume_cache.get_fixed_batch(batch_idx)
+      with timer.stage('head'):
+        outputs = self.head.predict_on_batch(inputs)
+      # in case of single head, make output a list of size 1
+      if not isinstance(outputs, list):
+        outputs = [outputs]
+      batch_outputs.append([output[:cb_size] for output in outputs])
+    
+    if len(batch_outputs) == 1:
+      return batch_outputs[0]
+    return [np.concatenate([outputs[i] for outputs in batch_outputs])
+            for i in range(len(batch_outputs[0]))]
+  
+  def open_memo(self):
+    if self.memo is None and self.memo_folder:
+      self.volume_cache.open_stores()
+      self.memo = OverlapMemo(self.memo_folder, weights_hash([self.head]),
+                              self.volume_cache.map_store.lineage, self.volume_cache.query_store.lineage,
+                              self.volume_cache.cache_dtype)
+    return self.memo
+  
+  def infer_overlaps(self, idx_current_frame, grid_coords, query_volume=None, low_latency_cells=0):
+    """ Overlaps and yaws of the current scan and grids. Pairs which are in the memo
+      (config['overlap_memo_folder']) are not inferred again, new pairs are added to the memo.
+      Scans given as query_volume (computed online) bypass the memo.
+      Args:
+        idx_current_frame: current query scan index.
+        grid_coords: nx2 numpy array of integer grid coordinates.
+        query_volume: feature volume of the current scan. If None, it is read from the query store.
+        low_latency_cells: up to this number of grids to infer, infer_cells() is used.
+      Returns:
+        the overlaps and the yaws (argmax of the yaw output of the head) as numpy arrays of size n.
+    """
+    map_records = self.lookup_cells(grid_coords)
+    memo = self.open_memo() if query_volume is None else None
+    # scans without a feature volume are not memorized
+    query_record = self.lookup_query(idx_current_frame) if memo is not None else -1
+    if query_record >= 0:
+      overlaps, yaws, is_known = memo.lookup(query_record, map_records)
+    else:
+      overlaps = np.zeros(len(map_records), dtype=np.float32)
+      yaws = np.zeros(len(map_records), dtype=np.int64)
+      is_known = np.zeros(len(map_records), dtype=bool)
+    
+    new_pairs = np.flatnonzero(~is_known)
+    timer.count('cells_inferred', len(new_pairs))
+    if len(new_pairs) == 0:
+      return overlaps, yaws
+    
+    overlaps[new_pairs], yaws[new_pairs] = self.infer_pairs(idx_current_frame, grid_coords[new_pairs],
+                                                            map_records[new_pairs], query_volume, low_latency_cells)
+    
+    if query_record >= 0:
+      # grids without a feature volume are not memorized
+      new_pairs = new_pairs[map_records[new_pairs] >= 0]
+      memo.add(query_record, map_records[new_pairs], overlaps[new_pairs], yaws[new_pairs])
+    return overlaps, yaws
+  
+  def infer_pairs(self, idx_current_frame, grid_coords, map_records, query_volume=None, low_latency_cells=0):
+    """ Infer the current scan and grids (without the memo).
+      Args:
+        idx_current_frame: current query scan index.
+        grid_coords: nx2 numpy array of integer grid coordinates.
+        map_records: records of the grids in the map feature volume store.
+        query_volume: feature volume of the current scan. If None, it is read from the query store.
+        low_latency_cells: up to this number of grids to infer, infer_cells() is used.
+      Returns:
+        the overlaps and the yaws (argmax of the yaw output of the head) as numpy arrays of size n.
+    """
+    if len(map_records) <= low_latency_cells:
+      outputs = self.infer_cells(idx_current_frame, map_records, query_volume)
+    else:
+      outputs = self.infer_multiple(idx_current_frame, grid_coords * self.resolution, query_volume)
+    overlaps = np.reshape(outputs[0], -1)
+    yaws = np.argmax(outputs[1], axis=1) if len(outputs) > 1 else np.zeros(len(map_records), dtype=np.int64)
+    return overlaps, yaws
+  
+  def cache_statistics(self):
+    """ Returns: dict with the hits, misses and hit rate (percent) of the feature volume cache.
+    """
+    policy = self.volume_cache.policy
+    return {'hits': policy.hits, 'misses': policy.misses, 'hit_rate': policy.hit_rate()}
+  
+  def print_statistics(self):
+    self.volume_cache.print_statistics()
+    if self.memo is not None:
+      self.memo.print_statistics()
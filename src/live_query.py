@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: an in-memory pipeline which computes the query feature volume of a raw LiDAR scan online.
+
+import time
+import numpy as np
+
+# the module is imported lazily (e.g. by the localization service), thus a missing library
+# raises an ImportError instead of exiting the process
+try:
+  from c_gen_depth_and_normal import gen_depth_and_normal
+  from c_gen_virtual_scan import gen_virtual_scan
+except ImportError as error:
+  raise ImportError("The live query pipeline needs the c libraries of prepare_training, "
+                    "use them by $export PYTHONPATH=$PYTHONPATH:<path-to-library> (%s)" % error)
+
+
+class LiveQueryPipeline():
+  """ This class computes the feature volume of a raw point cloud without any disk round trip:
+    virtual scan -> depth and normal data -> leg of OverlapNet.
+    The resulting feature volume can be given directly to SensorModel.update_weights().
+  """
+  STAGES = ['virtual_scan', 'depth_and_normal', 'leg', 'total']
+
+  def __init__(self, fast_infer, range_image_params):
+    """ Initialization:
+      fast_infer: the FastInfer instance whose leg is used.
+      range_image_params: parameters for generating a range image.
+    """
+    if not hasattr(fast_infer, 'leg'):
+      raise ValueError('The live query pipeline needs the leg of OverlapNet, use the keras head backend without inference workers.')
+    if fast_infer.use_class_probabilities or fast_infer.use_class_probabilities_pca or fast_infer.use_intensity:
+      raise ValueError('The live query pipeline only supports depth and normal inputs.')
+
+    self.fast_infer = fast_infer
+    self.range_image_params = range_image_params
+
+    # preallocated input of the leg (1 x height x width x chans)
+    self.leg_input = np.zeros((1, fast_infer.inputShape[0], fast_infer.inputShape[1],
+                               fast_infer.no_input_channels), dtype=np.float32)
+
+    # latencies of all processed scans in milliseconds
+    self.latencies = {stage: [] for stage in self.STAGES}
+
+  def process(self, points):
+    """ Compute the feature volume of a scan.
+      Args:
+        points: raw point cloud as nx3 or nx4 numpy array (the 4th column, e.g. intensity, is ignored).
+      Returns:
+        the feature volume and a dict with the latency of each stage in milliseconds.
+    """
+    params = self.range_image_params
+    t_start = time.perf_counter()
+
+    # homogeneous points (x, y, z, 1), like utils.load_vertex()
+    current_vertex = np.ones((len(points), 4), dtype=np.float32)
+    current_vertex[:, :3] = points[:, :3]
+    query_scan = gen_virtual_scan(current_vertex,
+                                  params['height'], params['width'],
+                                  params['fov_up'], params['fov_down'],
+                                  params['max_range'], params['min_range'])
+    t_virtual_scan = time.perf_counter()
+
+    depth_and_normal = gen_depth_and_normal(query_scan.astype(np.float32),
+                                            params['height'], params['width'],
+                                            params['fov_up'], params['fov_down'],
+                                            params['max_range'], params['min_range'])
+    # same channel layout as the OverlapNet generator: depth first, then the normals
+    channel = 0
+    if self.fast_infer.use_depth:
+      self.leg_input[0, :, :, channel] = depth_and_normal[:, :, 3] / np.max(depth_and_normal[:, :, 3])
+      channel += 1
+    if self.fast_infer.use_normals:
+      self.leg_input[0, :, :, channel:channel + 3] = depth_and_normal[:, :, :3]
+    t_depth_and_normal = time.perf_counter()
+
+    feature_volume = self.fast_infer.leg.predict_on_batch(self.leg_input)[0]
+    t_leg = time.perf_counter()
+
+    latency = {'virtual_scan': 1000. * (t_virtual_scan - t_start),
+               'depth_and_normal': 1000. * (t_depth_and_normal - t_virtual_scan),
+               'leg': 1000. * (t_leg - t_depth_and_normal),
+               'total': 1000. * (t_leg - t_start)}
+    for stage in self.STAGES:
+      self.latencies[stage].append(latency[stage])
+
+    return feature_volume, latency
+
+  def print_statistics(self):
+    if len(self.latencies['total']) == 0:
+      return
+    for stage in self.STAGES:
+      print('Live query %-16s mean: %7.1f ms  max: %7.1f ms' %
+            (stage, np.mean(self.latencies[stage]), np.max(self.latencies[stage])))
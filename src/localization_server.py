@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a long-lived localization service which keeps the network, the map and the cache resident.
+#
+# Protocol: every message (request and response) is a frame of
+#   8 bytes header: length of the json part and length of the array part (big endian uint32)
+#   json part: a dict with the field 'type'
+#   array part (optional): one numpy array in .npy format, e.g. a scan or a query feature volume
+#
+# Requests:
+#   {'type': 'init', 'session': name, 'num_particles': n}
+#     starts (or restarts) a session with particles spread over the map, or around
+#     'pose': [x, y, yaw] (meters, radian) with 'sigma': [sigma_xy, sigma_yaw] if given.
+#   {'type': 'update', 'session': name, 'odometry': [rot1, trasl, rot2]}
+#     odometry increment since the last update (translation in meters). The observation is either
+#     the array part (a nx3/nx4 scan or a feature volume) or the precomputed query feature volume 'frame'.
+#     Returns the pose estimate [x, y, yaw] with its 3x3 covariance and the latency.
+#   {'type': 'metrics'}: frames/s, latency percentiles and cache hit rate.
+#   {'type': 'close', 'session': name}
+
+import io
+import os
+import sys
+import json
+import time
+import yaml
+import socket
+import struct
+import threading
+import socketserver
+from collections import deque
+import numpy as np
+
+from initialization import init_particles_given_coords
+from map_manifest import load_map_manifest
+from motion_model import motion_model
+from particle_set import ParticleSet
+from resample import resample, limit, kld_params
+
+HEADER = struct.Struct('>II')
+
+
+def recv_exactly(sock, num_bytes):
+  data = bytearray()
+  while len(data) < num_bytes:
+    chunk = sock.recv(min(num_bytes - len(data), 1 << 20))
+    if not chunk:
+      raise ConnectionError('connection closed')
+    data += chunk
+  return bytes(data)
+
+
+def send_message(sock, message, array=None):
+  """ Send a message (dict) and optionally one numpy array.
+  """
+  payload = b''
+  if array is not None:
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    payload = buffer.getvalue()
+  text = json.dumps(message).encode()
+  sock.sendall(HEADER.pack(len(text), len(payload)) + text + payload)
+
+
+def recv_frame(sock):
+  """ Receive the json part and the array part of a message, without decoding them.
+  """
+  text_len, payload_len = HEADER.unpack(recv_exactly(sock, HEADER.size))
+  return recv_exactly(sock, text_len), recv_exactly(sock, payload_len)
+
+
+def decode_message(text, payload):
+  """ Returns: the message (dict) and the numpy array (or None).
+    Raises ValueError if a part can not be decoded.
+  """
+  try:
+    message = json.loads(text.decode())
+    array = np.load(io.BytesIO(payload), allow_pickle=False) if len(payload) > 0 else None
+  except Exception as error:
+    raise ValueError('malformed message, %s: %s' % (type(error).__name__, error))
+  if not isinstance(message, dict):
+    raise ValueError('malformed message, the json part is not a dict')
+  return message, array
+
+
+def recv_message(sock):
+  """ Receive a message.
+    Returns: the message (dict) and the numpy array (or None).
+  """
+  return decode_message(*recv_frame(sock))
+
+
+def parse_address(address):
+  """ 'unix:/path/to/socket' or 'host:port'.
+    Returns: the socket family and address.
+  """
+  if address.startswith('unix:'):
+    return socket.AF_UNIX, address[len('unix:'):]
+  host, port = address.rsplit(':', 1)
+  return socket.AF_INET, (host, int(port))
+
+
+class LocalizationSession():
+  """ The state of the particle filter of one client.
+  """
+  def __init__(self, sensor_model, particles):
+    self.sensor_model = sensor_model
+    self.particles = particles
+    self.is_initial = True
+    self.num_updates = 0
+
+
+class LocalizationService():
+  """ This class holds the resident parts (network, map, feature volume cache, overlap memo)
+    and the particle filters of all sessions. The requests are processed one at a time,
+    since the network and the cache are shared.
+  """
+  def __init__(self, config):
+    """ Initialization:
+      config: configuration parameters of the localization (localization.yml).
+    """
+    from head_inference import create_fast_infer
+
+    self.config = config
+    self.grid_res = config['resolution']
+    self.map_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'], 'feature_volumes')
+    self.manifest = load_map_manifest(self.map_folder, self.grid_res)
+    self.mapsize = self.manifest.bounds
+    self.grid_coords = self.manifest.coords.astype(float)
+    self.model = create_fast_infer(config)
+    # created on the first scan, needs the c libraries of prepare_training
+    self.query_pipeline = None
+
+    self.kld_params = None
+    if config.get('kld_sampling', False):
+      self.kld_params = kld_params(config, self.grid_res, config['numParticles'])
+
+    self.sessions = {}
+    self.seeds = np.random.SeedSequence(config.get('seed', 0))
+    self.lock = threading.Lock()
+
+    # metrics of the update requests
+    self.start_time = time.time()
+    self.num_frames = 0
+    self.latencies = deque(maxlen=config.get('service_metrics_window', 1000))
+    self.frame_times = deque(maxlen=config.get('service_metrics_window', 1000))
+
+  def handle(self, message, array):
+    """ Process one request.
+      Returns: the response (dict) and an optional numpy array.
+    """
+    handlers = {'init': self.init_session, 'update': self.update_session,
+                'metrics': self.metrics, 'close': self.close_session}
+    if message.get('type') not in handlers:
+      return {'type': 'error', 'error': 'unknown request type %s' % message.get('type')}, None
+    with self.lock:
+      try:
+        return handlers[message['type']](message, array), None
+      except Exception as error:
+        return {'type': 'error', 'error': '%s: %s' % (type(error).__name__, error)}, None
+
+  def init_session(self, message, array):
+    from sensor_model_overlap import SensorModel
+
+    session_name = message.get('session', 'default')
+    if session_name in self.sessions:
+      self.sessions[session_name].sensor_model.shutdown()
+
+    num_particles = int(message.get('num_particles', self.config['numParticles']))
+    capacity = max(num_particles, self.kld_params['max_particles']) if self.kld_params else num_particles
+    rng = np.random.default_rng(self.seeds.spawn(1)[0])
+    particles = ParticleSet(capacity, rng)
+
+    if 'pose' in message:
+      # gaussian around a given pose
+      x, y, yaw = message['pose']
+      sigma_xy, sigma_yaw = message.get('sigma', [1.0, 0.1])
+      init = np.empty((num_particles, 4))
+      init[:, 0] = x / self.grid_res + sigma_xy / self.grid_res * rng.standard_normal(num_particles)
+      init[:, 1] = y / self.grid_res + sigma_xy / self.grid_res * rng.standard_normal(num_particles)
+      init[:, 2] = yaw + sigma_yaw * rng.standard_normal(num_particles)
+      init[:, 3] = 1.0
+      particles.assign(init)
+    else:
+      particles.assign(init_particles_given_coords(num_particles, self.grid_coords, rng=rng))
+
+    # the sensor model of a session shares the network and the map
+    sensor_model = SensorModel(dict(self.config), self.mapsize, self.map_folder,
+                               model=self.model, manifest=self.manifest)
+    self.sessions[session_name] = LocalizationSession(sensor_model, particles)
+    return {'type': 'init', 'session': session_name, 'num_particles': num_particles}
+
+  def update_session(self, message, array):
+    t_start = time.perf_counter()
+    session_name = message.get('session', 'default')
+    if session_name not in self.sessions:
+      raise KeyError('session %s is not initialized' % session_name)
+    session = self.sessions[session_name]
+    particles = session.particles
+
+    # odometry in grid units, like the commands of main_overlap_mcl.py
+    rot1, trasl, rot2 = message.get('odometry', [0., 0., 0.])
+    command = np.array([rot1, trasl / self.grid_res, rot2])
+    motion_model(particles, command)
+    session.sensor_model.prefetch(particles, command)
+
+    # only update the weight when the car moves
+    is_updated = False
+    if command[1] > 0.2 / self.grid_res or session.is_initial:
+      session.is_initial = False
+      is_updated = True
+      query_volume = self.query_volume(array)
+      frame_idx = message.get('frame', -1)
+      if query_volume is None and frame_idx < 0:
+        raise ValueError('an update needs a scan, a query feature volume or a frame index')
+      session.sensor_model.update_weights(particles, frame_idx, query_volume)
+      num_particles = limit(particles, **self.kld_params) if self.kld_params else None
+      resample(particles, num_particles=num_particles, scheme=self.config.get('resample_scheme', 'systematic'))
+    session.num_updates += 1
+
+    pose, covariance = self.estimate(particles)
+    latency = time.perf_counter() - t_start
+    self.num_frames += 1
+    self.latencies.append(latency)
+    self.frame_times.append(time.time())
+    return {'type': 'update', 'session': session_name, 'pose': pose.tolist(), 'covariance': covariance.tolist(),
+            'num_particles': len(particles), 'weights_updated': is_updated,
+            'skipped_cells': session.sensor_model.num_skipped_cells, 'latency_ms': 1000. * latency}
+
+  def query_volume(self, array):
+    """ The query feature volume of an update: the given volume, or the volume of the given scan.
+      Raises ImportError if a scan is given, but the c libraries of the live query pipeline are missing
+      (answered as error by handle()).
+    """
+    if array is None:
+      return None
+    if array.ndim == 2 and array.shape[1] in [3, 4]:
+      if self.query_pipeline is None:
+        from live_query import LiveQueryPipeline
+        self.query_pipeline = LiveQueryPipeline(self.model, self.config['range_image'])
+      query_volume, _ = self.query_pipeline.process(array)
+      return query_volume
+    return array
+
+  def estimate(self, particles):
+    """ Weighted mean and covariance of the particles.
+      Returns: the pose [x, y, yaw] (meters, radian) and its 3x3 covariance.
+    """
+    weights = particles.weight.astype(np.float64)
+    weights = weights / np.sum(weights)
+    poses = particles.data[:3].astype(np.float64)
+    poses[:2] *= self.grid_res
+    # circular mean of the yaw
+    yaw = np.arctan2(np.dot(weights, np.sin(poses[2])), np.dot(weights, np.cos(poses[2])))
+    mean = np.array([np.dot(weights, poses[0]), np.dot(weights, poses[1]), yaw])
+    diffs = poses - mean[:, None]
+    diffs[2] = np.arctan2(np.sin(diffs[2]), np.cos(diffs[2]))
+    covariance = (diffs * weights).dot(diffs.T)
+    return mean, covariance
+
+  def metrics(self, message, array):
+    latencies = 1000. * np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+    frames_per_second = 0.
+    if len(self.frame_times) > 1 and self.frame_times[-1] > self.frame_times[0]:
+      frames_per_second = (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+    cache = self.model.cache_statistics()
+    response = {'type': 'metrics',
+                'uptime_s': time.time() - self.start_time,
+                'sessions': len(self.sessions),
+                'frames': self.num_frames,
+                'frames_per_second': frames_per_second,
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p99': float(np.percentile(latencies, 99)),
+                'cache_hit_rate': cache['hit_rate'],
+                'cache_hits': cache['hits'],
+                'cache_misses': cache['misses']}
+    if self.model.memo is not None:
+      response['memo_hit_rate'] = self.model.memo.hit_rate()
+    return response
+
+  def close_session(self, message, array):
+    session_name = message.get('session', 'default')
+    if session_name in self.sessions:
+      self.sessions.pop(session_name).sensor_model.shutdown()
+    return {'type': 'close', 'session': session_name}
+
+
+class LocalizationRequestHandler(socketserver.BaseRequestHandler):
+  """ Handles the requests of one connection until the client closes it.
+  """
+  def handle(self):
+    while True:
+      try:
+        text, payload = recv_frame(self.request)
+      except ConnectionError:
+        return
+      # the whole frame is received, thus a malformed message is answered and the connection is kept
+      try:
+        message, array = decode_message(text, payload)
+      except ValueError as error:
+        send_message(self.request, {'type': 'error', 'error': str(error)})
+        continue
+      response, response_array = self.server.service.handle(message, array)
+      send_message(self.request, response, response_array)
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def create_server(service, address):
+  """ Create a server for the service listening on 'unix:/path' or 'host:port'.
+  """
+  family, socket_address = parse_address(address)
+  if family == socket.AF_UNIX:
+    if os.path.exists(socket_address):
+      os.remove(socket_address)
+    server = ThreadingUnixServer(socket_address, LocalizationRequestHandler)
+  else:
+    server = ThreadingTCPServer(socket_address, LocalizationRequestHandler)
+  server.service = service
+  return server
+
+
+class LocalizationClient():
+  """ A client of the localization service.
+  """
+  def __init__(self, address):
+    family, socket_address = parse_address(address)
+    self.sock = socket.socket(family, socket.SOCK_STREAM)
+    self.sock.connect(socket_address)
+
+  def request(self, message, array=None):
+    send_message(self.sock, message, array)
+    response, _ = recv_message(self.sock)
+    if response.get('type') == 'error':
+      raise RuntimeError(response['error'])
+    return response
+
+  def init(self, session='default', num_particles=None, pose=None, sigma=None):
+    message = {'type': 'init', 'session': session}
+    if num_particles is not None:
+      message['num_particles'] = num_particles
+    if pose is not None:
+      message['pose'] = list(pose)
+    if sigma is not None:
+      message['sigma'] = list(sigma)
+    return self.request(message)
+
+  def update(self, odometry, session='default', scan=None, query_volume=None, frame=None):
+    message = {'type': 'update', 'session': session, 'odometry': [float(v) for v in odometry]}
+    if frame is not None:
+      message['frame'] = int(frame)
+    return self.request(message, scan if scan is not None else query_volume)
+
+  def metrics(self):
+    return self.request({'type': 'metrics'})
+
+  def close(self, session='default'):
+    response = self.request({'type': 'close', 'session': session})
+    self.sock.close()
+    return response
+
+
+if __name__ == '__main__':
+  # load config file
+  config_filename = '../config/localization.yml'
+  if len(sys.argv) > 1:
+    config_filename = sys.argv[1]
+
+  if yaml.__version__ >= '5.1':
+    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
+  else:
+    config = yaml.load(open(config_filename))
+
+  service = LocalizationService(config)
+  address = config.get('service_address', 'localhost:8090')
+  server = create_server(service, address)
+  print('Localization service listening on', address)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
@@ -5,6 +5,7 @@
 
 import os
 import sys
+import time
 import yaml
 import numpy as np
 import matplotlib.pyplot as plt
@@ -14,97 +15,184 @@ import utils
 from initialization import check_mapsize, init_particles_given_coords
 from motion_model import motion_model, gen_commands
 from sensor_model_overlap import SensorModel
-from resample import resample
+from resample import resample, limit, kld_params
+from particle_set import ParticleSet
+from stage_timer import timer
 
 from visualizer import Visualizer
 from vis_loc_result import plot_traj_result
-  
-if __name__ == '__main__':
-  # load config file
-  config_filename = '../config/localization.yml'
-  if len(sys.argv) > 1:
-    config_filename = sys.argv[1]
 
-  if yaml.__version__>='5.1':  
-    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
-  else:
-    config = yaml.load(open(config_filename))  
-  
+
+def estimate_pose(particles, ratio=0.8):
+  """ Estimate the pose as weighted mean of the best particles (ParticleSet).
+    Returns: [x, y, theta] in grid units, NaN if all weights are zero.
+  """
+  idxes = np.argsort(particles.weight)[::-1]
+  idxes = idxes[:max(1, int(ratio * len(idxes)))]
+  weights = particles.weight[idxes].astype(np.float64)
+  if np.sum(weights) == 0:
+    return np.full(3, np.nan)
+  return particles.data[:3, idxes].dot(weights / np.sum(weights))
+
+
+def run_localization(config, sensor_model, mapsize, grid_coords, poses, rng=None, query_pipeline=None):
+  """ Run the overlap-based MCL over a sequence.
+    Args:
+      config: configuration parameters.
+      sensor_model: the sensor model (SensorModel).
+      mapsize: the size of the map.
+      grid_coords: the coordinates of the grids of the map.
+      poses: ground truth poses in the LiDAR coordinate system.
+      rng: numpy Generator for all sampling steps. If None, it is seeded with config['seed'] (default 0).
+      query_pipeline: if given, the query feature volumes are computed online from the scans (see live_query.py).
+    Returns:
+      the pose estimates of every frame (in grid units), the computation time of every frame in seconds,
+      and the particles of every frame if config['save_result'] is set (else None).
+  """
   # setup parameters
   start_idx = config['start_index']
   grid_res = config['resolution']
   numParticles = config['numParticles']
   save_result = config['save_result']
   visualize = config['visualize']
-  data_root_folder = config['data_root_folder']
-  seq_idx_map = config['infer_seqs_map']
-  seq_idx_query = config['infer_seqs_query']
-  move_thres = config['move_thres']
-  
-  # load map
-  map_folder = os.path.join(data_root_folder, seq_idx_map, 'feature_volumes')
-  mapsize, grid_coords = check_mapsize(map_folder, grid_res)
-  
-  # load poses
-  pose_file = config['pose_file']
-  poses = utils.load_poses(pose_file)
-  inv_frame0 = np.linalg.inv(poses[0])
-  
-  # load calibrations
-  calib_file = config['calib_file']
-  T_cam_velo = utils.load_calib(calib_file)
-  T_cam_velo = np.asarray(T_cam_velo).reshape((4, 4))
-  T_velo_cam = np.linalg.inv(T_cam_velo)
-  
-  # convert poses in LiDAR coordinate system
-  new_poses = []
-  for pose in poses:
-    new_poses.append(T_velo_cam.dot(inv_frame0).dot(pose).dot(T_cam_velo))
-  new_poses = np.array(new_poses)
-  poses = new_poses
+  # KLD-sampling: the number of particles adapts to the uncertainty
+  kld_sampling = config.get('kld_sampling', False)
+  if kld_sampling:
+    limit_params = kld_params(config, grid_res, numParticles)
 
-  # initialize sensor model
-  sensor_model = SensorModel(config, mapsize, map_folder)
+  resample_scheme = config.get('resample_scheme', 'systematic')
+  if rng is None:
+    rng = np.random.default_rng(config.get('seed', 0))
+
+  # per-stage timing of every frame, written to config['trace_file'] (see stage_timer.py)
+  trace_file = config.get('trace_file', '')
+  if trace_file:
+    timer.reset()
+    timer.enable()
+
+  if query_pipeline is not None:
+    scan_paths = utils.load_files(config['scan_folder'])
 
   # generate motion commands
-  commands = gen_commands(poses, grid_res)
+  commands = gen_commands(poses, grid_res, rng=rng)
 
-  # initialize particles
-  particles = init_particles_given_coords(numParticles, grid_coords)
+  # initialize particles, the particle set is allocated once for the maximal number of particles
+  max_particles = max(numParticles, limit_params['max_particles']) if kld_sampling else numParticles
+  particles = ParticleSet(max_particles, rng)
+  particles.assign(init_particles_given_coords(numParticles, grid_coords, rng=rng))
   is_initial = True
-  
+
   if visualize:
     plt.ion()
     visualizer = Visualizer(mapsize, poses, poses, strat_idx=start_idx)
-    
+
+  loc_results = None
   if save_result:
-    loc_results = np.empty((len(poses), numParticles, 4))
-  
+    loc_results = np.zeros((len(poses), max_particles, 4))
+  estimates = np.full((len(poses), 3), np.nan)
+  frame_times = np.zeros(len(poses))
+
   for frame_idx in range(start_idx, len(poses)):
+    timer.begin_frame(frame_idx)
     if visualize:
-      visualizer.update(frame_idx, particles)
-      visualizer.fig.canvas.draw()
-      visualizer.fig.canvas.flush_events()
-    
+      with timer.stage('visualization'):
+        visualizer.update(frame_idx, particles.to_array())
+        visualizer.fig.canvas.draw()
+        visualizer.fig.canvas.flush_events()
+
+    t_frame = time.perf_counter()
     # motion model
-    particles = motion_model(particles, commands[frame_idx])
+    with timer.stage('motion_model'):
+      particles = motion_model(particles, commands[frame_idx])
+
+    # load feature volumes for the next frames in the background
+    with timer.stage('prefetch'):
+      sensor_model.prefetch(particles, commands[frame_idx])
 
     # only update the weight when the car moves
     if commands[frame_idx, 1] > 0.2 / grid_res or is_initial:
       is_initial = False
-      
+
       # grid-based method
-      particles = sensor_model.update_weights(particles, frame_idx)
-      
-      # resampling
-      particles = resample(particles)
-    
+      if query_pipeline is not None:
+        with timer.stage('live_query'):
+          query_volume, latency = query_pipeline.process(utils.load_vertex(scan_paths[frame_idx]))
+        print('live query latency: %.1f ms (virtual scan %.1f ms, depth and normal %.1f ms, leg %.1f ms)' %
+              (latency['total'], latency['virtual_scan'], latency['depth_and_normal'], latency['leg']))
+        with timer.stage('update_weights'):
+          particles = sensor_model.update_weights(particles, frame_idx, query_volume)
+      else:
+        with timer.stage('update_weights'):
+          particles = sensor_model.update_weights(particles, frame_idx)
+      if sensor_model.num_skipped_cells > 0:
+        print('skipped %d grids (latency budget)' % sensor_model.num_skipped_cells)
+
+      # resampling, with KLD-sampling the size of the new particle set is given by the current spread
+      with timer.stage('resample'):
+        num_particles = limit(particles, **limit_params) if kld_sampling else None
+        particles = resample(particles, num_particles=num_particles, scheme=resample_scheme)
+    frame_times[frame_idx] = time.perf_counter() - t_frame
+    timer.end_frame(particles=len(particles))
+
+    estimates[frame_idx] = estimate_pose(particles)
     if save_result:
-      loc_results[frame_idx, :len(particles)] = particles
-    
+      loc_results[frame_idx, :len(particles)] = particles.data.T
+
     print('finished frame:', frame_idx)
 
+  if trace_file:
+    timer.enable(False)
+    timer.save(trace_file)
+    timer.print_summary()
+    print('Saved the timing trace to %s_*' % trace_file)
+
+  return estimates, frame_times, loc_results
+
+
+if __name__ == '__main__':
+  # load config file
+  config_filename = '../config/localization.yml'
+  if len(sys.argv) > 1:
+    config_filename = sys.argv[1]
+
+  if yaml.__version__>='5.1':
+    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
+  else:
+    config = yaml.load(open(config_filename))
+
+  # setup parameters
+  start_idx = config['start_index']
+  grid_res = config['resolution']
+  numParticles = config['numParticles']
+  save_result = config['save_result']
+  data_root_folder = config['data_root_folder']
+  seq_idx_map = config['infer_seqs_map']
+  live_query = config.get('live_query', False)
+
+  # load map
+  map_folder = os.path.join(data_root_folder, seq_idx_map, 'feature_volumes')
+  mapsize, grid_coords = check_mapsize(map_folder, grid_res)
+
+  # load poses
+  poses = utils.load_lidar_poses(config['pose_file'], config['calib_file'])
+
+  # initialize sensor model
+  sensor_model = SensorModel(config, mapsize, map_folder)
+
+  # compute the query feature volumes online from the raw scans
+  query_pipeline = None
+  if live_query:
+    from live_query import LiveQueryPipeline
+    query_pipeline = LiveQueryPipeline(sensor_model.model, config['range_image'])
+
+  estimates, frame_times, loc_results = run_localization(config, sensor_model, mapsize, grid_coords, poses,
+                                                         query_pipeline=query_pipeline)
+
+  sensor_model.model.print_statistics()
+  if live_query:
+    query_pipeline.print_statistics()
+
   if save_result:
     print('Saving localization results...')
     np.savez_compressed('localization_results_'+str(start_idx), loc_results)
-    plot_traj_result(loc_results, poses, numParticles=numParticles, start_idx=start_idx)
\ No newline at end of file
+    plot_traj_result(loc_results, poses, numParticles=numParticles, start_idx=start_idx)
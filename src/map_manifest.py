@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a binary manifest of the feature volume map, which replaces walking the map folder.
+
+import os
+import numpy as np
+
+from feature_volume_store import FeatureVolumeStore, store_exists
+
+# the manifest is stored next to the feature_volumes folder of a map
+MANIFEST_FILENAME = 'map_manifest.npz'
+# the coarse levels of the map pyramid are stored next to the manifest
+PYRAMID_FILENAME = 'map_pyramid.npz'
+
+
+class MapManifest():
+  """ This class holds the index of a feature volume map: the integer grid coordinates of all grids,
+    the bounds and resolution of the map and a dense occupancy bitmap.
+    The occupancy bitmap uses the same layout as the grid lookup tables of the MCL:
+    row = max_y - y, column = x - min_x.
+    A coarse level of the map pyramid is a manifest as well, each of its grids is represented
+    by the feature volume of one grid of the map.
+  """
+  def __init__(self, coords, resolution, representatives=None):
+    """ Initialization:
+      coords: nx2 numpy array of integer grid coordinates (real coordinates divided by the resolution).
+      resolution: the resolution of the grids.
+      representatives: for a coarse level, nx2 numpy array with the integer coordinates of the map grid
+        whose feature volume represents each grid. None for the map itself.
+    """
+    self.coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    self.resolution = float(resolution)
+    self.representatives = representatives
+    self.index_lut = None
+
+    # bounds of the map [min_x, max_x, min_y, max_y] in grid coordinates
+    self.bounds = [int(np.min(self.coords[:, 0])), int(np.max(self.coords[:, 0])),
+                   int(np.min(self.coords[:, 1])), int(np.max(self.coords[:, 1]))]
+
+    # dense occupancy bitmap
+    self.occupancy = np.zeros((self.bounds[3] - self.bounds[2] + 1,
+                               self.bounds[1] - self.bounds[0] + 1), dtype=bool)
+    self.occupancy[self.bounds[3] - self.coords[:, 1], self.coords[:, 0] - self.bounds[0]] = True
+
+  @classmethod
+  def from_real_coords(cls, real_coords, resolution):
+    """ Create a manifest from real coordinates (in meters) of the grids.
+    """
+    grid_coords = np.round(np.asarray(real_coords, dtype=float) / resolution).astype(np.int64)
+    return cls(np.unique(grid_coords, axis=0), resolution)
+
+  @classmethod
+  def load(cls, manifest_file):
+    """ Load a manifest written by save().
+    """
+    data = np.load(manifest_file)
+    manifest = cls.__new__(cls)
+    manifest.coords = data['coords'].astype(np.int64)
+    manifest.resolution = float(data['resolution'])
+    manifest.bounds = [int(b) for b in data['bounds']]
+    shape = tuple(data['occupancy_shape'])
+    manifest.occupancy = np.unpackbits(data['occupancy'], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+    manifest.representatives = None
+    manifest.index_lut = None
+    return manifest
+
+  def save(self, manifest_file):
+    """ Save the manifest as a binary file. The occupancy bitmap is stored bit packed.
+    """
+    tmp_file = manifest_file + '.tmp.npz'
+    np.savez(tmp_file,
+             coords=self.coords.astype(np.int32),
+             resolution=self.resolution,
+             bounds=np.array(self.bounds, dtype=np.int64),
+             occupancy_shape=np.array(self.occupancy.shape, dtype=np.int64),
+             occupancy=np.packbits(self.occupancy.reshape(-1)))
+    os.replace(tmp_file, manifest_file)
+
+  def real_coords(self):
+    """ Real coordinates (in meters) of all grids.
+    """
+    return self.coords * self.resolution
+
+  def lut_index(self, grid_xs, grid_ys):
+    """ Convert integer grid coordinates into indexes of the occupancy bitmap.
+      Args:
+        grid_xs, grid_ys: integer grid coordinates (numpy arrays).
+      Returns:
+        row and column indexes and a mask of the coordinates inside the bitmap.
+    """
+    lut_rows = self.bounds[3] - grid_ys
+    lut_cols = grid_xs - self.bounds[0]
+    in_lut = (lut_rows >= 0) & (lut_rows < self.occupancy.shape[0]) & \
+             (lut_cols >= 0) & (lut_cols < self.occupancy.shape[1])
+    return lut_rows, lut_cols, in_lut
+
+  def contains(self, grid_xs, grid_ys):
+    """ Check for integer grid coordinates whether there is a feature volume.
+      Returns:
+        a boolean numpy array.
+    """
+    lut_rows, lut_cols, in_lut = self.lut_index(grid_xs, grid_ys)
+    has_volume = np.zeros(len(lut_rows), dtype=bool)
+    has_volume[in_lut] = self.occupancy[lut_rows[in_lut], lut_cols[in_lut]]
+    return has_volume
+
+  def grid_keys(self, grid_xs, grid_ys):
+    """ Unique integer keys (flat index into the occupancy bitmap) of grid coordinates inside the map.
+    """
+    return (self.bounds[3] - grid_ys) * self.occupancy.shape[1] + (grid_xs - self.bounds[0])
+
+  def keys2coords(self, grid_keys):
+    """ Inverse of grid_keys().
+      Returns:
+        nx2 numpy array of integer grid coordinates.
+    """
+    width = self.occupancy.shape[1]
+    return np.c_[grid_keys % width + self.bounds[0], self.bounds[3] - grid_keys // width]
+
+  def representative_coords(self, grid_keys):
+    """ The grids of the map whose feature volumes are inferred for the given grids of this level.
+      Args:
+        grid_keys: keys (see grid_keys()) of grids with a feature volume.
+      Returns:
+        nx2 numpy array of integer grid coordinates of the map.
+    """
+    if self.representatives is None:
+      return self.keys2coords(grid_keys)
+    if self.index_lut is None:
+      # the keys are flat indexes into the occupancy bitmap
+      self.index_lut = np.full(self.occupancy.size, -1, dtype=np.int64)
+      self.index_lut[self.grid_keys(self.coords[:, 0], self.coords[:, 1])] = np.arange(len(self.coords))
+    return self.representatives[self.index_lut[grid_keys]]
+
+
+def manifest_path(map_folder):
+  """ Path of the manifest given the feature volume folder of a map.
+  """
+  return os.path.join(os.path.dirname(os.path.normpath(os.path.expanduser(map_folder))), MANIFEST_FILENAME)
+
+
+def build_map_manifest(map_folder, grid_res):
+  """ Build a manifest from the index of the packed feature volume store of the map or,
+    if there is none, by parsing the filenames (x_y.npz) of the feature volume folder once.
+    Args:
+      map_folder: the feature volume folder of the map.
+      grid_res: the resolution of the grids.
+    Returns:
+      the manifest.
+  """
+  seq_folder = os.path.dirname(os.path.normpath(os.path.expanduser(map_folder)))
+  if store_exists(seq_folder):
+    return MapManifest(FeatureVolumeStore(seq_folder).keys, grid_res)
+
+  real_coords = []
+  for filename in sorted(os.listdir(os.path.expanduser(map_folder))):
+    coord = os.path.splitext(filename)[0].split('_')
+    if len(coord) == 2:
+      real_coords.append(coord)
+
+  return MapManifest.from_real_coords(np.array(real_coords, dtype=float), grid_res)
+
+
+def load_map_manifest(map_folder, grid_res):
+  """ Load the manifest of a map. For maps generated before the manifest existed,
+    the manifest is built once from the feature volume folder and saved.
+    Args:
+      map_folder: the feature volume folder of the map.
+      grid_res: the resolution of the grids.
+    Returns:
+      the manifest.
+  """
+  manifest_file = manifest_path(map_folder)
+  if os.path.exists(manifest_file):
+    manifest = MapManifest.load(manifest_file)
+    if not np.isclose(manifest.resolution, grid_res):
+      raise ValueError('Map manifest %s has resolution %f, but %f is configured.'
+                       % (manifest_file, manifest.resolution, grid_res))
+    return manifest
+
+  print('Map manifest not found, building it from: ', map_folder)
+  manifest = build_map_manifest(map_folder, grid_res)
+  manifest.save(manifest_file)
+  return manifest
+
+
+def build_pyramid_level(manifest, level_resolution):
+  """ Build a coarse level of the map pyramid. Each grid of the level contains at least one grid of the map,
+    the one nearest to its center represents it, thus the level needs no new feature volumes.
+    Args:
+      manifest: the manifest of the map.
+      level_resolution: the resolution of the level (larger than the one of the map).
+    Returns:
+      the manifest of the level.
+  """
+  real_coords = manifest.real_coords()
+  level_coords = np.round(real_coords / level_resolution).astype(np.int64)
+  distances = np.linalg.norm(real_coords - level_coords * level_resolution, axis=1)
+  # sorted by grid of the level, then by distance to its center
+  order = np.lexsort((distances, level_coords[:, 1], level_coords[:, 0]))
+  unique_coords, first = np.unique(level_coords[order], axis=0, return_index=True)
+  return MapManifest(unique_coords, level_resolution, representatives=manifest.coords[order][first])
+
+
+def save_map_pyramid(levels, pyramid_file, manifest):
+  """ Save the coarse levels of a map pyramid. The bounds and number of grids of the map
+    are saved as well, thus levels of an outdated map are detected.
+  """
+  arrays = {'resolutions': np.array([level.resolution for level in levels]),
+            'map_bounds': np.array(manifest.bounds, dtype=np.int64),
+            'map_size': len(manifest.coords)}
+  for i, level in enumerate(levels):
+    arrays['coords_%d' % i] = level.coords.astype(np.int32)
+    arrays['representatives_%d' % i] = level.representatives.astype(np.int32)
+  tmp_file = pyramid_file + '.tmp.npz'
+  np.savez(tmp_file, **arrays)
+  os.replace(tmp_file, pyramid_file)
+
+
+def load_map_pyramid(map_folder, manifest, level_resolutions):
+  """ Load the levels of the map pyramid. Missing coarse levels are built from the manifest and saved.
+    Args:
+      map_folder: the feature volume folder of the map.
+      manifest: the manifest of the map.
+      level_resolutions: resolutions of the levels, from coarse to fine.
+    Returns:
+      list of manifests, one per level. The level with the resolution of the map is the manifest itself.
+  """
+  pyramid_file = os.path.join(os.path.dirname(manifest_path(map_folder)), PYRAMID_FILENAME)
+
+  saved_levels = {}
+  if os.path.exists(pyramid_file):
+    data = np.load(pyramid_file)
+    is_outdated = int(data['map_size']) != len(manifest.coords) or list(data['map_bounds']) != manifest.bounds
+    for i, res in enumerate([] if is_outdated else data['resolutions']):
+      saved_levels[round(float(res), 6)] = MapManifest(data['coords_%d' % i], res,
+                                                       representatives=data['representatives_%d' % i].astype(np.int64))
+
+  levels = []
+  is_new = False
+  for res in level_resolutions:
+    if np.isclose(res, manifest.resolution):
+      levels.append(manifest)
+    elif round(float(res), 6) in saved_levels:
+      levels.append(saved_levels[round(float(res), 6)])
+    else:
+      print('Building map pyramid level with resolution: ', res)
+      levels.append(build_pyramid_level(manifest, res))
+      is_new = True
+
+  if is_new:
+    save_map_pyramid([level for level in levels if level is not manifest], pyramid_file, manifest)
+  return levels
@@ -5,13 +5,16 @@
 
 from utils import *
 
+# noise (standard deviations) in the [rot1 trasl rot2] commands when moving the particles
+COMMAND_NOISE = [0.01, 0.1, 0.01]
+
 
 def motion_model(particles, u, real_command=False, duration=0.1):
   """ MOTION performs the sampling from the proposal.
   distribution, here the rotation-translation-rotation motion model
 
   input:
-     particles ... the particles as in the main script
+     particles ... the particles (ParticleSet), updated in place
      u ... the command in the form [rot1 trasl rot2] or real odometry [v, w]
      noise ... the variances for producing the Gaussian noise for
      perturbating the motion,  noise = [noiseR1 noiseTrasl noiseR2]
@@ -20,27 +23,42 @@ def motion_model(particles, u, real_command=False, duration=0.1):
      the same particles, with updated poses.
 
   The position of the i-th particle is given by the 3D vector
-  particles(i).pose which represents (x, y, theta).
+  (particles.x[i], particles.y[i], particles.theta[i]).
 
   Assume Gaussian noise in each of the three parameters of the motion model.
   These three parameters may be used as standard deviations for sampling.
+  The noise is drawn into the preallocated noise buffer of the particles and the
+  intermediate results are computed in its scratch buffer, thus nothing is allocated.
   """
-  num_particles = len(particles)
+  xs, ys, thetas = particles.x, particles.y, particles.theta
+  # three rows of standard normal noise
+  noise = particles.standard_normal(3)
+  heading, step = particles.scratch(2)
   if not real_command:
     # noise in the [rot1 trasl rot2] commands when moving the particles
-    MOTION_NOISE = [0.01, 0.1, 0.01]
+    MOTION_NOISE = COMMAND_NOISE
     r1Noise = MOTION_NOISE[0]
     transNoise = MOTION_NOISE[1]
     r2Noise = MOTION_NOISE[2]
 
-    rot1 = u[0] + r1Noise * np.random.randn(num_particles)
-    tras1 = u[1] + transNoise * np.random.randn(num_particles)
-    rot2 = u[2] + r2Noise * np.random.randn(num_particles)
+    rot1, tras1, rot2 = noise
+    rot1 *= r1Noise
+    rot1 += u[0]
+    tras1 *= transNoise
+    tras1 += u[1]
+    rot2 *= r2Noise
+    rot2 += u[2]
 
     # update pose using motion model
-    particles[:, 0] += tras1 * np.cos(particles[:, 2] + rot1)
-    particles[:, 1] += tras1 * np.sin(particles[:, 2] + rot1)
-    particles[:, 2] += rot1 + rot2
+    np.add(thetas, rot1, out=heading)
+    np.cos(heading, out=step)
+    step *= tras1
+    xs += step
+    np.sin(heading, out=step)
+    step *= tras1
+    ys += step
+    thetas += rot1
+    thetas += rot2
 
   else:  # use real commands with duration
     # noise in the [v, w] commands when moving the particles
@@ -49,22 +67,42 @@ def motion_model(particles, u, real_command=False, duration=0.1):
     wNoise = MOTION_NOISE[1]
 
     # use the Gaussian noise to simulate the noise in the motion model
-    v = u[0] + vNoise * np.random.randn(num_particles)
-    w = u[1] + wNoise * np.random.randn(num_particles)
-    gamma = wNoise * np.random.randn(num_particles)
-
-    # update pose using motion models
-    particles[:, 0] += - v / w * np.sin(particles[:, 2]) + v / w * np.sin(particles[:, 2] + w * duration)
-    particles[:, 1] += v / w * np.cos(particles[:, 2]) - v / w * np.cos(particles[:, 2] + w * duration)
-    particles[:, 2] += w * duration + gamma * duration
+    v, w, gamma = noise
+    v *= vNoise
+    v += u[0]
+    w *= wNoise
+    w += u[1]
+    gamma *= wNoise
+
+    # update pose using motion models, v is reused for v / w
+    v /= w
+    np.sin(thetas, out=step)
+    step *= v
+    xs -= step
+    np.multiply(w, duration, out=heading)
+    heading += thetas
+    np.sin(heading, out=step)
+    step *= v
+    xs += step
+    np.cos(thetas, out=step)
+    step *= v
+    ys += step
+    np.cos(heading, out=step)
+    step *= v
+    ys -= step
+    w *= duration
+    thetas += w
+    gamma *= duration
+    thetas += gamma
 
   return particles
 
 
-def gen_commands(poses, grid_res):
+def gen_commands(poses, grid_res, rng=np.random):
   """ Create commands out of the ground truth with noise.
   input:
     ground truth poses
+    rng: random number generator (numpy.random or a numpy Generator)
 
   output:
     commands for each frame.
@@ -106,9 +144,9 @@ def gen_commands(poses, grid_res):
   
   # add noise to commands
   commands = np.c_[r1, distance, r2]
-  commands_[1:] = commands + np.array([0.01 * np.random.randn(len(commands)),
-                                       0.01 * np.random.randn(len(commands)),
-                                       0.01 * np.random.randn(len(commands))]).T
+  commands_[1:] = commands + np.array([0.01 * rng.standard_normal(len(commands)),
+                                       0.01 * rng.standard_normal(len(commands)),
+                                       0.01 * rng.standard_normal(len(commands))]).T
 
   return commands_
 
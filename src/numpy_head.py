@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: evaluate the head of OverlapNet in numpy (float32) from exported weights, without keras.
+#
+# Export the head of a trained model once (needs keras):
+#   python3 numpy_head.py [../config/localization.yml]
+# then set head_backend: 'numpy' in the configuration.
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from head_inference import HeadInference
+from overlap_memo import weights_hash
+from stage_timer import timer
+
+
+def softmax(x):
+  x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+  return x / np.sum(x, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+  'linear': lambda x: x,
+  'relu': lambda x: np.maximum(x, 0),
+  'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+  'tanh': np.tanh,
+  'softmax': softmax,
+  'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+}
+
+
+def activation(x, name):
+  if name not in ACTIVATIONS:
+    raise ValueError('Activation %s is not supported by the numpy head.' % name)
+  return ACTIVATIONS[name](x)
+
+
+def same_padding(size, kernel, stride):
+  """ Padding before and after of the 'same' mode of keras (tensorflow) along one axis.
+  """
+  out_size = -(-size // stride)
+  total = max((out_size - 1) * stride + kernel - size, 0)
+  return total // 2, total - total // 2
+
+
+def windows2d(x, pool_size, strides, padding, pad_value=0.):
+  """ Sliding windows of a batch of images (channels last) without copying.
+    Returns: b x out_h x out_w x c x kernel_h x kernel_w view.
+  """
+  if padding == 'same':
+    pad_h = same_padding(x.shape[1], pool_size[0], strides[0])
+    pad_w = same_padding(x.shape[2], pool_size[1], strides[1])
+    x = np.pad(x, ((0, 0), pad_h, pad_w, (0, 0)), constant_values=pad_value)
+  elif padding != 'valid':
+    raise ValueError('Padding %s is not supported by the numpy head.' % padding)
+  return sliding_window_view(x, tuple(pool_size), axis=(1, 2))[:, ::strides[0], ::strides[1]]
+
+
+def conv2d_layer(inputs, config, weights):
+  """ 2D convolution as one matrix product over the unfolded windows (im2col).
+  """
+  if tuple(config.get('dilation_rate', (1, 1))) != (1, 1) or config.get('data_format', 'channels_last') != 'channels_last':
+    raise ValueError('Conv2D %s: only channels_last without dilation is supported.' % config['name'])
+  kernel = weights[0]
+  windows = windows2d(inputs[0], kernel.shape[:2], config['strides'], config['padding'])
+  x = np.einsum('bhwckl,klcf->bhwf', windows, kernel, optimize=True)
+  if config.get('use_bias', True):
+    x += weights[1]
+  return activation(x, config.get('activation', 'linear'))
+
+
+def dense_layer(inputs, config, weights):
+  x = np.matmul(inputs[0], weights[0])
+  if config.get('use_bias', True):
+    x += weights[1]
+  return activation(x, config.get('activation', 'linear'))
+
+
+def pooling2d_layer(reduce):
+  def layer(inputs, config, weights):
+    pad_value = -np.inf if reduce is np.max else 0.
+    windows = windows2d(inputs[0], config['pool_size'], config['strides'] or config['pool_size'],
+                        config['padding'], pad_value)
+    return reduce(windows, axis=(4, 5))
+  return layer
+
+
+def batch_normalization_layer(inputs, config, weights):
+  weights = list(weights)
+  gamma = weights.pop(0) if config.get('scale', True) else 1.
+  beta = weights.pop(0) if config.get('center', True) else 0.
+  mean, variance = weights
+  return (inputs[0] - mean) * (gamma / np.sqrt(variance + config.get('epsilon', 1e-3))) + beta
+
+
+def delta_layer(inputs, config, weights):
+  """ The delta layer of OverlapNet: the absolute differences of the features of every pixel
+    of the first volume and every pixel of the second volume.
+    Returns: b x (h*w) x (h*w) x c array.
+  """
+  a, b = inputs
+  a = a.reshape(a.shape[0], -1, 1, a.shape[-1])
+  b = b.reshape(b.shape[0], 1, -1, b.shape[-1])
+  return np.abs(a - b)
+
+
+def correlation_layer(inputs, config, weights):
+  """ Circular cross-correlation of two feature volumes along the width (yaw) for all shifts.
+    Returns: b x w array.
+  """
+  a, b = inputs
+  spectrum = np.conj(np.fft.rfft(a, axis=2)) * np.fft.rfft(b, axis=2)
+  return np.fft.irfft(np.sum(spectrum, axis=(1, 3)), n=a.shape[2], axis=1).astype(np.float32)
+
+
+# numpy implementations of the layers, keyed by the keras class name.
+# A layer gets the list of its input arrays, its keras config and its weights.
+LAYERS = {
+  'InputLayer': None,
+  'Conv2D': conv2d_layer,
+  'Dense': dense_layer,
+  'Flatten': lambda inputs, config, weights: inputs[0].reshape(len(inputs[0]), -1),
+  'Reshape': lambda inputs, config, weights: inputs[0].reshape((len(inputs[0]),) + tuple(config['target_shape'])),
+  'Activation': lambda inputs, config, weights: activation(inputs[0], config['activation']),
+  'Dropout': lambda inputs, config, weights: inputs[0],
+  'BatchNormalization': batch_normalization_layer,
+  'MaxPooling2D': pooling2d_layer(np.max),
+  'AveragePooling2D': pooling2d_layer(np.mean),
+  'Concatenate': lambda inputs, config, weights: np.concatenate(inputs, axis=config.get('axis', -1)),
+  'Add': lambda inputs, config, weights: sum(inputs[1:], inputs[0]),
+  'Subtract': lambda inputs, config, weights: inputs[0] - inputs[1],
+  'Multiply': lambda inputs, config, weights: np.prod(inputs, axis=0),
+  'DeltaLayer': delta_layer,
+  'CorrelationLayer': correlation_layer,
+}
+
+
+def correlation_spectrum(x, config):
+  return np.fft.rfft(x, axis=2).astype(np.complex64)
+
+
+def correlation_combine(spectra, config, weights, width):
+  spectrum = np.conj(spectra[0]) * spectra[1]
+  return np.fft.irfft(np.sum(spectrum, axis=(1, 3)), n=width, axis=1).astype(np.float32)
+
+
+# Layers of two volumes which are factorized: every input volume is transformed on its own
+# (thus once per query and once per map grid), only the combination is computed for every pair.
+# The entries are (transform(x, config), combine(transformed inputs, config, weights, width of the inputs)).
+FACTORIZED_LAYERS = {
+  'CorrelationLayer': (correlation_spectrum, correlation_combine),
+}
+
+
+def register_layer(class_name, function):
+  """ Add the numpy implementation of a (custom) keras layer: function(inputs, config, weights).
+  """
+  LAYERS[class_name] = function
+
+
+class NumpyHead():
+  """ This class evaluates an exported keras head (see export_head()) in numpy with float32.
+    It has the interface of the keras model used by HeadInference: input_shape, predict_on_batch() and get_weights().
+    Batches are evaluated in chunks, thus the largest intermediate array stays within a memory budget.
+  """
+  def __init__(self, graph, weights, max_bytes=256 * 1024 ** 2):
+    """ Initialization:
+      graph: the keras model config (layers with their inbound nodes, input and output layers).
+      weights: dict with the list of float32 weights of every layer.
+      max_bytes: memory budget of the intermediate arrays of one chunk of the batch.
+    """
+    self.graph = graph
+    self.weights = weights
+    for layer in graph['layers']:
+      if layer['class_name'] not in LAYERS:
+        raise ValueError('Layer %s (%s) is not supported by the numpy head, add it with register_layer().' %
+                         (layer['name'], layer['class_name']))
+    layers = {layer['name']: layer for layer in graph['layers']}
+    self.input_shape = [tuple(layers[name]['config']['batch_input_shape']) for name, _, _ in graph['input_layers']]
+    self.input_keys = [tuple(key) for key in graph['input_layers']]
+    self.output_keys = [tuple(key) for key in graph['output_layers']]
+    # the calls of the layers in topological order: (layer, tensor key of the output, tensor keys of the inputs)
+    self.nodes = [(layer, (layer['name'], node_idx, 0), [tuple(node[:3]) for node in inbound])
+                  for layer in graph['layers'] if LAYERS[layer['class_name']] is not None
+                  for node_idx, inbound in enumerate(layer['inbound_nodes'])]
+
+    self.split_graph()
+
+    # shapes of all tensors (without the batch dimension) from one pair of zero volumes.
+    # The size of the chunks: the largest intermediate array of one pair must fit into the budget.
+    tensors = {key: np.zeros((1,) + tuple(shape[1:]), dtype=np.float32)
+               for key, shape in zip(self.input_keys, self.input_shape)}
+    self.run_nodes(tensors, self.nodes)
+    self.shapes = {key: x.shape[1:] for key, x in tensors.items()}
+    self.chunk_size = max(1, int(max_bytes // max(x.nbytes for x in tensors.values())))
+
+  @classmethod
+  def load(cls, filename, max_bytes=256 * 1024 ** 2):
+    """ Load a head exported by export_head().
+    """
+    data = np.load(filename)
+    graph = json.loads(str(data['graph']))
+    weights = {}
+    for layer in graph['layers']:
+      num_weights = int(data['num_weights/' + layer['name']])
+      weights[layer['name']] = [data['weights/%s/%d' % (layer['name'], i)].astype(np.float32)
+                                for i in range(num_weights)]
+    return cls(graph, weights, max_bytes)
+
+  def get_weights(self):
+    return [weights for layer in self.graph['layers'] for weights in self.weights[layer['name']]]
+
+  def split_graph(self):
+    """ Split the graph into the layers which depend only on the query volume (first input), only on
+      the map volume (second input), and on both (the pairwise part). The parts of a volume are the tensors
+      of one input used by the pairwise part: they are computed once per query and once per map grid.
+      The inputs of factorized layers (FACTORIZED_LAYERS) are parts in transformed form.
+    """
+    sides = {key: frozenset([i]) for i, key in enumerate(self.input_keys)}
+    for layer, key, inbound in self.nodes:
+      sides[key] = frozenset().union(*[sides[input_key] for input_key in inbound])
+    self.side_nodes = [[node for node in self.nodes if sides[node[1]] == frozenset([i])] for i in range(2)]
+    self.pair_nodes = [node for node in self.nodes if len(sides[node[1]]) > 1]
+
+    # parts of each side: (name, tensor key, transform or None)
+    self.parts = [[], []]
+    def add_part(key, transform):
+      side = next(iter(sides[key]))
+      name = '%s_%d_%d' % key + ('_factorized' if transform is not None else '')
+      if name not in [part[0] for part in self.parts[side]]:
+        self.parts[side].append((name, key, transform))
+      return name
+    self.pair_inputs = {}
+    self.factorized_nodes = set()
+    for layer, key, inbound in self.pair_nodes:
+      transform = None
+      if layer['class_name'] in FACTORIZED_LAYERS and all(len(sides[input_key]) == 1 for input_key in inbound):
+        transform = FACTORIZED_LAYERS[layer['class_name']][0]
+        self.factorized_nodes.add(key)
+      self.pair_inputs[key] = [add_part(input_key, transform) if len(sides[input_key]) == 1 else None
+                               for input_key in inbound]
+    for key in self.output_keys:
+      if len(sides[key]) == 1:
+        add_part(key, None)
+
+  def run_nodes(self, tensors, nodes):
+    for layer, key, inbound in nodes:
+      tensors[key] = LAYERS[layer['class_name']]([tensors[input_key] for input_key in inbound], layer['config'],
+                                                 self.weights[layer['name']])
+    return tensors
+
+  def evaluate(self, inputs):
+    """ Evaluate the graph for a chunk of the batch.
+      Returns: the list of outputs.
+    """
+    tensors = {key: np.asarray(x, dtype=np.float32) for key, x in zip(self.input_keys, inputs)}
+    self.run_nodes(tensors, self.nodes)
+    return [tensors[key] for key in self.output_keys]
+
+  def precompute(self, volumes, side):
+    """ Compute the parts of feature volumes which do not depend on the other volume of a pair.
+      Args:
+        volumes: n x h x w x c numpy array of feature volumes.
+        side: 0 for query volumes (first input), 1 for map volumes (second input).
+      Returns:
+        dict with the parts (arrays of size n in the first dimension).
+    """
+    tensors = {self.input_keys[side]: np.asarray(volumes, dtype=np.float32)}
+    self.run_nodes(tensors, self.side_nodes[side])
+    return {name: transform(tensors[key], None) if transform is not None else tensors[key]
+            for name, key, transform in self.parts[side]}
+
+  def is_raw_part(self, name, side):
+    """ Returns: True if a part is the input volume itself.
+    """
+    return name == '%s_%d_%d' % self.input_keys[side]
+
+  def evaluate_pairs(self, query_parts, map_parts):
+    """ Evaluate the pairwise part of the head for one query and n map grids.
+      Args:
+        query_parts: the parts of the query volume (see precompute()), size 1.
+        map_parts: the parts of the map volumes, size n.
+      Returns:
+        list of outputs (a single array for a head with one output), like predict_on_batch().
+    """
+    num_pairs = len(next(iter(map_parts.values())))
+    chunk_outputs = []
+    for start in range(0, num_pairs, self.chunk_size):
+      end = min(start + self.chunk_size, num_pairs)
+      parts = {name: np.broadcast_to(x, (end - start,) + x.shape[1:]) for name, x in query_parts.items()}
+      parts.update({name: x[start:end] for name, x in map_parts.items()})
+      tensors = {key: parts[name] for side in range(2) for name, key, transform in self.parts[side]
+                 if transform is None}
+      for layer, key, inbound in self.pair_nodes:
+        if key in self.factorized_nodes:
+          combine = FACTORIZED_LAYERS[layer['class_name']][1]
+          tensors[key] = combine([parts[name] for name in self.pair_inputs[key]], layer['config'],
+                                 self.weights[layer['name']], self.shapes[inbound[0]][1])
+        else:
+          tensors[key] = LAYERS[layer['class_name']]([tensors[input_key] for input_key in inbound],
+                                                     layer['config'], self.weights[layer['name']])
+      chunk_outputs.append([tensors[key] for key in self.output_keys])
+    outputs = [np.concatenate([outputs[i] for outputs in chunk_outputs]) if len(chunk_outputs) > 1
+               else np.ascontiguousarray(chunk_outputs[0][i]) for i in range(len(chunk_outputs[0]))]
+    return outputs if len(outputs) > 1 else outputs[0]
+
+  def predict_on_batch(self, inputs):
+    """ Evaluate the head like keras Model.predict_on_batch().
+      Returns: list of outputs (a single array for a head with one output).
+    """
+    batch_size = len(inputs[0])
+    chunk_outputs = [self.evaluate([x[start:start + self.chunk_size] for x in inputs])
+                     for start in range(0, batch_size, self.chunk_size)]
+    outputs = [np.concatenate([outputs[i] for outputs in chunk_outputs]) if len(chunk_outputs) > 1
+               else chunk_outputs[0][i] for i in range(len(chunk_outputs[0]))]
+    return outputs if len(outputs) > 1 else outputs[0]
+
+
+def export_head(head, filename, num_check_pairs=8, tolerance=1e-3):
+  """ Export the weights and the graph of a keras head for NumpyHead. The numpy head is compared
+    with keras for random pairs of feature volumes, the export fails if they deviate.
+    Args:
+      head: the keras model of the head.
+      filename: the .npz file of the exported head.
+      num_check_pairs: number of random pairs of the comparison.
+      tolerance: maximal absolute deviation of the outputs.
+    Returns:
+      the maximal absolute deviation of every output.
+  """
+  model_config = head.get_config()
+  graph = {'layers': [{'name': layer['name'], 'class_name': layer['class_name'], 'config': layer['config'],
+                       'inbound_nodes': layer['inbound_nodes']} for layer in model_config['layers']],
+           'input_layers': model_config['input_layers'],
+           'output_layers': model_config['output_layers']}
+  weights = {layer['name']: [np.asarray(w, dtype=np.float32) for w in head.get_layer(layer['name']).get_weights()]
+             for layer in graph['layers']}
+  numpy_head = NumpyHead(graph, weights)
+
+  # compare with keras
+  rng = np.random.default_rng(0)
+  inputs = [rng.standard_normal((num_check_pairs,) + tuple(shape[1:])).astype(np.float32)
+            for shape in numpy_head.input_shape]
+  keras_outputs = head.predict_on_batch(inputs)
+  numpy_outputs = numpy_head.predict_on_batch(inputs)
+  if not isinstance(keras_outputs, list):
+    keras_outputs, numpy_outputs = [keras_outputs], [numpy_outputs]
+  deviations = [float(np.max(np.abs(np.asarray(k) - n))) for k, n in zip(keras_outputs, numpy_outputs)]
+  if max(deviations) > tolerance:
+    raise ValueError('The numpy head deviates from keras by %s, check the implementations of the layers %s.' %
+                     (deviations, sorted(set(layer['class_name'] for layer in graph['layers']))))
+
+  arrays = {'graph': np.array(json.dumps(graph))}
+  for name, layer_weights in weights.items():
+    arrays['num_weights/' + name] = np.array(len(layer_weights))
+    for i, w in enumerate(layer_weights):
+      arrays['weights/%s/%d' % (name, i)] = w
+  np.savez(filename, **arrays)
+  return deviations
+
+
+class MapHeadParts():
+  """ This class stores the map side parts of the head (see NumpyHead.precompute()) of every record
+    of the map feature volume store, thus they are computed once per grid and not in every frame.
+    The parts live with the map in <map sequence>/head_parts/<key>, one folder per segment of the store
+    with one memory mapped .npy file per part. The key combines the hash of the head weights and the segment,
+    segments never change, thus after volumes were appended only the parts of the new segment are computed.
+    The index of a segment is written last.
+  """
+  def __init__(self, head, map_store, head_hash, batch_size=256):
+    """ Initialization, the parts are computed if they do not exist yet:
+      head: the numpy head (NumpyHead).
+      map_store: the map feature volume store (FeatureVolumeStore).
+      head_hash: hash of the weights of the head (see weights_hash()).
+      batch_size: number of map grids computed at once.
+    """
+    self.names = [name for name, _, _ in head.parts[1] if not head.is_raw_part(name, 1)]
+    self.offsets = map_store.offsets
+    # the parts of every segment
+    self.segment_parts = []
+    for segment_idx in range(len(map_store.segments)):
+      segment_id = map_store.segment_id(segment_idx)
+      key = hashlib.sha1(('%s_%s' % (head_hash, segment_id)).encode()).hexdigest()[:16]
+      folder = os.path.join(map_store.folder, 'head_parts', key)
+      if len(self.names) > 0 and not os.path.exists(os.path.join(folder, 'index.json')):
+        self.build(head, map_store, segment_idx, folder, batch_size)
+      self.segment_parts.append({name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+                                 for name in self.names})
+
+  def build(self, head, map_store, segment_idx, folder, batch_size):
+    first, last = int(self.offsets[segment_idx]), int(self.offsets[segment_idx + 1])
+    print('Precomputing the map side of the head for %d grids in %s' % (last - first, folder))
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+    files = {}
+    for start in range(first, last, batch_size):
+      parts = head.precompute(map_store.read(slice(start, min(start + batch_size, last))), 1)
+      for name in self.names:
+        if name not in files:
+          files[name] = np.lib.format.open_memmap(os.path.join(folder, name + '.npy.tmp'), mode='w+',
+                                                  dtype=parts[name].dtype,
+                                                  shape=(last - first,) + parts[name].shape[1:])
+        files[name][start - first:start - first + batch_size] = parts[name]
+    for name, part in files.items():
+      part.flush()
+      filename = part.filename
+      del part
+      os.replace(filename, os.path.join(folder, name + '.npy'))
+    files.clear()
+    with open(os.path.join(folder, 'index.json.tmp'), 'w') as f:
+      json.dump({'parts': self.names, 'segment': map_store.segment_id(segment_idx)}, f)
+    os.replace(os.path.join(folder, 'index.json.tmp'), os.path.join(folder, 'index.json'))
+
+  def lookup(self, map_records):
+    """ Returns: dict with the parts of the given records, zeros for records < 0 (grids without volume).
+    """
+    map_records = np.asarray(map_records, dtype=np.int64)
+    is_valid = map_records >= 0
+    records = np.maximum(map_records, 0)
+    if len(self.segment_parts) == 1:
+      parts = {name: part[records] for name, part in self.segment_parts[0].items()}
+    else:
+      segments = np.searchsorted(self.offsets, records, side='right') - 1
+      parts = {}
+      for name in self.names:
+        first_part = self.segment_parts[0][name]
+        parts[name] = np.empty((len(records),) + first_part.shape[1:], dtype=first_part.dtype)
+      for segment in np.unique(segments):
+        is_in_segment = segments == segment
+        local = records[is_in_segment] - self.offsets[segment]
+        for name, part in self.segment_parts[segment].items():
+          parts[name][is_in_segment] = part[local]
+    for name in parts:
+      parts[name][~is_valid] = 0
+    return parts
+
+
+class NumpyFastInfer(HeadInference):
+  """ The online inference with the numpy head, no keras is needed.
+    The query feature volumes are read from the store, thus live queries (which need the legs) are not supported.
+
+    With config['factorized_head'] (default), the head is split into the parts of single volumes and
+    the pairwise part (see NumpyHead.split_graph()): the query side is computed once per frame,
+    the map side once per grid (stored with the map, see MapHeadParts), only the pairwise part for every pair.
+  """
+  def __init__(self, config, cache_size=None):
+    """
+      config: configure parameters, used attributes: 'numpy_head_file', 'numpy_head_bytes' and
+        'factorized_head' (optional) and the attributes of the feature volume cache.
+      cache_size: number of cached feature volumes. If None, the number is given by the memory budget
+        of the cache (config['cache_bytes']).
+    """
+    self.batch_size = config['batch_size']
+    self.head = NumpyHead.load(config['numpy_head_file'], config.get('numpy_head_bytes', 256 * 1024 ** 2))
+    self.init_head_inference(config, cache_size)
+
+    self.factorized = config.get('factorized_head', True)
+    self.map_parts = None
+    # the query side of the last frame
+    self.query_parts = None
+    self.query_frame = None
+    self.query_volume = None
+    # name of the map part which is the map volume itself (read through the cache), None if not used
+    self.raw_map_part = next((name for name, _, _ in self.head.parts[1] if self.head.is_raw_part(name, 1)), None)
+
+  def open_map_parts(self):
+    if self.map_parts is None:
+      self.volume_cache.open_stores()
+      self.map_parts = MapHeadParts(self.head, self.volume_cache.map_store, weights_hash([self.head]))
+    return self.map_parts
+
+  def infer_multiple(self, idx_current_frame, coordinates_nearby_grid, query_volume=None):
+    if not self.factorized:
+      return super().infer_multiple(idx_current_frame, coordinates_nearby_grid, query_volume)
+    self.volume_cache.open_stores()
+    map_store = self.volume_cache.map_store
+    grid_coords = np.round(np.asarray(coordinates_nearby_grid) / map_store.resolution).astype(np.int64)
+    return self.infer_records(idx_current_frame, map_store.lookup(grid_coords), query_volume)
+
+  def infer_cells(self, idx_current_frame, map_records, query_volume=None):
+    if not self.factorized:
+      return super().infer_cells(idx_current_frame, map_records, query_volume)
+    return self.infer_records(idx_current_frame, map_records, query_volume)
+
+  def infer_records(self, idx_current_frame, map_records, query_volume=None):
+    """ Factorized inference of the current scan and grids given as records of the map store.
+      Returns:
+        the same outputs as infer_multiple().
+    """
+    self.volume_cache.new_record_task(idx_current_frame, map_records, query_volume)
+
+    # the query side is computed once per frame
+    if self.query_parts is None or idx_current_frame != self.query_frame or query_volume is not self.query_volume:
+      with timer.stage('head_query'):
+        self.query_parts = self.head.precompute(self.volume_cache.input1[:1], 0)
+      self.query_frame = idx_current_frame
+      self.query_volume = query_volume
+    map_parts = self.open_map_parts().lookup(map_records)
+
+    if self.raw_map_part is None:
+      # the pairwise part needs no map volumes, thus the cache is not used
+      with timer.stage('head'):
+        outputs = self.head.evaluate_pairs(self.query_parts, map_parts)
+      return outputs if isinstance(outputs, list) else [outputs]
+
+    batch_outputs = []
+    for batch_idx in range(len(self.volume_cache)):
+      inputs, cb_size = self.volume_cache.get_fixed_batch(batch_idx)
+      start = batch_idx * self.volume_cache.batch_size
+      parts = {name: x[start:start + cb_size] for name, x in map_parts.items()}
+      parts[self.raw_map_part] = inputs[1][:cb_size]
+      with timer.stage('head'):
+        outputs = self.head.evaluate_pairs(self.query_parts, parts)
+      batch_outputs.append(outputs if isinstance(outputs, list) else [outputs])
+
+    if len(batch_outputs) == 1:
+      return batch_outputs[0]
+    return [np.concatenate([outputs[i] for outputs in batch_outputs]) for i in range(len(batch_outputs[0]))]
+
+
+if __name__ == '__main__':
+  import yaml
+  from fast_infer import FastInfer
+
+  # load config file
+  config_filename = '../config/localization.yml'
+  if len(sys.argv) > 1:
+    config_filename = sys.argv[1]
+
+  if yaml.__version__ >= '5.1':
+    config = yaml.load(open(config_filename), Loader=yaml.FullLoader)
+  else:
+    config = yaml.load(open(config_filename))
+
+  infer = FastInfer(config)
+  deviations = export_head(infer.head, config['numpy_head_file'])
+  print('Exported the head to %s, maximal deviation of the outputs from keras: %s' %
+        (config['numpy_head_file'], deviations))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a persistent memo of the OverlapNet head outputs (overlap and yaw) of pairs of query frames and map grids.
+
+import os
+import uuid
+import atexit
+import hashlib
+import numpy as np
+
+
+def weights_hash(models):
+  """ Hash of the weights of keras models.
+    Args:
+      models: list of keras models.
+    Returns:
+      hex string of the sha1 hash.
+  """
+  sha1 = hashlib.sha1()
+  for model in models:
+    for weights in model.get_weights():
+      weights = np.ascontiguousarray(weights)
+      sha1.update(str(weights.shape).encode())
+      sha1.update(weights.tobytes())
+  return sha1.hexdigest()
+
+
+class OverlapMemo():
+  """ This class stores the overlap and the yaw (argmax of the yaw output) of every evaluated pair
+    of a query frame and a map grid on disk, thus repeated runs on the same data skip the inference.
+
+    The memo lives in folder/<key>, where the key combines the hash of the head weights, the lineages
+    of the map and query feature volume stores and the precision of the cached volumes fed to the head.
+    A new model, regenerated volumes or another cache_dtype thus start a new memo.
+    The pairs are given by their records in the stores, appended volumes (see FeatureVolumeStore.create())
+    get new records, thus the entries of the other volumes are kept.
+    There is one file per query record with the map store records sorted. New entries of a frame are kept in memory
+    and the file is written once, when the next frame is used (or at exit, see flush()). Every writer uses its own
+    temporary file which is atomically moved in place, after merging the entries written by others meanwhile.
+    Concurrent runs may drop each other's new entries of a frame in a race, but never corrupt a file.
+  """
+  def __init__(self, folder, head_hash, map_lineage, query_lineage, cache_dtype):
+    """ Initialization:
+      folder: root folder of the memo.
+      head_hash: hash of the weights of the head (see weights_hash()).
+      map_lineage, query_lineage: lineages of the map and query feature volume stores.
+      cache_dtype: precision of the volumes fed to the head (see config['cache_dtype']).
+    """
+    key = '%s_%s_%s_%s' % (head_hash, map_lineage, query_lineage, np.dtype(cache_dtype).name)
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    self.folder = os.path.join(folder, key)
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+
+    # the entries of the last used query record: sorted map records, overlaps and yaws
+    self.query_record = None
+    self.records = np.zeros(0, dtype=np.int64)
+    self.overlaps = np.zeros(0, dtype=np.float32)
+    self.yaws = np.zeros(0, dtype=np.int16)
+    # True if the entries of the frame have new entries which are not written yet
+    self.dirty = False
+
+    self.hits = 0
+    self.misses = 0
+    atexit.register(self.flush)
+
+  def frame_file(self, query_record):
+    return os.path.join(self.folder, 'query_' + str(query_record).zfill(6) + '.npz')
+
+  def read_frame(self, query_record):
+    """ Returns: the map records, overlaps and yaws in the file of a query record (empty if there is none).
+    """
+    filename = self.frame_file(query_record)
+    if os.path.exists(filename):
+      entries = np.load(filename)
+      return entries['records'], entries['overlaps'], entries['yaws']
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int16)
+
+  def load_frame(self, query_record):
+    if query_record == self.query_record:
+      return
+    self.flush()
+    self.query_record = query_record
+    self.records, self.overlaps, self.yaws = self.read_frame(query_record)
+
+  def merge(self, records, overlaps, yaws):
+    """ Merge entries into the entries of the current frame, the given ones replace existing entries.
+    """
+    records = np.concatenate([np.asarray(records, dtype=np.int64), self.records])
+    records, first = np.unique(records, return_index=True)
+    self.overlaps = np.concatenate([np.asarray(overlaps, dtype=np.float32), self.overlaps])[first]
+    self.yaws = np.concatenate([np.asarray(yaws, dtype=np.int16), self.yaws])[first]
+    self.records = records
+
+  def flush(self):
+    """ Write the new entries of the current frame into its file.
+    """
+    if not self.dirty:
+      return
+    self.dirty = False
+    # entries which were written by other runs meanwhile are kept, the own ones take precedence
+    own_entries = (self.records, self.overlaps, self.yaws)
+    self.records, self.overlaps, self.yaws = self.read_frame(self.query_record)
+    self.merge(*own_entries)
+
+    filename = self.frame_file(self.query_record)
+    tmp_file = '%s.%d.%s.tmp.npz' % (filename, os.getpid(), uuid.uuid4().hex[:8])
+    np.savez(tmp_file, records=self.records, overlaps=self.overlaps, yaws=self.yaws)
+    os.replace(tmp_file, filename)
+
+  def lookup(self, query_record, map_records):
+    """ Look up the pairs of a query frame and map grids.
+      Args:
+        query_record: record of the query frame in the query feature volume store.
+        map_records: records of the grids in the map feature volume store.
+      Returns:
+        overlaps, yaws and a boolean numpy array which is True for the pairs found in the memo.
+    """
+    self.load_frame(query_record)
+    map_records = np.asarray(map_records, dtype=np.int64)
+    overlaps = np.zeros(len(map_records), dtype=np.float32)
+    yaws = np.zeros(len(map_records), dtype=np.int64)
+    found = np.zeros(len(map_records), dtype=bool)
+    if len(self.records) > 0:
+      pos = np.minimum(np.searchsorted(self.records, map_records), len(self.records) - 1)
+      found = self.records[pos] == map_records
+      overlaps[found] = self.overlaps[pos[found]]
+      yaws[found] = self.yaws[pos[found]]
+
+    num_found = int(np.count_nonzero(found))
+    self.hits += num_found
+    self.misses += len(map_records) - num_found
+    return overlaps, yaws, found
+
+  def add(self, query_record, map_records, overlaps, yaws):
+    """ Add newly inferred pairs of a query frame, the frame file is written by flush().
+      Args:
+        query_record: record of the query frame in the query feature volume store.
+        map_records: records of the grids in the map feature volume store.
+        overlaps: the overlap of each pair.
+        yaws: the yaw of each pair (argmax of the yaw output of the head).
+    """
+    map_records = np.asarray(map_records, dtype=np.int64)
+    if len(map_records) == 0:
+      return
+    self.load_frame(query_record)
+
+    # the old entries of a record are replaced by the new ones
+    self.merge(map_records, overlaps, yaws)
+    self.dirty = True
+
+  def hit_rate(self):
+    if self.hits + self.misses == 0:
+      return 0.0
+    return 100.0 * self.hits / (self.hits + self.misses)
+
+  def print_statistics(self):
+    self.flush()
+    print('Overlap memo hit rate: %5.1f %% (%d hits, %d misses) in %s' %
+          (self.hit_rate(), self.hits, self.misses, self.folder))
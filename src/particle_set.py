@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a preallocated set of particles stored as float32 structure of arrays.
+
+import numpy as np
+
+
+class ParticleSet():
+  """ This class stores the particles of the MCL as rows x, y, theta and weight of float32 arrays.
+    All memory is allocated once for the maximal number of particles:
+      - two buffers for the particles, resampling writes into the back buffer and swaps the buffers,
+      - a buffer for the Gaussian noise of the motion model, filled in place by a numpy Generator,
+      - a float64 scratch buffer for intermediate results (e.g. the likelihoods, which underflow in float32).
+    The properties x, y, theta and weight are views of the current particles, thus they can be updated in place.
+  """
+  __slots__ = ('capacity', 'size', 'rng', 'buffers', 'current', 'noise', 'scratch_buffer')
+
+  def __init__(self, capacity, rng=None):
+    """ Initialization:
+      capacity: maximal number of particles.
+      rng: numpy Generator for the noise and the resampling. If None, a new one is created.
+    """
+    self.capacity = capacity
+    self.size = 0
+    self.rng = rng if rng is not None else np.random.default_rng()
+    self.buffers = np.zeros((2, 4, capacity), dtype=np.float32)
+    self.current = 0
+    self.noise = np.zeros(3 * capacity, dtype=np.float32)
+    self.scratch_buffer = np.zeros((2, capacity), dtype=np.float64)
+
+  @classmethod
+  def from_array(cls, particles, capacity=None, rng=None):
+    """ Create a particle set from a nx4 numpy array [x, y, theta, weight].
+    """
+    particle_set = cls(max(len(particles), capacity or 0), rng)
+    particle_set.assign(particles)
+    return particle_set
+
+  def assign(self, particles):
+    """ Replace the particles by a nx4 numpy array [x, y, theta, weight].
+    """
+    if len(particles) > self.capacity:
+      raise ValueError('%d particles exceed the capacity of %d' % (len(particles), self.capacity))
+    self.size = len(particles)
+    self.data[:] = np.asarray(particles).T
+
+  def __len__(self):
+    return self.size
+
+  @property
+  def data(self):
+    """ The current particles as 4xn array (rows x, y, theta, weight).
+    """
+    return self.buffers[self.current, :, :self.size]
+
+  @property
+  def x(self):
+    return self.buffers[self.current, 0, :self.size]
+
+  @property
+  def y(self):
+    return self.buffers[self.current, 1, :self.size]
+
+  @property
+  def theta(self):
+    return self.buffers[self.current, 2, :self.size]
+
+  @property
+  def weight(self):
+    return self.buffers[self.current, 3, :self.size]
+
+  def standard_normal(self, rows):
+    """ Fill the noise buffer with standard normal samples in place.
+      Returns: rows x n view of the noise buffer.
+    """
+    noise = self.noise[:rows * self.size]
+    self.rng.standard_normal(out=noise, dtype=np.float32)
+    return noise.reshape(rows, self.size)
+
+  def scratch(self, rows):
+    """ Returns: rows x n float64 view of the scratch buffer (up to 2 rows), the content is undefined.
+    """
+    return self.scratch_buffer[:rows, :self.size]
+
+  def select(self, indexes):
+    """ Replace the particles by the particles with the given indexes (e.g. drawn by resampling).
+      The selected particles are gathered into the back buffer, then the buffers are swapped.
+    """
+    if len(indexes) > self.capacity:
+      raise ValueError('%d particles exceed the capacity of %d' % (len(indexes), self.capacity))
+    back = self.buffers[1 - self.current, :, :len(indexes)]
+    np.take(self.data, indexes, axis=1, out=back)
+    self.current = 1 - self.current
+    self.size = len(indexes)
+
+  def to_array(self):
+    """ Returns: the particles as nx4 float64 numpy array [x, y, theta, weight] (a copy).
+    """
+    return self.data.T.astype(np.float64)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: a motion-predicted prefetcher which warms the feature volume cache in background threads.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from motion_model import COMMAND_NOISE
+
+
+class FeatureVolumePrefetcher():
+  """ This class predicts the grids which the particle cloud is likely to touch in the next frames
+    and loads their feature volumes into the cache with a thread pool, while the current frame is inferred.
+  """
+  def __init__(self, volume_cache, manifest, config):
+    """ Initialization:
+      volume_cache: the feature volume cache (FeatureVolumeCacheSequence).
+      manifest: the map manifest, only grids with a feature volume are prefetched.
+      config: configuration parameters, used attributes:
+        'prefetch_frames': number of frames to predict ahead.
+        'prefetch_workers': number of loading threads.
+        'prefetch_max_cells': maximal number of grids queued per frame.
+    """
+    self.volume_cache = volume_cache
+    self.manifest = manifest
+    self.num_frames = config.get('prefetch_frames', 2)
+    self.max_cells = config.get('prefetch_max_cells', 2000)
+    self.num_workers = config.get('prefetch_workers', 4)
+    self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+    self.futures = []
+    # number of grids per job, small jobs can be cancelled when the next frame arrives
+    self.job_size = 64
+
+  def predict_cells(self, particles, command):
+    """ Predict the grids of the particles for the next frames assuming the same command,
+      the grids are dilated by the spread of the motion noise.
+      Args:
+        particles: the particles (ParticleSet).
+        command: the last command [rot1 trasl rot2] (in grid units).
+      Returns:
+        integer grid coordinates sorted by the number of particles (most first).
+    """
+    rot1, trasl, rot2 = command[0], command[1], command[2]
+    r1Noise, transNoise, r2Noise = COMMAND_NOISE
+
+    xs = particles.x.astype(np.float64)
+    ys = particles.y.astype(np.float64)
+    thetas = particles.theta.astype(np.float64)
+    grid_xs = []
+    grid_ys = []
+    spread = 0.
+    for k in range(1, self.num_frames + 1):
+      xs += trasl * np.cos(thetas + rot1)
+      ys += trasl * np.sin(thetas + rot1)
+      thetas += rot1 + rot2
+      grid_xs.append(np.round(xs).astype(np.int64))
+      grid_ys.append(np.round(ys).astype(np.int64))
+      # 3 sigma of the accumulated noise in translation and lateral displacement
+      spread = 3 * np.sqrt(k * transNoise ** 2 + (k * trasl * (r1Noise + r2Noise)) ** 2)
+
+    grid_xs = np.concatenate(grid_xs)
+    grid_ys = np.concatenate(grid_ys)
+    _, _, in_map = self.manifest.lut_index(grid_xs, grid_ys)
+    grid_xs = grid_xs[in_map]
+    grid_ys = grid_ys[in_map]
+    keys, counts = np.unique(self.manifest.grid_keys(grid_xs, grid_ys), return_counts=True)
+    cells = self.manifest.keys2coords(keys)
+
+    # dilate the predicted grids by the spread of the noise
+    radius = int(np.ceil(spread))
+    if radius > 0:
+      offsets = np.array([[dx, dy] for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1)
+                          if dx * dx + dy * dy <= radius * radius])
+      cells = (cells[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+      counts = np.repeat(counts, len(offsets))
+
+    has_volume = self.manifest.contains(cells[:, 0], cells[:, 1])
+    cells = cells[has_volume]
+    counts = counts[has_volume]
+    keys, inverse = np.unique(self.manifest.grid_keys(cells[:, 0], cells[:, 1]), return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), weights=counts)
+    order = np.argsort(-counts, kind='stable')
+    return self.manifest.keys2coords(keys[order])
+
+  def schedule(self, particles, command):
+    """ Queue the loading of the feature volumes which are likely to be used in the next frames.
+      Loads which were queued for the last frame and did not start yet are cancelled.
+    """
+    for future in self.futures:
+      future.cancel()
+
+    self.volume_cache.open_stores()
+    cells = self.predict_cells(particles, command)
+    records = self.volume_cache.map_store.lookup(cells)
+    is_new = (records >= 0) & ~self.volume_cache.is_cached(records)
+    cells = cells[is_new][:self.max_cells]
+    records = records[is_new][:self.max_cells]
+
+    self.futures = [self.executor.submit(self.volume_cache.prefetch,
+                                         records[start:start + self.job_size], cells[start:start + self.job_size])
+                    for start in range(0, len(records), self.job_size)]
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False)
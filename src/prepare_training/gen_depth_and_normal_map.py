@@ -17,6 +17,31 @@ except:
   sys.exit(-1)
 
 
+def gen_depth_and_normal_grid(virtual_scan_path, depth_folder, normal_folder, range_image_params):
+  """ Generate depth and normal data of one virtual grid scan, existing data is replaced.
+    Args:
+      virtual_scan_path: path of the virtual scan (.npz).
+      depth_folder: path of folder for generated depth data.
+      normal_folder: path of folder for generated normal data.
+      range_image_params: parameters for generating a range image.
+  """
+  virtual_scan = np.load(virtual_scan_path)['arr_0']
+  coordinate = os.path.basename(virtual_scan_path).replace('.npz', '')
+  
+  # generate depth and normal data
+  depth_and_normal = gen_depth_and_normal(virtual_scan.astype(np.float32),
+                                          range_image_params['height'], range_image_params['width'],
+                                          range_image_params['fov_up'], range_image_params['fov_down'],
+                                          range_image_params['max_range'], range_image_params['min_range'])
+  
+  depth = depth_and_normal[:, :, 3] / np.max(depth_and_normal[:, :, 3])
+  normal = depth_and_normal[:, :, :3]
+  
+  # save depth and normal data
+  np.save(os.path.join(depth_folder, coordinate), depth)
+  np.save(os.path.join(normal_folder, coordinate), normal)
+
+
 def gen_depth_and_normal_map(virtual_scan_folder, depth_folder, normal_folder, range_image_params):
   """ Generate depth and normal data given virtual grid scans.
     Args:
@@ -37,29 +62,19 @@ def gen_depth_and_normal_map(virtual_scan_folder, depth_folder, normal_folder, r
   if not os.path.exists(normal_folder):
     os.makedirs(normal_folder)
   
+  # existing depth data is listed once
+  existing = set(os.path.splitext(f)[0] for f in os.listdir(depth_folder))
+  
   print('start generating depth and normal data for map scans...')
   for virtual_scan_path in tqdm(virtual_scan_paths):
-    # load virtual scan and the coordinate
-    virtual_scan = np.load(virtual_scan_path)['arr_0']
     coordinate = os.path.basename(virtual_scan_path).replace('.npz', '')
 
     # check existence
-    if os.path.exists(os.path.join(depth_folder, coordinate + '.npy')):
+    if coordinate in existing:
       print('existing: ', coordinate)
       continue
     
-    # generate depth and normal data
-    depth_and_normal = gen_depth_and_normal(virtual_scan.astype(np.float32),
-                                            range_image_params['height'], range_image_params['width'],
-                                            range_image_params['fov_up'], range_image_params['fov_down'],
-                                            range_image_params['max_range'], range_image_params['min_range'])
-    
-    depth = depth_and_normal[:, :, 3] / np.max(depth_and_normal[:, :, 3])
-    normal = depth_and_normal[:, :, :3]
-    
-    # save depth and normal data
-    np.save(os.path.join(depth_folder, coordinate), depth)
-    np.save(os.path.join(normal_folder, coordinate), normal)
+    gen_depth_and_normal_grid(virtual_scan_path, depth_folder, normal_folder, range_image_params)
 
 
 if __name__ == '__main__':
@@ -30,6 +30,22 @@ def gen_pcd_map(poses, scan_paths, map_file,
     Returns:
       pcd_map: the global point cloud map in open3d format.
   """
+  pcd_map = accumulate_scans(poses, scan_paths, voxel_size, max_dist, min_dist, min_z)
+  o3d.io.write_point_cloud(map_file, pcd_map)
+  print('Finished and saved the map in: ', map_file)
+  
+  # visualize pcd map
+  if vis_map:
+    o3d.visualization.draw_geometries([pcd_map])
+  
+  return pcd_map
+
+
+def accumulate_scans(poses, scan_paths, voxel_size=0.02, max_dist=50, min_dist=3, min_z=-2):
+  """ Accumulate LiDAR scans into a point cloud, see gen_pcd_map().
+    Returns:
+      the down sampled point cloud in open3d format.
+  """
   pcd_map = o3d.geometry.PointCloud()
   for idx in tqdm(range(len(scan_paths))):
     curren_points = utils.load_vertex(scan_paths[idx])
@@ -43,15 +59,7 @@ def gen_pcd_map(poses, scan_paths, map_file,
     pcd_map += localcloud
   
   print('Downsampling with voxel size of: ', voxel_size)
-  pcd_map = pcd_map.voxel_down_sample(voxel_size)
-  o3d.io.write_point_cloud(map_file, pcd_map)
-  print('Finished and saved the map in: ', map_file)
-  
-  # visualize pcd map
-  if vis_map:
-    o3d.visualization.draw_geometries([pcd_map])
-  
-  return pcd_map
+  return pcd_map.voxel_down_sample(voxel_size)
 
 
 def gen_grid(virtual_scan_folder, file_name, point_cloud_points, range_image_params):
@@ -84,6 +92,67 @@ def crop_cloud_with_bbox(cloud, center=[0, 0], length=50, width=50, height=5):
   return cloud.crop(bbox)
 
 
+def grid_file_name(x_global, y_global):
+  """ The file name of a grid (without extension) given its real coordinates.
+  """
+  new_x = str('{:+.2f}'.format(x_global)).zfill(10)
+  new_y = str('{:+.2f}'.format(y_global)).zfill(10)
+  return new_x + '_' + new_y
+
+
+def gen_grid_scan(pcd_map, virtual_scan_folder, x_global, y_global, z, range_image_params):
+  """ Generate the virtual scan of a grid from the global map, an existing scan is replaced.
+    Args:
+      pcd_map: the global point cloud map.
+      virtual_scan_folder: path of virtual scan folder.
+      x_global, y_global: real coordinates of the grid.
+      z: the height of the virtual sensor.
+      range_image_params: parameters for generating a range image.
+  """
+  grid_pose = np.identity(4)
+  pcd_map_tmp = crop_cloud_with_bbox(pcd_map, center=[x_global, y_global])
+  
+  grid_pose[0, 3] = x_global
+  grid_pose[1, 3] = y_global
+  grid_pose[2, 3] = z
+  current_points = np.array(pcd_map_tmp.points)
+  homo_points = np.ones((current_points.shape[0], current_points.shape[1] + 1), dtype=np.float32)
+  homo_points[:, :-1] = current_points
+  homo_points = np.linalg.inv(grid_pose).dot(homo_points.T).T
+  
+  gen_grid(virtual_scan_folder, grid_file_name(x_global, y_global), homo_points, range_image_params)
+
+
+def rasterize_poses(xyzs, grid_res, offset):
+  """ The grids inside a square of (2 * offset) around each pose, see rasterize_map().
+    Args:
+      xyzs: nx3 numpy array of positions of the poses.
+      grid_res: the resolution of the grids.
+      offset: the offset of the border.
+    Returns:
+      mx2 numpy array of integer grid coordinates (in the order of the first pose reaching them)
+      and the height of the pose which reaches a grid first.
+  """
+  min_x = int(np.round((np.min(xyzs[:, 0]) - offset) / grid_res))
+  max_x = int(np.round((np.max(xyzs[:, 0]) + offset) / grid_res))
+  min_y = int(np.round((np.min(xyzs[:, 1]) - offset) / grid_res))
+  max_y = int(np.round((np.max(xyzs[:, 1]) + offset) / grid_res))
+  
+  loc_coords = np.arange(-offset, offset + grid_res, grid_res)
+  grid_xs = np.round((xyzs[:, 0, None, None] + loc_coords[None, :, None]) / grid_res).astype(np.int64)
+  grid_ys = np.round((xyzs[:, 1, None, None] + loc_coords[None, None, :]) / grid_res).astype(np.int64)
+  grid_xs, grid_ys = np.broadcast_arrays(grid_xs, grid_ys)
+  grid_coords = np.stack([grid_xs.reshape(-1), grid_ys.reshape(-1)], axis=1)
+  frame_idxes = np.repeat(np.arange(len(xyzs)), len(loc_coords) ** 2)
+  inside = ((grid_coords[:, 0] >= min_x) & (grid_coords[:, 0] <= max_x) &
+            (grid_coords[:, 1] >= min_y) & (grid_coords[:, 1] <= max_y))
+  grid_coords, frame_idxes = grid_coords[inside], frame_idxes[inside]
+  
+  _, first = np.unique(grid_coords, axis=0, return_index=True)
+  first = np.sort(first)
+  return grid_coords[first], xyzs[frame_idxes[first], 2]
+
+
 def rasterize_map(poses, pcd_map, virtual_scan_folder, grid_res, offset, range_image_params):
   """ Rasterize the global map into grids.
     Args:
@@ -98,6 +167,9 @@ def rasterize_map(poses, pcd_map, virtual_scan_folder, grid_res, offset, range_i
   if not os.path.exists(virtual_scan_folder):
     os.makedirs(virtual_scan_folder)
   
+  # existing virtual scans are listed once
+  existing = set(os.path.splitext(f)[0] for f in os.listdir(virtual_scan_folder))
+  
   # initialize a road look up table
   xyzs = poses[:, :3, 3]
   min_x = int(np.round((np.min(xyzs[:, 0]) - offset) / grid_res))
@@ -120,7 +192,6 @@ def rasterize_map(poses, pcd_map, virtual_scan_folder, grid_res, offset, range_i
   # fill in the road lookup table
   for frame_idx in tqdm(range(len(xyzs))):
     for loc_coord in loc_coords:
-      grid_pose = np.identity(4)
       # covert local grid coordinates to global coordinates with rounding
       x_global = round((xyzs[frame_idx, 0] + loc_coord[0]) / grid_res) * grid_res
       y_global = round((xyzs[frame_idx, 1] + loc_coord[1]) / grid_res) * grid_res
@@ -134,27 +205,14 @@ def rasterize_map(poses, pcd_map, virtual_scan_folder, grid_res, offset, range_i
       if grid_map_lut[lut_x, lut_y] < 1:
         grid_map_lut[lut_x, lut_y] = 1
         
-        new_x = str('{:+.2f}'.format(x_global)).zfill(10)
-        new_y = str('{:+.2f}'.format(y_global)).zfill(10)
-        file_name = new_x + '_' + new_y
+        file_name = grid_file_name(x_global, y_global)
         
         # check existence
-        if os.path.exists(os.path.join(virtual_scan_folder, file_name + '.npz')):
+        if file_name in existing:
           print('existing: ', file_name)
           continue
         
-        pcd_map_tmp = pcd_map
-        pcd_map_tmp = crop_cloud_with_bbox(pcd_map_tmp, center=[x_global, y_global])
-        
-        grid_pose[0, 3] = x_global
-        grid_pose[1, 3] = y_global
-        grid_pose[2, 3] = xyzs[frame_idx, 2]
-        current_points = np.array(pcd_map_tmp.points)
-        homo_points = np.ones((current_points.shape[0], current_points.shape[1] + 1), dtype=np.float32)
-        homo_points[:, :-1] = current_points
-        homo_points = np.linalg.inv(grid_pose).dot(homo_points.T).T
-        
-        gen_grid(virtual_scan_folder, file_name, homo_points, range_image_params)
+        gen_grid_scan(pcd_map, virtual_scan_folder, x_global, y_global, xyzs[frame_idx, 2], range_image_params)
 
 
 if __name__ == '__main__':
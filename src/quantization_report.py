@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: report the deviation of the overlaps and yaws of int8 quantized feature volumes from float32.
+
+import os
+import sys
+import json
+import yaml
+import numpy as np
+
+import utils
+from feature_volume_store import FeatureVolumeStore, store_exists
+from head_inference import create_fast_infer
+
+
+def load_yaml(filename):
+  if yaml.__version__ >= '5.1':
+    return yaml.load(open(filename), Loader=yaml.FullLoader)
+  return yaml.load(open(filename))
+
+
+def quantize_store(source_folder, folder, quantization, batch_size=1024):
+  """ Write an int8 copy of a float32 feature volume store.
+    Args:
+      source_folder: the folder of the float32 store.
+      folder: the folder of the int8 store, it is replaced if it exists.
+      quantization: 'volume' or 'channel'.
+    Returns:
+      the int8 store and the source store.
+  """
+  source = FeatureVolumeStore(source_folder)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  # the records are copied in the order of the source records
+  order = np.argsort(source.records)
+  keys, source_records = source.keys[order], source.records[order]
+  store = FeatureVolumeStore.create(folder, keys, source.volume_shape, source.resolution, np.int8, quantization)
+  records = store.lookup(keys)
+  for start in range(0, len(source), batch_size):
+    store.copy_records(records[start:start + batch_size], source, source_records[start:start + batch_size])
+  store.finalize()
+  return store, source
+
+
+def volume_deviation(store, source, batch_size=1024):
+  """ Returns: the rms and the maximal absolute deviation of the dequantized volumes from float32,
+    the rms relative to the rms of the float32 volumes.
+  """
+  order = np.argsort(source.records)
+  source_records = source.records[order]
+  records = store.lookup(source.keys[order])
+  squared_error = 0.
+  squared_sum = 0.
+  max_error = 0.
+  for start in range(0, len(source), batch_size):
+    reference = np.asarray(source.read(source_records[start:start + batch_size]), dtype=np.float64)
+    errors = store.read(records[start:start + batch_size]) - reference
+    squared_error += np.sum(errors ** 2)
+    squared_sum += np.sum(reference ** 2)
+    max_error = max(max_error, float(np.max(np.abs(errors))))
+  rms = np.sqrt(squared_error / max(1, len(source) * np.prod(source.volume_shape)))
+  return {'rms': float(rms), 'relative_rms': float(np.sqrt(squared_error / max(squared_sum, 1e-30))),
+          'max': max_error}
+
+
+def reference_pairs(config, report_config, map_store, query_store):
+  """ The evaluated pairs: every frame_step-th query frame and the map grids within radius of its pose.
+    Returns:
+      list of (frame index, nx2 integer grid coordinates).
+  """
+  poses = utils.load_lidar_poses(config['pose_file'], config['calib_file'])
+  grid_coords = map_store.keys
+  real_coords = grid_coords * map_store.resolution
+  pairs = []
+  for frame_idx in query_store.keys[::report_config.get('frame_step', 10)]:
+    if frame_idx >= len(poses):
+      continue
+    distances = np.hypot(*(real_coords - poses[frame_idx, :2, 3]).T)
+    nearby = distances <= report_config.get('radius', 10.)
+    if np.any(nearby):
+      pairs.append((int(frame_idx), grid_coords[nearby]))
+  return pairs
+
+
+def infer_reference(model, pairs):
+  """ Returns: the overlaps and the yaw bins of all pairs (concatenated).
+  """
+  outputs = [model.infer_pairs(frame_idx, grid_coords, model.lookup_cells(grid_coords))
+             for frame_idx, grid_coords in pairs]
+  return np.concatenate([overlaps for overlaps, _ in outputs]), np.concatenate([yaws for _, yaws in outputs])
+
+
+def compare(reference, quantized, yaw_bins, min_overlap_for_yaw):
+  """ Returns: dict with the deviation of the overlaps and of the yaws (in bins, circular)
+    of pairs with a reference overlap of at least min_overlap_for_yaw.
+  """
+  overlaps, yaws = reference
+  overlap_errors = np.abs(quantized[0] - overlaps)
+  with_yaw = overlaps >= min_overlap_for_yaw
+  yaw_errors = np.abs(quantized[1][with_yaw] - yaws[with_yaw]) % yaw_bins
+  yaw_errors = np.minimum(yaw_errors, yaw_bins - yaw_errors)
+  result = {'pairs': len(overlaps),
+            'overlap_mean': float(np.mean(overlap_errors)),
+            'overlap_p99': float(np.percentile(overlap_errors, 99)),
+            'overlap_max': float(np.max(overlap_errors)),
+            'yaw_pairs': int(np.sum(with_yaw))}
+  if len(yaw_errors) > 0:
+    result.update({'yaw_equal': float(np.mean(yaw_errors == 0)),
+                   'yaw_mean_bins': float(np.mean(yaw_errors)),
+                   'yaw_max_bins': int(np.max(yaw_errors))})
+  return result
+
+
+def run_report(config, report_config):
+  """ Quantize the map and query stores with every configured granularity and compare the head outputs
+    on the reference pairs with float32.
+    Returns: list of dicts with the results of every quantization.
+  """
+  # the workers are not needed for a single pass
+  config = dict(config, inference_workers=0)
+  map_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'])
+  query_folder = os.path.join(config['data_root_folder'], config['infer_seqs_query'])
+  for folder in [map_folder, query_folder]:
+    if not store_exists(folder):
+      raise FileNotFoundError('No packed feature volumes in %s, please run gen_feature_volumes.py.' % folder)
+
+  model = create_fast_infer(config)
+  map_store, query_store = FeatureVolumeStore(map_folder), FeatureVolumeStore(query_folder)
+  if map_store.quantization or query_store.quantization:
+    raise ValueError('The reference stores must be float32, set volume_dtype: float32 to generate them.')
+  pairs = reference_pairs(config, report_config, map_store, query_store)
+  print('Reference: %d frames, %d pairs' % (len(pairs), sum(len(grid_coords) for _, grid_coords in pairs)))
+  reference = infer_reference(model, pairs)
+  del model
+
+  results = []
+  for quantization in report_config.get('quantizations', ['volume', 'channel']):
+    root_folder = os.path.join(report_config['quantized_root_folder'], quantization)
+    result = {'quantization': quantization,
+              'float32_bytes': map_store.storage_bytes() + query_store.storage_bytes(),
+              'int8_bytes': 0}
+    for seq, source_folder in [('map', map_folder), ('query', query_folder)]:
+      seq_name = config['infer_seqs_' + seq]
+      store, source = quantize_store(source_folder, os.path.join(root_folder, seq_name), quantization)
+      result['int8_bytes'] += store.storage_bytes()
+      result[seq + '_volumes'] = volume_deviation(store, source)
+    model = create_fast_infer(dict(config, data_root_folder=root_folder))
+    result.update(compare(reference, infer_reference(model, pairs), report_config.get('yaw_bins', 360),
+                          report_config.get('min_overlap_for_yaw', 0.7)))
+    del model
+    results.append(result)
+    print_result(result)
+  return results
+
+
+def print_result(result):
+  print('%s quantization: %.1f MB instead of %.1f MB' %
+        (result['quantization'], result['int8_bytes'] / 1024.0 ** 2, result['float32_bytes'] / 1024.0 ** 2))
+  for seq in ['map', 'query']:
+    print('  %-5s volumes: relative rms error %.4f, max error %.4f' %
+          (seq, result[seq + '_volumes']['relative_rms'], result[seq + '_volumes']['max']))
+  print('  overlaps of %d pairs: mean deviation %.5f, p99 %.5f, max %.5f' %
+        (result['pairs'], result['overlap_mean'], result['overlap_p99'], result['overlap_max']))
+  if 'yaw_equal' in result:
+    print('  yaws of %d pairs: %.1f %% equal, mean deviation %.2f bins, max %d bins' %
+          (result['yaw_pairs'], 100. * result['yaw_equal'], result['yaw_mean_bins'], result['yaw_max_bins']))
+
+
+if __name__ == '__main__':
+  # load config file
+  report_filename = '../config/quantization_report.yml'
+  if len(sys.argv) > 1:
+    report_filename = sys.argv[1]
+  report_config = load_yaml(report_filename)
+  config = load_yaml(report_config['localization_config'])
+
+  results = run_report(config, report_config)
+
+  results_file = report_config.get('results_file', 'quantization_report.json')
+  with open(results_file, 'w') as f:
+    json.dump({'config': report_config, 'results': results}, f, indent=2)
+  print('Saved the quantization report to', results_file)
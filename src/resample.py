@@ -3,64 +3,134 @@
 # This file is covered by the LICENSE file in the root of this project.
 # Brief: resample the particles
 
+from scipy.stats import norm
 from utils import *
+from particle_set import ParticleSet
 
 
-def resample(particles):
-  """ Low variance re-sampling.
+def systematic_indexes(cum_weights, num_particles, rng):
+  """ Systematic (low variance) re-sampling: one random offset, evenly spaced pointers.
   """
-  weights = particles[:, 3]
+  positions = (rng.random(1) + np.arange(num_particles)) / num_particles
+  return np.searchsorted(cum_weights, positions)
+
+
+def stratified_indexes(cum_weights, num_particles, rng):
+  """ Stratified re-sampling: one random pointer in each of the num_particles strata.
+  """
+  positions = (rng.random(num_particles) + np.arange(num_particles)) / num_particles
+  return np.searchsorted(cum_weights, positions)
+
+
+def multinomial_indexes(cum_weights, num_particles, rng):
+  """ Multinomial re-sampling: independent random pointers.
+  """
+  return np.searchsorted(cum_weights, rng.random(num_particles))
+
+
+def residual_indexes(cum_weights, num_particles, rng):
+  """ Residual re-sampling: every particle is copied floor(num_particles * weight) times,
+    the remaining particles are drawn by multinomial re-sampling of the residual weights.
+  """
+  weights = np.diff(cum_weights, prepend=0.)
+  num_copies = np.floor(num_particles * weights).astype(np.int64)
+  indexes = np.repeat(np.arange(len(weights)), num_copies)
+  num_residual = num_particles - len(indexes)
+  if num_residual > 0:
+    residuals = num_particles * weights - num_copies
+    cum_residuals = np.cumsum(residuals)
+    cum_residuals /= cum_residuals[-1]
+    indexes = np.concatenate([indexes, multinomial_indexes(cum_residuals, num_residual, rng)])
+  return indexes
+
+
+RESAMPLING_SCHEMES = {'systematic': systematic_indexes,
+                      'stratified': stratified_indexes,
+                      'multinomial': multinomial_indexes,
+                      'residual': residual_indexes}
+
+
+def resample(particles, num_particles=None, scheme='systematic'):
+  """ Re-sampling of the particles, only done if the effective number of particles is below the half.
+    Args:
+      particles: the particles (ParticleSet), the random numbers are drawn from its Generator.
+      num_particles: size of the new particle set (e.g. given by limit()). If None, the size is kept.
+        A new size always triggers resampling.
+      scheme: 'systematic' (low variance, default), 'stratified', 'multinomial' or 'residual'.
+    Returns:
+      the same particles, the new ones are written into its back buffer.
+  """
+  if scheme not in RESAMPLING_SCHEMES:
+    raise ValueError('Unknown resampling scheme %s, use one of %s' % (scheme, list(RESAMPLING_SCHEMES.keys())))
+  if num_particles is None:
+    num_particles = len(particles)
+  weights = particles.weight
   
-  # normalize the weights
-  weights = weights / sum(weights)
+  # normalized cumulative weights (accumulated in double precision)
+  cum_weights = np.cumsum(weights, dtype=np.float64)
+  total_weight = cum_weights[-1]
+  cum_weights /= total_weight
   
   # compute effective number of particles
-  eff_N = 1 / sum(weights ** 2)
+  eff_N = total_weight ** 2 / np.dot(weights, weights)
+  if eff_N >= len(particles) * 1.0 / 2.0 and num_particles == len(particles):
+    return particles
   
-  # resample
-  new_particles = np.zeros(particles.shape)
-  i = 0
-  if eff_N < len(particles)*1.0/2.0:
-    r = np.random.rand(1) * 1.0/len(particles)
-    c = weights[0]
-    for idx in range(len(particles)):
-      u = r + idx/len(particles)
-      while u > c:
-        if i >= len(particles) - 1:
-          break
-        i += 1
-        c += weights[i]
-      new_particles[idx] = particles[i]
-  else:
-    new_particles = particles
-    
-  return new_particles
-
-
-def limit(particles, map_size):
-  kld_z = 0.01
-  precomputed_epsilon_factor = 0.02
+  indexes = RESAMPLING_SCHEMES[scheme](cum_weights, num_particles, particles.rng)
+  # pointers behind the last cumulative weight (rounding) select the last particle
+  np.minimum(indexes, len(particles) - 1, out=indexes)
   
-  x_min = round(map_size[0])
-  x_max = round(map_size[1])
-  y_min = round(map_size[2])
-  y_max = round(map_size[3])
-  # create a grid files lookup table
-  grid_paths_lut = np.full(((y_max - y_min)*2, (x_max - x_min))*2, 0, dtype=int)
-
-  coords = particles[:, :2]
-  
-  map_xs = np.round(y_max - coords[:, 1]).astype(int)
-  map_ys = np.round(coords[:, 0] - x_min).astype(int)
+  particles.select(indexes)
+  return particles
+
 
-  grid_paths_lut[map_xs, map_ys] = 1
-  cells_with_data = np.count_nonzero(grid_paths_lut)
+def kld_params(config, grid_res, num_particles):
+  """ The parameters of limit() given by the configuration (config['kld_bin_size'] in meters,
+    config['kld_bin_angle'] in degrees, config['kld_epsilon'], config['kld_delta'],
+    config['kld_min_particles'] and config['kld_max_particles']).
+    Args:
+      config: configuration parameters of the localization.
+      grid_res: the resolution of the grids.
+      num_particles: the default of the maximal number of particles.
+    Returns:
+      dict with the keyword arguments of limit().
+  """
+  return {'bin_size': config.get('kld_bin_size', 1.0) / grid_res,
+          'bin_angle': config.get('kld_bin_angle', 10.) * np.pi / 180.,
+          'epsilon': config.get('kld_epsilon', 0.05),
+          'delta': config.get('kld_delta', 0.01),
+          'min_particles': config.get('kld_min_particles', 200),
+          'max_particles': config.get('kld_max_particles', num_particles)}
+
+
+def limit(particles, bin_size=1.0, bin_angle=np.pi / 18, epsilon=0.05, delta=0.01,
+          min_particles=100, max_particles=100000):
+  """ KLD-sampling: the number of particles which is needed such that, with probability 1 - delta,
+    the error between the sample-based and the true posterior is below epsilon (Fox, 2003).
+    The posterior is approximated by the histogram of the particles over bins of (x, y, theta).
+    Args:
+      particles: the particles (ParticleSet).
+      bin_size: size of the bins in x and y (in grid units).
+      bin_angle: size of the bins in theta (in radian).
+      epsilon: bound of the Kullback-Leibler distance.
+      delta: probability that the bound is violated.
+      min_particles, max_particles: limits of the number of particles.
+    Returns:
+      the number of particles.
+  """
+  bins = np.c_[np.floor(particles.x / bin_size),
+               np.floor(particles.y / bin_size),
+               np.floor(np.mod(particles.theta, 2 * np.pi) / bin_angle)].astype(np.int64)
+  cells_with_data = len(np.unique(bins, axis=0))
+  if cells_with_data < 2:
+    return min_particles
   
+  kld_z = norm.ppf(1 - delta)
   common = 2.0 / (9 * (cells_with_data - 1))
-  to_be_cubed = 1 - common - np.sqrt(common) * kld_z
-  result = ((cells_with_data - 1) / precomputed_epsilon_factor) * to_be_cubed * to_be_cubed * to_be_cubed
+  to_be_cubed = 1 - common + np.sqrt(common) * kld_z
+  result = ((cells_with_data - 1) / (2 * epsilon)) * to_be_cubed * to_be_cubed * to_be_cubed
   
-  return int(result)
+  return int(np.clip(np.ceil(result), min_particles, max_particles))
   
   
 def test_sampling():
@@ -68,8 +138,8 @@ def test_sampling():
   particles = np.array([[1, 0, 0, 1], [0, 0, 0, 0.5], [0, 0, 0, 0.1],
                         [0, 0, 0, 0.3], [0, 1, 0, 1], [0, 0, 0, 0.5]])
   
-  particles = resample(particles)
-  print(particles)
+  particles = resample(ParticleSet.from_array(particles))
+  print(particles.to_array())
 
 
 def test_limit():
@@ -77,16 +147,14 @@ def test_limit():
   # near particles
   particles = np.array([[1, 0, 0, 1], [0, 0, 0, 0.5], [0, 0, 0, 0.1],
                         [0, 0, 0, 0.3], [0, 1, 0, 1], [0, 0, 0, 0.5]])
-  mapsize = [-5, 5, -10, 10]
-  
-  k = limit(particles, mapsize)
+  k = limit(ParticleSet.from_array(particles))
   print(k)
   
   # far particles
   particles = np.array([[1, 0, 0, 1], [2, 0, 0, 0.5], [3, 0, 0, 0.1],
                         [-1, 0, 0, 0.3], [-2, 1, 0, 1], [-3, 0, 0, 0.5]])
 
-  k = limit(particles, mapsize)
+  k = limit(ParticleSet.from_array(particles))
   print(k)
   
   
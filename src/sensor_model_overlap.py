@@ -3,10 +3,13 @@
 # This file is covered by the LICENSE file in the root of this project.
 # Brief: this is the sensor model for overlap-based Monte Carlo localization.
 #        This model use grid map, where each grid contains a virtual frame.
-import os
+import time
 import numpy as np
 import matplotlib.pyplot as plt
-from fast_infer import FastInfer
+from head_inference import create_fast_infer
+from map_manifest import load_map_manifest, load_map_pyramid
+from prefetcher import FeatureVolumePrefetcher
+from stage_timer import timer
 
 
 class SensorModel():
@@ -15,11 +18,13 @@ class SensorModel():
     frame for each grid after discretization. We use OverlapNet estimate the overlaps between the current frame and
     the grid virtual frames and use the predictions as the observation measurement.
   """
-  def __init__(self, config, mapsize, map_folder):
+  def __init__(self, config, mapsize, map_folder, model=None, manifest=None):
     """ initialization:
       config_file: the configuration file of the OverlapNet
       mapsize: the size of the given map
       map_folder: the folder contains the feature volume map
+      model: an already loaded FastInfer, e.g. shared by several runs. If None, it is created.
+      manifest: an already loaded map manifest. If None, it is loaded from map_folder.
     """
     # because we round the coordinates of particles, therefore it is safer to have an offset to the border
     self.offset = 1
@@ -27,28 +32,39 @@ class SensorModel():
     self.x_max = round(mapsize[1])
     self.y_min = round(mapsize[2])
     self.y_max = round(mapsize[3])
-    # create a grid files lookup table
-    self.grid_paths_lut = np.full((self.y_max - self.y_min + self.offset,
-                                   self.x_max - self.x_min + self.offset), 0, dtype=np.object)
     
     # map resolution
     self.resolution = config['resolution']
 
-    # initialize fast infer
-    self.model = FastInfer(config, cache_size=50000)
+    # initialize fast infer, the feature volume cache is sized by config['cache_bytes'].
+    # The backend is given by config['head_backend'], a given model (e.g. the stub of benchmark.py) needs none.
+    if model is None:
+      model = create_fast_infer(config)
+    self.model = model
     
-    # for check the file existing
+    # the map manifest tells which grids have a feature volume
     self.map_folder = map_folder
+    self.manifest = manifest if manifest is not None else load_map_manifest(map_folder, self.resolution)
+    self.coords = self.manifest.real_coords()
     
-    # get grid coords
-    self.coords = []
-    feature_paths = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-      os.path.expanduser(self.map_folder)) for f in fn]
-    feature_paths.sort()
-    feature_paths = np.array(feature_paths)
-    for feature_path in feature_paths:
-      self.coords.append(os.path.basename(feature_path).replace('.npz', '').split('_'))
-    self.coords = np.array(self.coords, dtype=float)
+    # coarse-to-fine map pyramid: coarse levels are used while the particle cloud is spread out.
+    # The level is the coarsest one whose spread threshold (meters) is below the spread of the cloud.
+    self.levels = [self.manifest]
+    self.level_spreads = []
+    if config.get('pyramid_levels'):
+      self.levels = load_map_pyramid(map_folder, self.manifest, config['pyramid_levels'])
+      self.level_spreads = config['pyramid_spreads']
+      if len(self.level_spreads) != len(self.levels) - 1 or self.levels[-1] is not self.manifest:
+        raise ValueError('pyramid_levels must end with the map resolution and pyramid_spreads needs '
+                         'one threshold per coarse level.')
+    self.level = None
+    
+    # optionally warm the feature volume cache for the next frames in background threads
+    self.prefetcher = None
+    if config.get('prefetch', False) and not hasattr(self.model, 'volume_cache'):
+      print('Prefetching is not supported with inference workers, the caches of the workers are filled on demand.')
+    elif config.get('prefetch', False):
+      self.prefetcher = FeatureVolumePrefetcher(self.model.volume_cache, self.manifest, config)
     
     # check whether correct yaw angle
     self.use_yaw = config['use_yaw']
@@ -56,110 +72,211 @@ class SensorModel():
       
     self.is_converged = False
     self.num_reduced = config['num_reduced']
+    # with KLD-sampling the number of particles adapts continuously, thus they are not reduced at convergence
+    self.reduce_on_convergence = not config.get('kld_sampling', False)
     self.converge_thres = config['converge_thres']
     self.min_overlap_for_angle = config['min_overlap_for_angle']
+    # up to this number of grids, the low-latency inference path is used
+    self.low_latency_cells = config.get('low_latency_cells', 64)
+    
+    # latency budget of the inference per frame in seconds (0: no budget). The grids are inferred in chunks,
+    # ordered by the weight of their particles, until the budget is spent.
+    self.latency_budget = config.get('latency_budget_ms', 0) / 1000.
+    self.budget_chunk_cells = config.get('budget_chunk_cells', 256)
+    # grids which were not inferred within the budget (last frame and in total)
+    self.num_skipped_cells = 0
+    self.total_skipped_cells = 0
     
     # parameters for weight updating
     self.default_weight = 0.1
     self.invalid_weight = 0.001
 
-  def update_weights(self, particles, frame_idx):
-    """ This function update the weight for each particle using batch.
+  def prefetch(self, particles, command):
+    """ Queue the loading of feature volumes the particles are likely to need in the next frames.
+      Should be called after the motion model, the loading runs while the current frame is inferred.
       Args:
-        particles: each particle has four properties [x, y, theta, weight]
-        measurements: overlap heatmaps
-      Returns:
-        particles ... same particles with changed particles(i).weight
+        particles: the particles (ParticleSet).
+        command: the current command [rot1 trasl rot2]
     """
-  
-    # lookup table for overlap, for every current frame the lookup tables are different
-    # We therefore initialize it for every current frame
-    overlap_lut = np.full((self.y_max - self.y_min + 1, self.x_max - self.x_min + 1), -1, dtype=np.float32)
-    new_particle = particles
-    infer_coords = []
-    overlap_idxes = 0
+    if self.prefetcher is not None:
+      self.prefetcher.schedule(particles, command)
 
-    # first collect the grid indexes to calculate overlaps
-    for idx in range(len(particles)):
-      particle = particles[idx]
-      x = int(round(particle[0]))
-      y = int(round(particle[1]))
-
-      # check whether there is feature volume
-      real_x = x * self.resolution
-      real_y = y * self.resolution
-      new_x = str('{:+.2f}'.format(real_x)).zfill(10)
-      new_y = str('{:+.2f}'.format(real_y)).zfill(10)
-      file_name = new_x + '_' + new_y + '.npz'
+  def shutdown(self):
+    """ Stop the background threads of this sensor model (the shared model is not touched).
+    """
+    if self.prefetcher is not None:
+      self.prefetcher.shutdown()
 
-      path = os.path.join(self.map_folder, file_name)
-      if not os.path.exists(path):
-        continue
+  def select_level(self, particles):
+    """ Select the level of the map pyramid given the spread of the particles.
+      Returns: the manifest of the level.
+    """
+    level_idx = len(self.levels) - 1
+    if len(self.level_spreads) > 0:
+      weights = particles.weight.astype(np.float64)
+      weights = weights / np.sum(weights)
+      var_x = np.dot(weights, (particles.x - np.dot(weights, particles.x)) ** 2)
+      var_y = np.dot(weights, (particles.y - np.dot(weights, particles.y)) ** 2)
+      spread = np.sqrt(var_x + var_y) * self.resolution
+      level_idx = next((i for i, thres in enumerate(self.level_spreads) if spread > thres), level_idx)
+    
+    if self.levels[level_idx] is not self.level:
+      self.level = self.levels[level_idx]
+      if len(self.levels) > 1:
+        print('Map pyramid level: %.2f m' % self.level.resolution)
+    return self.level
 
-      # check a grid sampled or not
-      check_flag = overlap_lut[int(self.y_max - y), int(x - self.x_min)]
-      if check_flag < 0:
-        infer_coords.append([real_x, real_y])
-        overlap_lut[int(self.y_max - y), int(x - self.x_min)] = overlap_idxes
-        overlap_idxes += 1
+  def infer_within_budget(self, frame_idx, cell_coords, cell_weights, query_volume, t_start):
+    """ Infer the grids in the order of their weight until the latency budget is spent.
+      At least one chunk of grids is always inferred.
+      Args:
+        frame_idx: index of the current scan.
+        cell_coords: integer coordinates of the grids.
+        cell_weights: the total weight of the particles in each grid.
+        query_volume: feature volume of the current scan (or None).
+        t_start: start time of the frame (time.perf_counter()).
+      Returns:
+        overlaps and yaws of the grids (zero for skipped grids) and a boolean mask of the inferred grids.
+    """
+    overlaps = np.zeros(len(cell_coords), dtype=np.float32)
+    yaws = np.zeros(len(cell_coords), dtype=np.int64)
+    is_inferred = np.zeros(len(cell_coords), dtype=bool)
+    order = np.argsort(-cell_weights, kind='stable')
+    
+    chunk_time = 0.
+    for start in range(0, len(order), self.budget_chunk_cells):
+      # stop if the next chunk is expected to exceed the budget
+      if start > 0 and time.perf_counter() - t_start + chunk_time > self.latency_budget:
+        break
+      t_chunk = time.perf_counter()
+      chunk = order[start:start + self.budget_chunk_cells]
+      overlaps[chunk], yaws[chunk] = self.model.infer_overlaps(frame_idx, cell_coords[chunk],
+                                                               query_volume, self.low_latency_cells)
+      is_inferred[chunk] = True
+      chunk_time = time.perf_counter() - t_chunk
+    
+    return overlaps, yaws, is_inferred
 
-    # if no new inferring, skip the weight updating
-    if len(infer_coords) == 0:
-      return particles
-    
-    # inferring overlaps
-    infer_coords = np.array(infer_coords)
-    results_overlapnet = self.model.infer_multiple(frame_idx, infer_coords)
-    overlaps = results_overlapnet[0]
+  def update_weights(self, particles, frame_idx, query_volume=None):
+    """ This function update the weight for each particle using batch.
+      All particles are processed at once: the grids of the particles are converted into integer keys,
+      every distinct grid is inferred only once and the results are scattered back to the particles.
+      With a latency budget, grids which are not inferred in time get a neutral likelihood:
+      the mean likelihood of the particles in inferred grids.
+      Args:
+        particles: the particles (ParticleSet), the weights are updated in place.
+        frame_idx: index of the current scan.
+        query_volume: feature volume of the current scan computed online (see live_query.py).
+          If None, the precomputed feature volume of frame_idx is used.
+      Returns:
+        particles ... same particles with changed weights
+    """
+    t_start = time.perf_counter()
+    xs, ys, thetas, weights = particles.x, particles.y, particles.theta, particles.weight
+    
+    # the level of the map pyramid (the map itself without pyramid)
+    level = self.select_level(particles)
+    
+    with timer.stage('cell_lookup'):
+      # first collect the grid indexes to calculate overlaps
+      if level is self.manifest:
+        grid_xs = np.round(xs).astype(np.int64)
+        grid_ys = np.round(ys).astype(np.int64)
+      else:
+        scale = self.resolution / level.resolution
+        grid_xs = np.round(xs * scale).astype(np.int64)
+        grid_ys = np.round(ys * scale).astype(np.int64)
+    
+      # check whether there is feature volume
+      has_volume = level.contains(grid_xs, grid_ys)
+    
+      # if no new inferring, skip the weight updating
+      if not np.any(has_volume):
+        return particles
+    
+      # each grid is sampled only once, grid_idxes maps the particles to the sampled grids
+      grid_keys = level.grid_keys(grid_xs[has_volume], grid_ys[has_volume])
+      unique_keys, grid_idxes = np.unique(grid_keys, return_inverse=True)
+      grid_idxes = grid_idxes.reshape(-1)
+    
+    timer.count('cells', len(unique_keys))
+    
+    # inferring overlaps, few grids (e.g. after convergence) use the low-latency path,
+    # pairs of earlier runs are taken from the overlap memo.
+    # Grids of a coarse level are represented by the feature volume of one grid of the map.
+    cell_coords = level.representative_coords(unique_keys)
+    self.num_skipped_cells = 0
+    with timer.stage('inference'):
+      if self.latency_budget > 0:
+        cell_weights = np.bincount(grid_idxes, weights=weights[has_volume], minlength=len(unique_keys))
+        overlaps, yaws, is_inferred = self.infer_within_budget(frame_idx, cell_coords, cell_weights,
+                                                               query_volume, t_start)
+        self.num_skipped_cells = int(np.count_nonzero(~is_inferred))
+        self.total_skipped_cells += self.num_skipped_cells
+      else:
+        overlaps, yaws = self.model.infer_overlaps(frame_idx, cell_coords, query_volume, self.low_latency_cells)
+    timer.count('cells_skipped', self.num_skipped_cells)
     if self.use_yaw:
-      yaws = np.argmax(results_overlapnet[1], axis=1)
       yaws = - (yaws - 180.) * np.pi / 180.  # convert from OverlapNet output to real yaw
     
-    # update particle weights
-    all_overlaps = np.ones(len(particles)) * self.default_weight
-    all_yaws = np.ones(len(particles)) * self.default_weight
-    for idx in range(len(particles)):
-      particle = particles[idx]
-      if particle[0] < self.x_min + self.offset or particle[0] > self.x_max - self.offset \
-        or particle[1] < self.y_min + self.offset or particle[1] > self.y_max - self.offset:
-        overlap = self.invalid_weight
-      else:
-        # update overlap
-        x = int(round(particle[0]))
-        y = int(round(particle[1]))
-        overlap_idx = overlap_lut[int(self.y_max - y), int(x - self.x_min)]
-        if overlap_idx < 0:
-          continue
-        overlap = overlaps[int(overlap_idx)]
-        if self.use_yaw:
-          if overlap >= self.min_overlap_for_angle:
-            delta_yaw = min(abs(yaws[int(overlap_idx)] - particle[2]),
-                            2*np.pi - abs(yaws[int(overlap_idx)] - particle[2]))
-            all_yaws[idx] = np.exp(-0.5 * delta_yaw * delta_yaw / (self.yaw_sigma * self.yaw_sigma))
-        
-      all_overlaps[idx] = overlap
-
-    # update the weights of the particles
+    # particles outside the borders of the map get an invalid weight
+    out_of_map = (xs < self.x_min + self.offset) | (xs > self.x_max - self.offset) | \
+                 (ys < self.y_min + self.offset) | (ys > self.y_max - self.offset)
+    is_valid = ~out_of_map[has_volume]
+    particle_idxes = np.flatnonzero(has_volume)[is_valid]
+    grid_idxes = grid_idxes[is_valid]
+    
+    # likelihood of the particles from the overlaps (and yaws), computed in the scratch buffer
+    factors, yaw_factors = particles.scratch(2)
+    factors.fill(self.default_weight)
+    factors[particle_idxes] = overlaps[grid_idxes]
+    factors[out_of_map] = self.invalid_weight
+    
     if self.use_yaw:
       # update weight also use yaw angle estimation
-      new_particle[:, 3] = new_particle[:, 3] * all_overlaps * all_yaws
+      use_angle = overlaps[grid_idxes] >= self.min_overlap_for_angle
+      angle_idxes = particle_idxes[use_angle]
+      diff_yaws = np.abs(yaws[grid_idxes[use_angle]] - thetas[angle_idxes])
+      delta_yaws = np.minimum(diff_yaws, 2 * np.pi - diff_yaws)
+      yaw_factors.fill(self.default_weight)
+      yaw_factors[angle_idxes] = np.exp(-0.5 * delta_yaws * delta_yaws / (self.yaw_sigma * self.yaw_sigma))
+      factors *= yaw_factors
+    
+    # particles in skipped grids get the mean likelihood of the particles in inferred grids
+    if self.num_skipped_cells > 0:
+      is_skipped = ~is_inferred[grid_idxes]
+      inferred_idxes = particle_idxes[~is_skipped]
+      factors[particle_idxes[is_skipped]] = np.mean(factors[inferred_idxes]) if len(inferred_idxes) > 0 \
+                                            else self.default_weight
+    
+    # update the weights of the particles, normalized in float64 before they are stored as float32
+    # (the products of small likelihoods underflow in float32). If all likelihoods vanish,
+    # the particles keep equal weights.
+    factors *= weights
+    max_factor = np.max(factors) if len(factors) > 0 else 0.
+    if max_factor > 0:
+      factors /= max_factor
     else:
-      new_particle[:, 3] = new_particle[:, 3] * all_overlaps
+      factors.fill(1.)
+    weights[:] = factors
 
-    # check convergence using the number of occupied grids
-    occupied_grid = overlap_lut[overlap_lut > 0]
-    if len(occupied_grid) < self.converge_thres and not self.is_converged:
+    # check convergence using the number of occupied grids of the map (the first sampled grid is not counted)
+    if level is self.manifest:
+      num_occupied_grids = len(unique_keys) - 1
+    else:
+      fine_xs = np.round(xs).astype(np.int64)
+      fine_ys = np.round(ys).astype(np.int64)
+      is_occupied = self.manifest.contains(fine_xs, fine_ys)
+      num_occupied_grids = len(np.unique(self.manifest.grid_keys(fine_xs[is_occupied], fine_ys[is_occupied]))) - 1
+    if num_occupied_grids < self.converge_thres and not self.is_converged:
       self.is_converged = True
       print('Converged!')
   
-      idxes = np.argsort(new_particle[:, 3])[::-1]
-      if not self.num_reduced > len(new_particle) or self.num_reduced < 0:
-        new_particle = new_particle[idxes[:self.num_reduced]]
-        
-    # normalization
-    new_particle[:, 3] = new_particle[:, 3] / np.max(new_particle[:, 3])
+      idxes = np.argsort(weights)[::-1]
+      if self.reduce_on_convergence and (not self.num_reduced > len(particles) or self.num_reduced < 0):
+        particles.select(idxes[:self.num_reduced])
   
-    return new_particle
+    return particles
     
   def save_error_map(self, error_map, frame_idx):
     """ This function generate error maps,
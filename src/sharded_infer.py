@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: spatially sharded inference of the head in a pool of worker processes.
+
+import multiprocessing
+import numpy as np
+
+from feature_volume_store import FeatureVolumeStore
+from head_inference import HeadInference, create_fast_infer
+from overlap_memo import OverlapMemo
+
+
+def run_shard_worker(config, cache_size, connection):
+  """ The loop of a worker process: it owns a model with its own feature volume cache
+    and infers the grids of its tiles of the map.
+  """
+  from overlap_memo import weights_hash
+  model = create_fast_infer(config, cache_size)
+  connection.send(('ready', weights_hash([model.head])))
+  while True:
+    request = connection.recv()
+    if request[0] == 'infer':
+      _, frame_idx, grid_coords, map_records, query_volume, low_latency_cells = request
+      connection.send(model.infer_pairs(frame_idx, grid_coords, map_records, query_volume, low_latency_cells))
+    elif request[0] == 'statistics':
+      connection.send(model.cache_statistics())
+    else:
+      break
+  connection.close()
+
+
+class ShardedInfer(HeadInference):
+  """ This class distributes the inference of the grids of a frame to worker processes.
+    The map is divided into square tiles and every tile belongs to one worker, thus a worker always
+    sees the same grids and its slice of the feature volume cache (cache_bytes / workers) keeps them.
+    The grids of a frame are sent to all workers at once and the overlaps and yaws are gathered in order.
+    The overlap memo is kept in this process, the workers only infer new pairs.
+  """
+  def __init__(self, config, num_workers):
+    """ Initialization, the workers are started (forked) and load the model.
+      config: configuration parameters, used attributes:
+        'resolution', 'data_root_folder', 'infer_seqs_map', 'infer_seqs_query',
+        'shard_tile_size': edge length of the tiles in meters (default 20 m),
+        'cache_bytes': memory budget of the caches of all workers, 'overlap_memo_folder'.
+      num_workers: number of worker processes.
+    """
+    self.resolution = config['resolution']
+    self.num_workers = num_workers
+    self.tile_cells = max(1, int(round(config.get('shard_tile_size', 20.) / self.resolution)))
+    self.datasetpath_map = config['data_root_folder'] + '/' + config['infer_seqs_map']
+    self.datasetpath_query = config['data_root_folder'] + '/' + config['infer_seqs_query']
+    self.map_store = None
+    self.query_store = None
+    self.memo_folder = config.get('overlap_memo_folder', '')
+    self.memo = None
+    # the precision of the volumes fed to the head by the caches of the workers, part of the key of the memo
+    self.cache_dtype = np.dtype(config.get('cache_dtype', 'float32'))
+
+    # every worker gets its slice of the memory budget of the cache
+    worker_config = dict(config)
+    worker_config['overlap_memo_folder'] = ''
+    worker_config['inference_workers'] = 0
+    worker_config['cache_bytes'] = int(config.get('cache_bytes', 4 * 1024 ** 3)) // num_workers
+
+    # fork: the workers load the network themselves, thus it must not be loaded in this process before
+    context = multiprocessing.get_context('fork')
+    self.connections = []
+    self.workers = []
+    for _ in range(num_workers):
+      connection, worker_connection = context.Pipe()
+      worker = context.Process(target=run_shard_worker, args=(worker_config, None, worker_connection), daemon=True)
+      worker.start()
+      self.connections.append(connection)
+      self.workers.append(worker)
+    head_hashes = [connection.recv()[1] for connection in self.connections]
+    self.head_hash = head_hashes[0]
+    print('Started %d inference workers (tiles of %d grids)' % (num_workers, self.tile_cells))
+
+  def open_stores(self):
+    if self.map_store is None:
+      self.map_store = FeatureVolumeStore(self.datasetpath_map)
+      self.query_store = FeatureVolumeStore(self.datasetpath_query)
+
+  def lookup_cells(self, grid_coords):
+    self.open_stores()
+    return self.map_store.lookup(grid_coords)
+
+  def lookup_query(self, idx_current_frame):
+    self.open_stores()
+    return int(self.query_store.lookup(np.array([idx_current_frame]))[0])
+
+  def open_memo(self):
+    if self.memo is None and self.memo_folder:
+      self.open_stores()
+      self.memo = OverlapMemo(self.memo_folder, self.head_hash, self.map_store.lineage, self.query_store.lineage,
+                              self.cache_dtype)
+    return self.memo
+
+  def shard_of(self, grid_coords):
+    """ Returns: the worker of every grid, given by the tile of the grid.
+    """
+    tiles = np.floor_divide(np.asarray(grid_coords, dtype=np.int64), self.tile_cells)
+    return ((tiles[:, 0] * 73856093) ^ (tiles[:, 1] * 19349663)) % self.num_workers
+
+  def infer_pairs(self, idx_current_frame, grid_coords, map_records, query_volume=None, low_latency_cells=0):
+    """ Infer the grids in the workers, see HeadInference.infer_pairs().
+    """
+    overlaps = np.zeros(len(map_records), dtype=np.float32)
+    yaws = np.zeros(len(map_records), dtype=np.int64)
+    shards = self.shard_of(grid_coords)
+    pending = []
+    for worker_idx, connection in enumerate(self.connections):
+      idxes = np.flatnonzero(shards == worker_idx)
+      if len(idxes) > 0:
+        connection.send(('infer', idx_current_frame, grid_coords[idxes], map_records[idxes], query_volume,
+                         low_latency_cells))
+        pending.append((connection, idxes))
+    for connection, idxes in pending:
+      overlaps[idxes], yaws[idxes] = connection.recv()
+    return overlaps, yaws
+
+  def cache_statistics(self):
+    for connection in self.connections:
+      connection.send(('statistics',))
+    statistics = [connection.recv() for connection in self.connections]
+    hits = sum(s['hits'] for s in statistics)
+    misses = sum(s['misses'] for s in statistics)
+    return {'hits': hits, 'misses': misses, 'hit_rate': 100.0 * hits / (hits + misses) if hits + misses > 0 else 0.0}
+
+  def print_statistics(self):
+    statistics = self.cache_statistics()
+    print('Feature volume cache hit rate (%d workers): %5.1f %% (%d hits, %d misses)' %
+          (self.num_workers, statistics['hit_rate'], statistics['hits'], statistics['misses']))
+    if self.memo is not None:
+      self.memo.print_statistics()
+
+  def shutdown(self):
+    """ Stop the workers.
+    """
+    for connection in self.connections:
+      connection.send(('stop',))
+    for worker in self.workers:
+      worker.join()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: low-overhead timing of the stages of the MCL loop with csv/json traces and a chrome trace export.
+
+import os
+import csv
+import json
+import time
+import threading
+import numpy as np
+
+
+class NullStage():
+  """ The stage of a disabled timer, it does nothing.
+  """
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage():
+  """ A timed stage, the duration is recorded when the with block is left.
+  """
+  __slots__ = ('timer', 'name', 'start')
+
+  def __init__(self, timer, name):
+    self.timer = timer
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    event = (self.name, self.start, time.perf_counter(), threading.get_ident(), self.timer.frame_idx)
+    with self.timer.lock:
+      self.timer.events.append(event)
+    return False
+
+
+class StageTimer():
+  """ This class records the durations of named stages and per-frame counters (e.g. cache hits, cells inferred).
+    Stages are timed with
+      with timer.stage('name'):
+        ...
+    also in background threads (e.g. disk reads of the cache), they are assigned to the frame in which they end.
+    A disabled timer returns a shared no-op stage, thus the instrumentation can stay in the code.
+  """
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    # events: (stage name, start, end, thread id, frame index)
+    self.events = []
+    self.frames = []
+    self.frame_idx = None
+    self.frame_start = None
+    self.counters = {}
+    self.time_origin = time.perf_counter()
+
+  def enable(self, enabled=True):
+    self.enabled = enabled
+
+  def stage(self, name):
+    if not self.enabled:
+      return NULL_STAGE
+    return Stage(self, name)
+
+  def count(self, name, value=1):
+    """ Add a value to a counter of the current frame.
+    """
+    if not self.enabled:
+      return
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def begin_frame(self, frame_idx):
+    if not self.enabled:
+      return
+    self.frame_idx = frame_idx
+    self.frame_start = time.perf_counter()
+    with self.lock:
+      self.frame_first_event = len(self.events)
+      self.counters = {}
+
+  def end_frame(self, **values):
+    """ Finish the current frame.
+      Args:
+        values: additional values of the frame, e.g. the number of particles.
+    """
+    if not self.enabled or self.frame_idx is None:
+      return
+    frame_end = time.perf_counter()
+    # background threads append concurrently, thus the events of the frame end at the index of the frame event
+    with self.lock:
+      frame_event = len(self.events)
+      self.events.append(('frame', self.frame_start, frame_end, threading.get_ident(), self.frame_idx))
+      events = self.events[self.frame_first_event:frame_event]
+    frame = {'frame': self.frame_idx, 'total': 1000. * (frame_end - self.frame_start)}
+    # stages of background threads (e.g. prefetching) are counted in the frame in which they end
+    for name, start, end, _, frame_idx in events:
+      if frame_idx == self.frame_idx:
+        frame[name] = frame.get(name, 0.) + 1000. * (end - start)
+    for name in frame:
+      if name != 'frame':
+        frame[name] = round(frame[name], 3)
+    with self.lock:
+      frame.update(self.counters)
+    frame.update(values)
+    self.frames.append(frame)
+    self.frame_idx = None
+
+  def stage_names(self):
+    names = []
+    for frame in self.frames:
+      names += [name for name in frame.keys() if name not in names]
+    return names
+
+  def summary(self):
+    """ Returns: for every stage and counter the number of frames, mean, p50, p95, p99 and max
+      of the per-frame values (durations in milliseconds).
+    """
+    summary = {}
+    for name in self.stage_names():
+      if name == 'frame':
+        continue
+      values = np.array([frame[name] for frame in self.frames if name in frame], dtype=np.float64)
+      summary[name] = {'frames': len(values),
+                       'mean': float(np.mean(values)),
+                       'p50': float(np.percentile(values, 50)),
+                       'p95': float(np.percentile(values, 95)),
+                       'p99': float(np.percentile(values, 99)),
+                       'max': float(np.max(values))}
+    return summary
+
+  def chrome_trace(self):
+    """ Returns: the stages as chrome trace (chrome://tracing, perfetto), the counters as counter tracks.
+    """
+    pid = os.getpid()
+    trace_events = []
+    for name, start, end, thread_id, frame_idx in self.events:
+      trace_events.append({'name': name, 'cat': 'mcl', 'ph': 'X', 'pid': pid, 'tid': thread_id,
+                           'ts': 1e6 * (start - self.time_origin), 'dur': 1e6 * (end - start),
+                           'args': {'frame': frame_idx}})
+    timed_stages = self.timed_stages()
+    frame_starts = {frame_idx: start for name, start, _, _, frame_idx in self.events if name == 'frame'}
+    for frame in self.frames:
+      counters = {name: value for name, value in frame.items()
+                  if name not in ['frame', 'total'] and name not in timed_stages}
+      if counters and frame['frame'] in frame_starts:
+        trace_events.append({'name': 'counters', 'ph': 'C', 'pid': pid,
+                             'ts': 1e6 * (frame_starts[frame['frame']] - self.time_origin), 'args': counters})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': {'summary': self.summary()}}
+
+  def timed_stages(self):
+    return set(event[0] for event in self.events)
+
+  def save(self, prefix):
+    """ Write the trace: <prefix>_frames.csv (one row per frame), <prefix>_summary.json (percentiles)
+      and <prefix>_chrome.json (chrome trace).
+    """
+    folder = os.path.dirname(prefix)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+
+    columns = self.stage_names()
+    with open(prefix + '_frames.csv', 'w', newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=columns)
+      writer.writeheader()
+      writer.writerows(self.frames)
+    with open(prefix + '_summary.json', 'w') as f:
+      json.dump(self.summary(), f, indent=2)
+    with open(prefix + '_chrome.json', 'w') as f:
+      json.dump(self.chrome_trace(), f)
+
+  def print_summary(self):
+    timed_stages = self.timed_stages()
+    for name, values in self.summary().items():
+      if name in timed_stages or name == 'total':
+        print('%-16s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms' %
+              (name, values['p50'], values['p95'], values['p99'], values['max']))
+      else:
+        print('%-16s p50 %8.0f     p95 %8.0f     p99 %8.0f     max %8.0f' %
+              (name, values['p50'], values['p95'], values['p99'], values['max']))
+
+
+# the timer of the process, enabled by run_localization() if config['trace_file'] is set
+timer = StageTimer()
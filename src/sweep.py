@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: run the overlap-based MCL for a grid of parameters (e.g. start indices and seeds) with a process pool.
+
+import os
+import sys
+import csv
+import time
+import yaml
+import itertools
+import multiprocessing
+import numpy as np
+
+import utils
+from map_manifest import load_map_manifest
+
+# state of a worker process, set by init_worker()
+worker = {}
+
+# parameters of the network and the feature volume cache, they are loaded once per worker (see init_worker())
+# thus they cannot be swept
+WORKER_PARAMETERS = ['head_backend', 'cache_dtype', 'cache_bytes', 'cache_policy', 'overlap_memo_folder',
+                     'inference_workers', 'factorized_head', 'loader_workers']
+
+
+def load_yaml(filename):
+  if yaml.__version__ >= '5.1':
+    return yaml.load(open(filename), Loader=yaml.FullLoader)
+  return yaml.load(open(filename))
+
+
+def expand_runs(sweep_config):
+  """ Expand the grid of config overrides into a list of runs.
+    Args:
+      sweep_config: sweep configuration, used attributes:
+        'overrides': dict of localization parameters, each with a list of values.
+        'repetitions': number of runs (each with its own random stream) per combination of values.
+    Returns:
+      list of dicts with the overrides of each run.
+    Raises:
+      ValueError: if a parameter of the network or the feature volume cache is overridden.
+  """
+  overrides = sweep_config.get('overrides', {}) or {}
+  fixed = [name for name in sorted(overrides.keys()) if name in WORKER_PARAMETERS]
+  if fixed:
+    raise ValueError('%s cannot be swept, the network and the feature volume cache are loaded once per worker.'
+                     % ', '.join(fixed))
+  names = sorted(overrides.keys())
+  runs = []
+  for values in itertools.product(*[overrides[name] for name in names]):
+    for repetition in range(sweep_config.get('repetitions', 1)):
+      run = dict(zip(names, values))
+      run['repetition'] = repetition
+      runs.append(run)
+  return runs
+
+
+def evaluate_estimates(estimates, poses, start_idx, grid_res, converge_thres=5, interval=100):
+  """ Compare the pose estimates with the ground truth (like evaluate.py).
+    Returns:
+      whether the localization converged at every interval, the rmse of the location in meters
+      and of the yaw in degrees after the first interval (-1 if not converged).
+  """
+  gt_xy = poses[start_idx:, :2, 3]
+  gt_yaw = np.array([utils.euler_angles_from_rotation_matrix(pose[:3, :3])[2] for pose in poses[start_idx:]])
+  diffs_dist = np.linalg.norm(estimates[start_idx:, :2] * grid_res - gt_xy, axis=1)
+  diffs_yaw = np.abs(estimates[start_idx:, 2] - gt_yaw)
+  diffs_yaw = np.minimum(diffs_yaw, np.abs(2. * np.pi - diffs_yaw)) * 180. / np.pi
+
+  checks = diffs_dist[interval::interval]
+  if len(checks) == 0 or not np.all(checks < converge_thres):
+    return False, -1., -1.
+  return True, float(np.sqrt(np.mean(diffs_dist[interval:] ** 2))), float(np.sqrt(np.mean(diffs_yaw[interval:] ** 2)))
+
+
+def init_worker(config, map_folder, mapsize, grid_coords, manifest, poses):
+  """ Set up a worker: the network and the feature volume cache are loaded once per worker,
+    the map (manifest, grid coordinates) and the poses are inherited from the parent process.
+  """
+  from head_inference import create_fast_infer
+  worker['config'] = config
+  worker['map_folder'] = map_folder
+  worker['mapsize'] = mapsize
+  worker['grid_coords'] = grid_coords
+  worker['manifest'] = manifest
+  worker['poses'] = poses
+  # the runs are already distributed to processes, thus no inference workers
+  worker['model'] = create_fast_infer(dict(config, inference_workers=0))
+
+
+def run_worker(args):
+  """ Run one configuration in a worker. A failing run does not stop the sweep,
+    its error is reported in the 'error' column of the results.
+    Args:
+      args: index of the run, overrides of the config and the seed sequence of the run.
+    Returns:
+      a dict with the overrides, the evaluation and the timings of the run (or the error).
+  """
+  run_idx, overrides, seed_sequence = args
+  try:
+    return run_configuration(run_idx, overrides, seed_sequence)
+  except Exception as error:
+    result = {'run': run_idx}
+    result.update(overrides)
+    result.update({'error': '%s: %s' % (type(error).__name__, error), 'pid': os.getpid()})
+    return result
+
+
+def run_configuration(run_idx, overrides, seed_sequence):
+  """ Run one configuration, see run_worker().
+  """
+  from main_overlap_mcl import run_localization
+  from sensor_model_overlap import SensorModel
+
+  config = dict(worker['config'])
+  config.update({name: value for name, value in overrides.items() if name != 'repetition'})
+  config['visualize'] = False
+  config['save_result'] = False
+
+  # an independent random stream per run
+  rng = np.random.default_rng(seed_sequence)
+
+  t_start = time.perf_counter()
+  sensor_model = SensorModel(config, worker['mapsize'], worker['map_folder'],
+                             model=worker['model'], manifest=worker['manifest'])
+  estimates, frame_times, _ = run_localization(config, sensor_model, worker['mapsize'], worker['grid_coords'],
+                                               worker['poses'], rng=rng)
+  sensor_model.shutdown()
+  runtime = time.perf_counter() - t_start
+
+  start_idx = config['start_index']
+  success, rmse_location, rmse_yaw = evaluate_estimates(estimates, worker['poses'], start_idx,
+                                                        config['resolution'],
+                                                        config.get('eval_converge_thres', 5),
+                                                        config.get('eval_interval', 100))
+  frame_times = frame_times[start_idx:]
+  result = {'run': run_idx}
+  result.update(overrides)
+  result.update({'success_converge': success,
+                 'rmse_location': rmse_location,
+                 'rmse_yaw': rmse_yaw,
+                 'frames': len(frame_times),
+                 'runtime_s': runtime,
+                 'frame_ms_mean': 1000. * float(np.mean(frame_times)) if len(frame_times) > 0 else 0.,
+                 'frame_ms_max': 1000. * float(np.max(frame_times)) if len(frame_times) > 0 else 0.,
+                 'pid': os.getpid()})
+  return result
+
+
+def save_results(results, filename):
+  """ Write the results of all runs as a csv table.
+  """
+  columns = []
+  for result in results:
+    columns += [name for name in result.keys() if name not in columns]
+  with open(filename, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=columns)
+    writer.writeheader()
+    for result in sorted(results, key=lambda result: result['run']):
+      writer.writerow(result)
+
+
+def print_results(results):
+  for result in sorted(results, key=lambda result: result['run']):
+    print(', '.join('%s: %s' % (name, ('%.3f' % value) if isinstance(value, float) else value)
+                    for name, value in result.items()))
+
+
+if __name__ == '__main__':
+  # load config file
+  sweep_filename = '../config/sweep.yml'
+  if len(sys.argv) > 1:
+    sweep_filename = sys.argv[1]
+  sweep_config = load_yaml(sweep_filename)
+  config = load_yaml(sweep_config['localization_config'])
+
+  # load the map and the poses once, the workers share them read-only.
+  # The network is not loaded here, thus no GPU context is inherited by the workers.
+  map_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'], 'feature_volumes')
+  manifest = load_map_manifest(map_folder, config['resolution'])
+  mapsize = manifest.bounds
+  grid_coords = manifest.coords.astype(float)
+  poses = utils.load_lidar_poses(config['pose_file'], config['calib_file'])
+
+  runs = expand_runs(sweep_config)
+  seed_sequences = np.random.SeedSequence(sweep_config.get('seed', 0)).spawn(len(runs))
+  num_workers = sweep_config.get('workers', 0) or os.cpu_count()
+  print('Running %d configurations with %d workers' % (len(runs), num_workers))
+
+  # fork: the workers inherit the loaded map without copying it (copy-on-write)
+  t_start = time.perf_counter()
+  context = multiprocessing.get_context('fork')
+  with context.Pool(num_workers, initializer=init_worker,
+                    initargs=(config, map_folder, mapsize, grid_coords, manifest, poses)) as pool:
+    results = []
+    for result in pool.imap_unordered(run_worker, zip(range(len(runs)), runs, seed_sequences)):
+      results.append(result)
+      if 'error' in result:
+        print('failed run %d (%d of %d): %s' % (result['run'], len(results), len(runs), result['error']))
+      else:
+        print('finished run %d (%d of %d)' % (result['run'], len(results), len(runs)))
+
+  print_results(results)
+  save_results(results, sweep_config.get('results_file', 'sweep_results.csv'))
+  print('Sweep finished in %.1f s, results saved to %s' %
+        (time.perf_counter() - t_start, sweep_config.get('results_file', 'sweep_results.csv')))
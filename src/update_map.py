@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Developed by Xieyuanli Chen and Thomas Läbe
+# This file is covered by the LICENSE file in the root of this project.
+# Brief: incremental update of the map with a new drive, only new and changed grids are generated.
+
+import os
+import sys
+import yaml
+import numpy as np
+from scipy.spatial import cKDTree
+
+import utils
+from feature_volume_store import FeatureVolumeStore
+
+# the virtual scan of a grid is generated from the map points inside a box of +-50 m (x, y) and +-5 m (z),
+# see crop_cloud_with_bbox() of prepare_training/gen_virtual_scan.py
+CROP_HALF_SIZE = 50.
+CROP_HALF_HEIGHT = 5.
+
+
+def load_yaml(filename):
+  if yaml.__version__ >= '5.1':
+    return yaml.load(open(filename), Loader=yaml.FullLoader)
+  return yaml.load(open(filename))
+
+
+def load_drive_poses(pose_file, calib_file, map_pose_file, map_calib_file):
+  """ Load the poses of a new drive and convert them into the LiDAR coordinate system
+    of the first frame of the map drive (like utils.load_lidar_poses() for the map drive).
+    Returns:
+      A numpy array of size nx4x4 with n poses as 4x4 transformation matrices.
+  """
+  poses = np.array(utils.load_poses(pose_file))
+  inv_map_frame0 = np.linalg.inv(utils.load_poses(map_pose_file)[0])
+  T_cam_velo = np.asarray(utils.load_calib(calib_file)).reshape((4, 4))
+  T_velo_cam_map = np.linalg.inv(np.asarray(utils.load_calib(map_calib_file)).reshape((4, 4)))
+  return np.array([T_velo_cam_map.dot(inv_map_frame0).dot(pose).dot(T_cam_velo) for pose in poses])
+
+
+def changed_voxels(map_points, new_points, voxel_size, min_points=1):
+  """ Find the voxels which are occupied by the new points, but not by the map.
+    Only the map points inside the bounding box of the new points are compared.
+    Args:
+      map_points: nx3 numpy array of the points of the map.
+      new_points: mx3 numpy array of the points of the new drive.
+      voxel_size: edge length of the voxels.
+      min_points: minimal number of new points in a voxel.
+    Returns:
+      kx3 numpy array of the centers of the changed voxels.
+  """
+  if len(new_points) == 0:
+    return np.zeros((0, 3))
+  new_voxels, counts = np.unique(np.floor(new_points / voxel_size).astype(np.int64), axis=0, return_counts=True)
+  new_voxels = new_voxels[counts >= min_points]
+  if len(new_voxels) == 0:
+    return np.zeros((0, 3))
+
+  low, high = np.min(new_voxels, axis=0), np.max(new_voxels, axis=0)
+  map_voxels = np.floor(map_points / voxel_size).astype(np.int64)
+  map_voxels = map_voxels[np.all((map_voxels >= low) & (map_voxels <= high), axis=1)]
+
+  # voxels inside the bounding box as flat indexes
+  size = high - low + 1
+  def flat(voxels):
+    local = voxels - low
+    return (local[:, 0] * size[1] + local[:, 1]) * size[2] + local[:, 2]
+  is_changed = ~np.isin(flat(new_voxels), flat(map_voxels))
+  return (new_voxels[is_changed] + 0.5) * voxel_size
+
+
+def affected_grids(changed_points, grid_coords, resolution, max_range):
+  """ Find the grids whose virtual scans see changed points.
+    Args:
+      changed_points: kx3 numpy array of changed points (e.g. centers of changed voxels).
+      grid_coords: nx2 numpy array of integer grid coordinates.
+      resolution: the resolution of the grids.
+      max_range: maximal range of the virtual scans.
+    Returns:
+      mx2 numpy array of the affected grids.
+  """
+  changed_points = changed_points[np.abs(changed_points[:, 2]) < CROP_HALF_HEIGHT]
+  if len(changed_points) == 0:
+    return np.zeros((0, 2), dtype=np.int64)
+  radius = min(max_range, CROP_HALF_SIZE)
+
+  # only the grids near the bounding box of the changes are checked
+  real_coords = grid_coords * resolution
+  low = np.min(changed_points[:, :2], axis=0) - radius
+  high = np.max(changed_points[:, :2], axis=0) + radius
+  candidates = np.flatnonzero(np.all((real_coords >= low) & (real_coords <= high), axis=1))
+  distances, _ = cKDTree(changed_points[:, :2]).query(real_coords[candidates], distance_upper_bound=radius)
+  return grid_coords[candidates[np.isfinite(distances)]]
+
+
+def update_map(prepare_config, config, update_config):
+  """ Extend the map with a new drive: the point cloud map, the virtual scans, the depth and normal data and
+    the feature volumes are generated only for grids which are new or whose neighbourhood point cloud changed.
+    The new and changed feature volumes are appended to the store (see FeatureVolumeStore.create()),
+    the records of the other grids, their overlap memo entries and head parts are kept.
+    The point cloud map is saved last, thus an interrupted update is repeated with the same grids
+    (and the generation of the feature volumes resumes from its checkpoint).
+  """
+  import open3d as o3d
+  from fast_infer import FastInfer
+  from map_manifest import MapManifest, manifest_path
+  from prepare_training.gen_virtual_scan import accumulate_scans, gen_grid_scan, grid_file_name, rasterize_poses
+  from prepare_training.gen_depth_and_normal_map import gen_depth_and_normal_grid
+
+  resolution = prepare_config['resolution']
+  range_image_params = prepare_config['range_image']
+  seq_folder = os.path.join(config['data_root_folder'], config['infer_seqs_map'])
+  map_store = FeatureVolumeStore(seq_folder)
+
+  print("================================================================================")
+  print(" step1: accumulate the scans of the new drive and find the changes of the map ...")
+  map_poses = utils.load_lidar_poses(prepare_config['pose_file'], prepare_config['calib_file'])
+  poses = load_drive_poses(update_config['new_pose_file'], update_config['new_calib_file'],
+                           prepare_config['pose_file'], prepare_config['calib_file'])
+  scan_paths = utils.load_files(update_config['new_scan_folder'])
+  num_frames = min(len(poses), len(scan_paths))
+  poses, scan_paths = poses[:num_frames], scan_paths[:num_frames]
+  new_cloud = accumulate_scans(poses, scan_paths)
+  pcd_map = o3d.io.read_point_cloud(prepare_config['map_file'])
+  changed = changed_voxels(np.asarray(pcd_map.points), np.asarray(new_cloud.points),
+                           update_config.get('change_voxel_size', 0.5), update_config.get('min_change_points', 5))
+  print('%d changed voxels' % len(changed))
+
+  print(" ")
+  print("================================================================================")
+  print(" step2: find the new and the changed grids ...")
+  drive_grids, drive_heights = rasterize_poses(poses[:, :3, 3], resolution, prepare_config['offset'])
+  is_new = map_store.lookup(drive_grids) < 0
+  changed_grids = affected_grids(changed, map_store.keys, resolution, range_image_params['max_range'])
+  # the height of the virtual sensor of a changed grid is given by the nearest pose
+  all_poses = np.concatenate([map_poses[:, :3, 3], poses[:, :3, 3]])
+  _, nearest = cKDTree(all_poses[:, :2]).query(changed_grids * resolution)
+  grids = np.concatenate([drive_grids[is_new], changed_grids])
+  heights = np.concatenate([drive_heights[is_new], all_poses[nearest, 2]])
+  print('%d new grids, %d changed grids of %d grids of the map' % (np.sum(is_new), len(changed_grids), len(map_store)))
+  if len(grids) == 0:
+    print('The map is up to date.')
+    return
+
+  print(" ")
+  print("================================================================================")
+  print(" step3: generate virtual scans, depth and normal data of the new and changed grids ...")
+  pcd_map = (pcd_map + new_cloud).voxel_down_sample(0.02)
+  for folder in [prepare_config['virtual_scan_folder'], prepare_config['map_depth_folder'],
+                 prepare_config['map_normal_folder']]:
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+  for (grid_x, grid_y), height in zip(grids, heights):
+    x_global, y_global = grid_x * resolution, grid_y * resolution
+    gen_grid_scan(pcd_map, prepare_config['virtual_scan_folder'], x_global, y_global, height, range_image_params)
+    gen_depth_and_normal_grid(os.path.join(prepare_config['virtual_scan_folder'],
+                                           grid_file_name(x_global, y_global) + '.npz'),
+                              prepare_config['map_depth_folder'], prepare_config['map_normal_folder'],
+                              range_image_params)
+
+  print(" ")
+  print("================================================================================")
+  print(" step4: generate the feature volumes of the new and changed grids ...")
+  config = dict(config, infer_seqs=config['infer_seqs_map'])
+  infer = FastInfer(config, cache_size=1)
+  infer.save_feature_volumes(grids * resolution, replace=True)
+
+  manifest = MapManifest(FeatureVolumeStore(seq_folder).keys, resolution)
+  manifest.save(manifest_path(os.path.join(seq_folder, 'feature_volumes')))
+  print('Saved map manifest with %d grids.' % len(manifest.coords))
+
+  # the point cloud map is replaced last
+  map_file = prepare_config['map_file']
+  root, extension = os.path.splitext(map_file)
+  o3d.io.write_point_cloud(root + '.tmp' + extension, pcd_map)
+  os.replace(root + '.tmp' + extension, map_file)
+  print('Saved the updated map in: ', map_file)
+
+
+if __name__ == '__main__':
+  # load config file
+  update_filename = '../config/update_map.yml'
+  if len(sys.argv) > 1:
+    update_filename = sys.argv[1]
+  update_config = load_yaml(update_filename)
+
+  update_map(load_yaml(update_config['prepare_config']), load_yaml(update_config['localization_config']),
+             update_config)
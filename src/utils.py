@@ -60,6 +60,28 @@ def load_calib(calib_path):
   return np.array(T_cam_velo)
 
 
+def load_lidar_poses(pose_path, calib_path):
+  """ Load ground truth poses and convert them into the LiDAR coordinate system of the first frame.
+    Args:
+      pose_path: (Complete) filename for the pose file
+      calib_path: (Complete) filename for the calib file
+    Returns:
+      A numpy array of size nx4x4 with n poses as 4x4 transformation
+      matrices
+  """
+  poses = load_poses(pose_path)
+  inv_frame0 = np.linalg.inv(poses[0])
+
+  T_cam_velo = np.asarray(load_calib(calib_path)).reshape((4, 4))
+  T_velo_cam = np.linalg.inv(T_cam_velo)
+
+  # convert poses in LiDAR coordinate system
+  new_poses = []
+  for pose in poses:
+    new_poses.append(T_velo_cam.dot(inv_frame0).dot(pose).dot(T_cam_velo))
+  return np.array(new_poses)
+
+
 def range_projection(current_vertex, fov_up=3.0, fov_down=-25.0, proj_H=64, proj_W=900, max_range=50):
   """ Project a pointcloud into a spherical projection, range image.
     Args: